@@ -94,6 +94,10 @@ async function fetchWithAuthRetry(url, options, isRetry = false) {
       return response; 
     }
   }  
+  if (!response.ok) {
+    // The server logs each request under this ID (TRACE_LOG)
+    console.warn(`Server answered ${response.status} to ${url} (request ID ${response.headers.get('X-Request-ID') || 'unknown'})`);
+  }
   return response;
 }
 
@@ -117,6 +121,7 @@ if (typeof browser !== 'undefined' && browser.runtime && browser.runtime.onMessa
         .then(async fetchResponse => ({ok: fetchResponse.ok, status: fetchResponse.status, statusText: fetchResponse.statusText, data: await fetchResponse.json()}))
         .then(parsedServerResponse => {
           if (!parsedServerResponse.ok) sendResponse({ success: false, message: `${magnetName}: ${parsedServerResponse.data.error || `Server error (${parsedServerResponse.status})`}` });
+          else if (parsedServerResponse.status === 202) sendResponse({ success: true, message: `${magnetName} queued on the server.` });
           else sendResponse({ success: true, message: `${magnetName} successfully sent to server.` });
         })
         .catch(error => {
@@ -125,6 +130,20 @@ if (typeof browser !== 'undefined' && browser.runtime && browser.runtime.onMessa
           else sendResponse({ success: false, message: `${magnetName}: Processing error - ${error.message}` });
         });
       return true; 
+    } else if (message.type === 'RESOLVE_MAGNETS' && Array.isArray(message.hrefs)) {
+      browser.storage.local.get(['isLoggedIn', 'serverUrl'])
+        .then(async storageData => {
+          // Not resolved: success false lets content.js try these links again later
+          if (!storageData.isLoggedIn || !storageData.serverUrl) return { success: false, results: [] };
+          const fetchOptions = { method: 'POST', headers: { 'Content-Type': 'application/json' }, mode: 'cors', credentials: 'include', body: JSON.stringify({ magnet_links: message.hrefs }) };
+          const fetchResponse = await fetchWithAuthRetry(`${storageData.serverUrl}/resolve_magnets`, fetchOptions);
+          if (!fetchResponse.ok) return { success: false, results: [] };
+          const data = await fetchResponse.json();
+          return { success: true, results: data.results || [] };
+        })
+        .then(response => sendResponse(response))
+        .catch(() => sendResponse({ success: false, results: [] }));
+      return true;
     } else if (message.type === 'USER_LOGOUT_REQUESTED') {
       performLogoutCleanup(false)
         .then(() => sendResponse({ success: true, message: 'Logout cleanup done.'}))
@@ -170,7 +189,8 @@ if (typeof browser !== 'undefined' && browser.downloads && browser.downloads.onC
           const errorMsg = serverResponseData.error || `Server error (${serverResponse.status})`;
           await showSystemNotification('.torrent Upload Error', `${filenameForNotification}: ${errorMsg}`, false);
         } else {
-          await showSystemNotification('.torrent Uploaded', `${filenameForNotification} successfully uploaded.`);
+          const uploadMessage = serverResponse.status === 202 ? 'uploaded and queued on the server' : 'successfully uploaded';
+          await showSystemNotification('.torrent Uploaded', `${filenameForNotification} ${uploadMessage}.`);
           if (prefs.removeTorrentAfterUpload) {
             try { await browser.downloads.removeFile(downloadDelta.id); } 
             catch (removeError) { /* console.error('Background: Failed to remove .torrent file:', removeError); */ await showSystemNotification('File Removal Error', `${filenameForNotification}: Could not be removed.`, false); }
@@ -43,6 +43,45 @@ function InterceptMagnetLinkClick(event) {
     });
 }
 
+// Magnet links already sent to the server's /resolve_magnets, in batches of at most this many
+const resolvedMagnetHrefs = new Set();
+const RESOLVE_BATCH_SIZE = 500;
+
+function annotateMagnetLinks(results) {
+  const byHref = new Map();
+  results.forEach(result => result.magnet_links.forEach(href => byHref.set(href, result)));
+  document.querySelectorAll('a[href^="magnet:"]').forEach(link => {
+    const result = byHref.get(link.href);
+    if (!result) return;
+    const name = result.name || result.info_hash;
+    link.title = result.present ? `${name} (already in qBittorrent)` : name;
+    if (result.present) {
+      link.dataset.magnetExtPresent = 'true';
+      link.style.opacity = '0.6';
+    }
+  });
+}
+
+function resolveMagnetLinks(magnetLinks) {
+  const hrefs = [...new Set(Array.from(magnetLinks, link => link.href))].filter(href => !resolvedMagnetHrefs.has(href));
+  for (let i = 0; i < hrefs.length; i += RESOLVE_BATCH_SIZE) {
+    const batch = hrefs.slice(i, i + RESOLVE_BATCH_SIZE);
+    // Marked as resolved while in flight; a failed lookup unmarks them so a
+    // later scan of the page retries them
+    const forgetBatch = () => batch.forEach(href => resolvedMagnetHrefs.delete(href));
+    batch.forEach(href => resolvedMagnetHrefs.add(href));
+    browser.runtime.sendMessage({ type: 'RESOLVE_MAGNETS', hrefs: batch })
+      .then(response => {
+        if (response && response.success) {
+          annotateMagnetLinks(response.results);
+        } else {
+          forgetBatch();
+        }
+      })
+      .catch(forgetBatch);
+  }
+}
+
 function attachListenersToMagnetLinks() {
   const magnetLinks = document.querySelectorAll('a[href^="magnet:"]');
   magnetLinks.forEach(link => {
@@ -50,6 +89,7 @@ function attachListenersToMagnetLinks() {
     link.removeEventListener('click', InterceptMagnetLinkClick, false);
     link.addEventListener('click', InterceptMagnetLinkClick, true);
   });
+  resolveMagnetLinks(magnetLinks);
 }
 
 function detachListenersFromMagnetLinks() {
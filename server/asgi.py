@@ -0,0 +1,198 @@
+# server/asgi.py
+# ASGI entry point for the async server mode. Run it with e.g.
+#   uvicorn --factory asgi:create_asgi_app --host 0.0.0.0 --port 5000
+# Async views (the /add_* routes when create_app(async_mode=True)) are awaited
+# directly on the server's event loop, and hand their blocking steps (auth,
+# rate limits, request parsing) to threads; every other route runs through the
+# regular Flask WSGI stack in a worker thread.
+import asyncio
+import inspect
+import sys
+import tempfile
+
+from flask import request
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import run_wsgi_app
+
+from app import create_app, close_async_torrent_db_client, warm_up_async_torrent_db_client, warm_up_settings, warm_up_users
+
+
+class AsgiAdapter():
+    def __init__(self, flask_app, max_body_size=None, spool_max_size=1024 * 1024, spool_dir=None):
+        self.app = flask_app
+        self.max_body_size = max_body_size
+        self.spool_max_size = spool_max_size
+        self.spool_dir = spool_dir
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise RuntimeError(f"Unsupported ASGI scope type '{scope['type']}'")
+
+        body = await self._read_body(receive)
+        if body is None:
+            await self._send_simple(send, 413, b'{"error": "Request body too large"}')
+            return
+        try:
+            environ = self._build_environ(scope, body)
+            if inspect.iscoroutinefunction(self._match_view(environ)):
+                await self._dispatch_async(environ, send)
+            else:
+                await self._dispatch_wsgi(environ, send)
+        finally:
+            body.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Load the users and log in to qBittorrent before accepting
+                # requests; the login is bounded by QB_WARMUP_TIMEOUT, and a
+                # failure still lets the server start
+                await asyncio.to_thread(warm_up_users)
+                if self.app.config.get('QB_WARMUP'):
+                    await warm_up_async_torrent_db_client(**warm_up_settings())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_async_torrent_db_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        # Spools the request body so the Flask request parsing works unchanged;
+        # small bodies stay in memory, large uploads spill to a temp file.
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size, dir=self.spool_dir)
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if self.max_body_size is not None and size > self.max_body_size:
+                body.close()
+                return None
+            body.write(chunk)
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    def _build_environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').upper().replace('-', '_')
+            value = raw_value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        if 'CONTENT_LENGTH' not in environ:
+            body.seek(0, 2)
+            environ['CONTENT_LENGTH'] = str(body.tell())
+            body.seek(0)
+        return environ
+
+    def _match_view(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return self.app.view_functions.get(endpoint)
+
+    async def _dispatch_async(self, environ, send):
+        # Mirrors Flask's full_dispatch_request, awaiting the view instead of
+        # handing it to a thread. Flask's contexts are contextvars, so they stay
+        # local to this coroutine.
+        with self.app.request_context(environ):
+            try:
+                rv = self.app.preprocess_request()
+                if rv is None:
+                    rv = await self.app.view_functions[request.url_rule.endpoint](**request.view_args)
+            except Exception as e:
+                try:
+                    rv = self.app.handle_user_exception(e)
+                except Exception as unhandled:
+                    rv = self.app.handle_exception(unhandled)
+            response = self.app.finalize_request(rv)
+            await send({
+                'type': 'http.response.start',
+                'status': response.status_code,
+                'headers': self._encode_headers(response.headers.to_wsgi_list()),
+            })
+            if hasattr(response.response, '__aiter__'):
+                # Streamed from an async generator, e.g. /events
+                try:
+                    async for chunk in response.response:
+                        if isinstance(chunk, str):
+                            chunk = chunk.encode('utf-8')
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                finally:
+                    await response.response.aclose()
+            else:
+                for chunk in response.iter_encoded():
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            response.close()
+
+    async def _dispatch_wsgi(self, environ, send):
+        app_iter, status, headers = await asyncio.to_thread(run_wsgi_app, self.app, environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': self._encode_headers(headers.to_wsgi_list()),
+        })
+        # Chunks are pulled in the worker thread, so streaming responses never
+        # block the event loop
+        iterator = iter(app_iter)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, iterator, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def _encode_headers(headers):
+        return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    @staticmethod
+    async def _send_simple(send, status, body):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(test_config=None):
+    flask_app = create_app(test_config, async_mode=True)
+    return AsgiAdapter(
+        flask_app,
+        max_body_size=flask_app.config['MAX_CONTENT_LENGTH'],
+        spool_max_size=flask_app.config['UPLOAD_SPOOL_MAX_SIZE'],
+        spool_dir=flask_app.config['UPLOAD_SPOOL_DIR'] or None,
+    )
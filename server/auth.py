@@ -0,0 +1,283 @@
+# server/auth.py
+# Users and cheap re-authentication for the API: user stores that map
+# usernames to password hashes and pick up changes without a restart, signed
+# bearer tokens that are checked with an HMAC instead of a password hash, and
+# a short-lived cache of recent successful password checks so repeated /login
+# calls skip the KDF.
+#
+# Run as a script to turn APP_USERS into APP_USER_HASHES, so workers don't
+# hash every password when they start:
+#   APP_USERS=user1:pass1,user2:pass2 python auth.py
+# or to set (or --remove) a user's password in a USER_STORE file or database:
+#   python auth.py users.sqlite3 alice
+import hashlib
+import hmac
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+
+class ApiTokens():
+    # Long-lived bearer tokens: the username and issue time, signed with
+    # HMAC-SHA256. Verification is a constant-time signature comparison, no
+    # server-side state. Rotating the secret revokes every token.
+    def __init__(self, secret, ttl=30 * 24 * 3600):
+        self.ttl = ttl
+        self._serializer = URLSafeTimedSerializer(secret, salt='api-token')
+
+    def issue(self, username):
+        return self._serializer.dumps({'u': username})
+
+    def verify(self, token):
+        # Returns the token's username, or None if it is invalid or expired
+        try:
+            payload = self._serializer.loads(token, max_age=self.ttl)
+        except (SignatureExpired, BadSignature):
+            return None
+        username = payload.get('u') if isinstance(payload, dict) else None
+        return username if isinstance(username, str) else None
+
+
+class CredentialCache():
+    # Remembers successful password checks for ttl seconds. Entries are keyed
+    # by an HMAC of username and password under a per-process random key, so
+    # neither is kept in memory, and tied to the password hash they were
+    # checked against, so a changed password is verified again. Failed checks
+    # are never cached.
+    def __init__(self, ttl=300.0, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()  # digest -> (expires_at, password_hash)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, username, password):
+        message = username.encode('utf-8') + b'\0' + password.encode('utf-8')
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def verify(self, username, password, password_hash):
+        if not self.ttl:
+            return check_password_hash(password_hash, password)
+        digest = self._digest(username, password)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] > now and entry[1] == password_hash:
+                self.hits += 1
+                return True
+            self.misses += 1
+        if not check_password_hash(password_hash, password):
+            return False
+        with self._lock:
+            self._entries[digest] = (now + self.ttl, password_hash)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def is_password_hash(value):
+    # Whether value looks like a werkzeug generate_password_hash() result,
+    # e.g. 'scrypt:32768:8:1$salt$hash'
+    method, _, rest = value.partition('$')
+    return method.split(':', 1)[0] in ('scrypt', 'pbkdf2') and rest.count('$') == 1
+
+
+class UserStore():
+    # username -> password hash. The users are loaded on first use and
+    # replaced as a whole when the source changed, checked at most every
+    # check_interval seconds, so a lookup is a dict lookup and adding or
+    # removing a user needs no restart. Subclasses implement _load() and
+    # _version(), a value that changes whenever the source does. A source
+    # that can't be read leaves the users loaded before in place.
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._users = None
+        self._loaded_version = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _version(self):
+        return None
+
+    def _current(self):
+        if self._users is not None and time.monotonic() < self._next_check:
+            return self._users
+        with self._lock:
+            if self._users is None or time.monotonic() >= self._next_check:
+                self._next_check = time.monotonic() + self.check_interval
+                try:
+                    version = self._version()
+                    if self._users is None or version != self._loaded_version:
+                        users = self._load()
+                        if not users:
+                            logger.warning("No users loaded from %s", self)
+                        elif self._users is not None:
+                            logger.info("Reloaded %d users from %s", len(users), self)
+                        self._users, self._loaded_version = users, version
+                except (OSError, sqlite3.Error, UnicodeDecodeError) as e:
+                    logger.warning("Could not load users from %s: %s", self, e)
+                    if self._users is None:
+                        self._users = {}
+            return self._users
+
+    def get(self, username):
+        return self._current().get(username)
+
+    def __contains__(self, username):
+        return username in self._current()
+
+    def __len__(self):
+        return len(self._current())
+
+
+def parse_user_hashes(text, source):
+    # 'user1:hash1,user2:hash2', or one pair per line; '#' starts a comment
+    users = {}
+    for line in text.splitlines():
+        for pair in line.partition('#')[0].split(','):
+            username, _, password_hash = pair.strip().partition(':')
+            if username and is_password_hash(password_hash):
+                users[username] = password_hash
+            elif pair.strip():
+                logger.warning("Skipping malformed user entry '%s' in %s", username, source)
+    return users
+
+
+class EnvUserStore(UserStore):
+    # APP_USERS (username:password pairs, hashed when first needed) and
+    # APP_USER_HASHES (username:password_hash pairs); never changes
+    def __init__(self, app_users='', app_user_hashes=''):
+        super().__init__(check_interval=float('inf'))
+        self.app_users = app_users
+        self.app_user_hashes = app_user_hashes
+
+    def _load(self):
+        users = {}
+        for pair in self.app_users.split(',') if self.app_users else ():
+            if ':' in pair:
+                username, password = pair.split(':', 1)
+                users[username.strip()] = generate_password_hash(password.strip())
+            else:
+                logger.warning("Skipping malformed user entry '%s' in APP_USERS", pair)
+        users.update(parse_user_hashes(self.app_user_hashes, 'APP_USER_HASHES'))
+        return users
+
+    def __str__(self):
+        return 'APP_USERS/APP_USER_HASHES'
+
+
+class FileUserStore(UserStore):
+    # A text file of username:password_hash pairs, as printed by this module
+    # when run as a script. Reloaded when its mtime, size or inode changes, so
+    # replacing the file atomically is picked up too.
+    def __init__(self, path, check_interval=1.0):
+        super().__init__(check_interval)
+        self.path = path
+
+    def _version(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as f:
+            return parse_user_hashes(f.read(), self.path)
+
+    def set(self, username, password_hash):
+        # password_hash None removes the user. Written to a temporary file
+        # and renamed, so readers never see a partial file.
+        try:
+            users = self._load()
+        except FileNotFoundError:
+            users = {}
+        users.pop(username, None)
+        if password_hash is not None:
+            users[username] = password_hash
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            f.writelines(f'{name}:{value}\n' for name, value in users.items())
+        os.replace(self.path + '.tmp', self.path)
+
+    def __str__(self):
+        return self.path
+
+
+class SQLiteUserStore(UserStore):
+    # A users(username, password_hash) table. Reloaded when PRAGMA
+    # data_version says another connection committed, which, unlike the
+    # mtime, also sees writes still in the WAL.
+    def __init__(self, path, check_interval=1.0):
+        super().__init__(check_interval)
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA busy_timeout = 5000')
+        self._db.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL)')
+
+    def _version(self):
+        return self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    def _load(self):
+        return {
+            username: password_hash
+            for username, password_hash in self._db.execute('SELECT username, password_hash FROM users')
+            if is_password_hash(password_hash)
+        }
+
+    def set(self, username, password_hash):
+        with self._lock:
+            if password_hash is None:
+                self._db.execute('DELETE FROM users WHERE username = ?', (username,))
+            else:
+                self._db.execute('INSERT OR REPLACE INTO users VALUES (?, ?)', (username, password_hash))
+            self._users = None  # data_version ignores this connection's own writes
+
+    def __str__(self):
+        return self.path
+
+
+def open_user_store(path, check_interval=1.0):
+    # SQLite for .db, .sqlite and .sqlite3 files, a text file otherwise
+    if path.endswith(('.db', '.sqlite', '.sqlite3')):
+        return SQLiteUserStore(path, check_interval)
+    return FileUserStore(path, check_interval)
+
+
+def hash_users(app_users):
+    # 'user1:pass1,user2:pass2' -> 'user1:<hash>,user2:<hash>'
+    pairs = []
+    for pair in app_users.split(','):
+        username, separator, password = pair.partition(':')
+        if separator:
+            pairs.append(f'{username.strip()}:{generate_password_hash(password.strip())}')
+    return ','.join(pairs)
+
+
+if __name__ == '__main__':
+    import getpass
+
+    args = [arg for arg in sys.argv[1:] if arg != '--remove']
+    if len(args) == 2:
+        store = open_user_store(args[0])
+        if '--remove' in sys.argv:
+            store.set(args[1], None)
+        else:
+            store.set(args[1], generate_password_hash(getpass.getpass(f'Password for {args[1]}: ')))
+    else:
+        print(hash_users(os.environ.get('APP_USERS') or getpass.getpass('APP_USERS (user1:pass1,user2:pass2): ')))
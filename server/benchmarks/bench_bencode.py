@@ -0,0 +1,115 @@
+# server/benchmarks/bench_bencode.py
+# Parse time and peak memory of torrent_meta.parse_torrent on large synthetic
+# multi-file torrents, compared with decoding the whole file into Python
+# objects and re-encoding 'info' to hash it (the usual bencode library route).
+#
+#   python benchmarks/bench_bencode.py [--files 1000,5000,20000,50000] [--repeat 5]
+#
+# Each torrent is spooled to a temp file and parsed through an mmap, the way a
+# large upload that spilled to disk is parsed by the server.
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from torrent_meta import parse_torrent, upload_buffer  # noqa: E402
+
+
+def bencode(value):
+    if isinstance(value, int):
+        return b"i%de" % value
+    if isinstance(value, bytes):
+        return b"%d:%s" % (len(value), value)
+    if isinstance(value, list):
+        return b"l" + b"".join(bencode(item) for item in value) + b"e"
+    return b"d" + b"".join(bencode(key) + bencode(value[key]) for key in sorted(value)) + b"e"
+
+
+def make_torrent(file_count, file_size=3 * 1024 * 1024, piece_length=256 * 1024):
+    files = [
+        {b"length": file_size + i, b"path": [b"disc%d" % (i // 500), b"track %05d - some long title.flac" % i]}
+        for i in range(file_count)
+    ]
+    total = sum(f[b"length"] for f in files)
+    pieces = os.urandom(20) * ((total + piece_length - 1) // piece_length)
+    info = {b"files": files, b"name": b"corpus-%d" % file_count, b"piece length": piece_length, b"pieces": pieces}
+    return bencode({b"announce": b"http://tracker.example/announce", b"info": info})
+
+
+def full_decode(data, i=0):
+    # Straightforward recursive decoder producing dicts, lists, ints and bytes
+    c = data[i:i + 1]
+    if c == b"i":
+        end = data.index(b"e", i)
+        return int(data[i + 1:end]), end + 1
+    if c == b"l":
+        items, i = [], i + 1
+        while data[i:i + 1] != b"e":
+            item, i = full_decode(data, i)
+            items.append(item)
+        return items, i + 1
+    if c == b"d":
+        result, i = {}, i + 1
+        while data[i:i + 1] != b"e":
+            key, i = full_decode(data, i)
+            result[key], i = full_decode(data, i)
+        return result, i + 1
+    colon = data.index(b":", i)
+    end = colon + 1 + int(data[i:colon])
+    return data[colon + 1:end], end
+
+
+def full_decode_metadata(stream):
+    stream.seek(0)
+    torrent, _ = full_decode(stream.read())
+    info = torrent[b"info"]
+    files = info.get(b"files") or [info]
+    return (info[b"name"].decode(), hashlib.sha1(bencode(info)).hexdigest(),
+            sum(f[b"length"] for f in files), len(files))
+
+
+def streaming_metadata(stream):
+    with upload_buffer(stream) as data:
+        return tuple(parse_torrent(data))
+
+
+def measure(fn, stream, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(stream)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(stream)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", default="1000,5000,20000,50000",
+                        help="comma-separated file counts of the generated torrents")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'files':>7} {'size':>9} | {'streaming':>10} {'peak':>11} | {'full decode':>11} {'peak':>11}")
+    for file_count in (int(n) for n in args.files.split(",")):
+        data = make_torrent(file_count)
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as stream:
+            stream.write(data)
+            stream.seek(0)
+            streamed, streamed_time, streamed_peak = measure(streaming_metadata, stream, args.repeat)
+            decoded, decoded_time, decoded_peak = measure(full_decode_metadata, stream, args.repeat)
+        assert streamed == decoded, (streamed, decoded)
+        print(f"{file_count:>7} {len(data) / 2**20:>7.1f}MB | {streamed_time * 1000:>8.1f}ms {streamed_peak / 1024:>8.1f}KiB"
+              f" | {decoded_time * 1000:>9.1f}ms {decoded_peak / 1024:>8.1f}KiB")
+
+
+if __name__ == "__main__":
+    main()
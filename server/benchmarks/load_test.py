@@ -0,0 +1,258 @@
+# server/benchmarks/load_test.py
+# Load test of the whole server: starts the fake qBittorrent
+# (tests/fake_qbittorrent.py) and create_app() under gunicorn, drives /login,
+# /add_magnet_link and /add_torrent_file at a fixed concurrency, and reports
+# throughput, p50/p99 latency and the RSS of every gunicorn worker.
+#
+#   python benchmarks/load_test.py --mode sync --workers 4 --concurrency 32 --duration 10
+#   python benchmarks/load_test.py --mode asgi --latency 0.05 --session-ttl 2 --failure-rate 0.01
+#
+# Modes: sync (gunicorn sync workers), gthread (--threads per worker) and asgi
+# (asgi.py under uvicorn workers). Extra server settings are passed with
+# --env NAME=VALUE, e.g. --env QB_POOL_MAXSIZE=32. Per-worker RSS is read from
+# /proc, so it is only reported on Linux.
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_QBITTORRENT = os.path.join(SERVER_DIR, 'tests', 'fake_qbittorrent.py')
+
+MODES = {
+    'sync': (['--worker-class', 'sync', '--threads', '1'], 'app:create_app()'),  # gunicorn.conf.py sets threads
+    'gthread': (['--worker-class', 'gthread'], 'app:create_app()'),
+    'asgi': (['--worker-class', 'uvicorn.workers.UvicornWorker'], 'asgi:create_asgi_app()'),
+}
+SCENARIOS = ('login', 'magnet', 'file')
+USER, PASSWORD = 'bench', 'bench-password'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_qbittorrent(latency, session_ttl, failure_rate):
+    args = [sys.executable, FAKE_QBITTORRENT, '--latency', str(latency), '--failure-rate', str(failure_rate)]
+    if session_ttl is not None:
+        args += ['--session-ttl', str(session_ttl)]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def start_server(mode, workers, threads, qb_url, extra_env, timeout=30.0):
+    worker_args, app_spec = MODES[mode]
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'QB_URL': qb_url,
+        'QB_USER': 'admin',
+        'QB_PASS': 'adminadmin',
+        'APP_USERS': f'{USER}:{PASSWORD}',
+        'FLASK_SECRET_KEY': uuid.uuid4().hex,
+        'METRICS_DIR': tempfile.mkdtemp(prefix='load-test-metrics-'),
+    })
+    env.update(extra_env)
+    args = ['gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--log-level', 'warning']
+    args += worker_args
+    if mode == 'gthread':
+        args += ['--threads', str(threads)]
+    process = subprocess.Popen(args + [app_spec], cwd=SERVER_DIR, env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            requests.get(base_url + '/status', timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start in time")
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def worker_rss(master_pid):
+    # {pid: RSS in KiB} of the gunicorn workers (children of the master)
+    rss = {}
+    if not os.path.isdir('/proc'):
+        return rss
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        if int(status.get('PPid', '0').strip()) == master_pid and 'VmRSS' in status:
+            rss[int(entry)] = int(status['VmRSS'].split()[0])
+    return rss
+
+
+def make_torrent(name):
+    name = name.encode('utf-8')
+    info = (b"d6:lengthi1048576e4:name%d:%s12:piece lengthi262144e6:pieces80:" % (len(name), name)
+            + os.urandom(80) + b"e")
+    return b"d8:announce31:http://tracker.example/announce4:info" + info + b"e"
+
+
+def send(session, base_url, scenario):
+    if scenario == 'login':
+        return session.post(base_url + '/login', json={'username': USER, 'password': PASSWORD}, timeout=60)
+    if scenario == 'magnet':
+        magnet_link = f"magnet:?xt=urn:btih:{uuid.uuid4().hex}{uuid.uuid4().hex[:8]}&dn=load-test"
+        return session.post(base_url + '/add_magnet_link', json={'magnet_link': magnet_link}, timeout=60)
+    name = uuid.uuid4().hex
+    files = {'file': (f'{name}.torrent', make_torrent(name), 'application/x-bittorrent')}
+    return session.post(base_url + '/add_torrent_file', files=files, timeout=60)
+
+
+def run_scenario(base_url, scenario, concurrency, duration):
+    # Every client thread logs in once, then sends requests back to back until
+    # the duration is up. Returns the latencies of successful requests and the
+    # count of failed ones by status.
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency + 1)
+
+    def client():
+        session = requests.Session()
+        session.post(base_url + '/login', json={'username': USER, 'password': PASSWORD}, timeout=60)
+        start_barrier.wait()
+        deadline = time.monotonic() + duration
+        own_latencies = []
+        own_errors = {}
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                status = send(session, base_url, scenario).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            if status in (200, 202):
+                own_latencies.append(elapsed)
+            else:
+                own_errors[status] = own_errors.get(status, 0) + 1
+        with lock:
+            latencies.extend(own_latencies)
+            for status, count in own_errors.items():
+                errors[status] = errors.get(status, 0) + count
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.monotonic()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.monotonic() - started
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(mode='sync', workers=2, threads=8, concurrency=16, duration=5.0, scenarios=SCENARIOS,
+        latency=0.0, session_ttl=None, failure_rate=0.0, extra_env=None):
+    fake, qb_url = start_fake_qbittorrent(latency, session_ttl, failure_rate)
+    try:
+        server, base_url = start_server(mode, workers, threads, qb_url, extra_env or {})
+        try:
+            rss_before = worker_rss(server.pid)
+            results = []
+            for scenario in scenarios:
+                latencies, errors, elapsed = run_scenario(base_url, scenario, concurrency, duration)
+                completed = len(latencies) + sum(errors.values())
+                results.append({
+                    'scenario': scenario,
+                    'requests': completed,
+                    'errors': {str(status): count for status, count in errors.items()},
+                    'throughput': completed / elapsed if elapsed else 0.0,
+                    'p50_ms': percentile(latencies, 0.50) * 1000,
+                    'p99_ms': percentile(latencies, 0.99) * 1000,
+                    'max_ms': max(latencies, default=float('nan')) * 1000,
+                })
+            rss_after = worker_rss(server.pid)
+        finally:
+            stop(server)
+    finally:
+        stop(fake)
+    return {
+        'mode': mode,
+        'workers': workers,
+        'concurrency': concurrency,
+        'results': results,
+        'worker_rss_kib': {str(pid): {'before': rss_before.get(pid), 'after': kib} for pid, kib in rss_after.items()},
+    }
+
+
+def print_report(report):
+    print(f"mode={report['mode']} workers={report['workers']} concurrency={report['concurrency']}")
+    print(f"{'scenario':>9} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for result in report['results']:
+        print(f"{result['scenario']:>9} {result['requests']:>9} {sum(result['errors'].values()):>7}"
+              f" {result['throughput']:>9.1f} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['max_ms']:>8.1f}")
+        if result['errors']:
+            print(f"{'':>9} errors by status: {result['errors']}")
+    for pid, rss in sorted(report['worker_rss_kib'].items()):
+        before = f"{rss['before'] / 1024:.1f}" if rss['before'] else '?'
+        print(f"worker {pid}: RSS {before} -> {rss['after'] / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the server against a fake qBittorrent")
+    parser.add_argument('--mode', choices=sorted(MODES), default='sync')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help="threads per worker in gthread mode")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent client connections")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per scenario")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the fake qBittorrent adds to every response")
+    parser.add_argument('--session-ttl', type=float, default=None, help="idle seconds before the fake expires a session")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of adds the fake fails with a 500")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help="extra server environment")
+    parser.add_argument('--json', metavar='PATH', help="also write the report as JSON")
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    report = run(
+        mode=args.mode, workers=args.workers, threads=args.threads, concurrency=args.concurrency,
+        duration=args.duration, scenarios=scenarios, latency=args.latency, session_ttl=args.session_ttl,
+        failure_rate=args.failure_rate, extra_env=dict(item.split('=', 1) for item in args.env),
+    )
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# server/gunicorn.conf.py
+# Loaded automatically by gunicorn when it is started from this directory, as
+# the Dockerfile does. Each worker loads its users and logs in to qBittorrent
+# before it accepts requests, so its first add is served at steady-state
+# latency. With METRICS_DIR set, the workers' metric files are reset here too.
+import os
+import threading
+
+# Threaded workers: a slow add or an open /events stream holds one thread
+# rather than a whole worker process. Command-line options such as
+# --worker-class and --threads take precedence.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def post_worker_init(worker):
+    # Runs in the worker once the app is loaded. post_fork would be too early:
+    # without preload_app the app is created after it, and create_app() drops
+    # any client built before. The wait is bounded by QB_WARMUP_TIMEOUT; a
+    # worker that could not log in still starts and /ready reports 503.
+    import app
+
+    app.warm_up_users()
+    flask_app = getattr(worker.wsgi, 'app', worker.wsgi)  # asgi.py wraps the Flask app
+    if not getattr(flask_app, 'config', {}).get('QB_WARMUP'):
+        return
+    if type(worker).__module__.startswith('uvicorn'):
+        return  # asgi.py warms the async client on lifespan startup
+
+    settings = app.warm_up_settings()
+    thread = threading.Thread(target=app.warm_up_torrent_db_client, kwargs=settings, name='qbittorrent-warm-up', daemon=True)
+    thread.start()
+    thread.join(settings['timeout'])
+
+
+def on_starting(server):
+    # Runs in the master before any worker starts: drops the metric files of
+    # the previous run, whose pids new workers may reuse
+    import metrics
+
+    metrics.REGISTRY.clear_directory()
+
+
+def child_exit(server, worker):
+    # Runs in the master once a worker has exited
+    import metrics
+
+    metrics.REGISTRY.mark_process_dead(worker.pid)
@@ -0,0 +1,349 @@
+# server/metrics.py
+# Minimal Prometheus-style metrics: counters, gauges and histograms rendered in
+# the text exposition format by GET /metrics.
+#
+# Without METRICS_DIR every process keeps its values in memory, which is right
+# for a single worker. With METRICS_DIR set (a directory shared by all gunicorn
+# workers, emptied when the server starts) each process writes its values to
+# its own mmap'ed file there, and rendering sums the files of all processes, so
+# any worker answering /metrics reports the totals. Counters and histograms of
+# workers that exited are kept; gauges only count live processes.
+# gunicorn.conf.py empties the directory when the server starts and retires a
+# worker's file when it exits, so a new worker that gets a reused pid starts
+# from zero.
+import bisect
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+_HEADER = struct.Struct('<Q')  # Bytes used in the file
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _MemoryStore():
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def close(self):
+        pass
+
+
+class _MmapStore():
+    # One process' values in a file other processes can read. Layout: the used
+    # size, then records of [u32 key length][utf-8 key][padding to 8][f64 value].
+    # Values are updated in place, so an update is a dict lookup and a pack_into.
+    def __init__(self, path, initial_size=64 * 1024):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            size = initial_size
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._positions = {}
+        self._used = _HEADER.unpack_from(self._map, 0)[0] or _HEADER.size
+        # A reused pid whose file was not retired picks up where the earlier
+        # process left off
+        for key, _, position in _parse_records(self._map, self._used):
+            self._positions[key] = position
+        _HEADER.pack_into(self._map, 0, self._used)
+
+    def add(self, key, amount):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            _VALUE.pack_into(self._map, position, _VALUE.unpack_from(self._map, position)[0] + amount)
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        position = _align(self._used + _KEY_LENGTH.size + len(encoded))
+        end = position + _VALUE.size
+        if end > len(self._map):
+            size = len(self._map)
+            while size < end:
+                size *= 2
+            self._map.close()
+            os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+        _KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _KEY_LENGTH.size:self._used + _KEY_LENGTH.size + len(encoded)] = encoded
+        _VALUE.pack_into(self._map, position, 0.0)
+        # Readers only look at records below the used size, so it moves last
+        self._used = end
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def snapshot(self):
+        with self._lock:
+            return {key: value for key, value, _ in _parse_records(self._map, self._used)}
+
+    def close(self):
+        with self._lock:
+            self._map.close()
+            os.close(self._fd)
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _parse_records(data, used):
+    offset = _HEADER.size
+    while offset + _KEY_LENGTH.size <= used:
+        length = _KEY_LENGTH.unpack_from(data, offset)[0]
+        key_start = offset + _KEY_LENGTH.size
+        position = _align(key_start + length)
+        if position + _VALUE.size > used:
+            break
+        key = bytes(data[key_start:key_start + length]).decode('utf-8')
+        yield key, _VALUE.unpack_from(data, position)[0], position
+        offset = position + _VALUE.size
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        return {}
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    return {key: value for key, value, _ in _parse_records(data, used)}
+
+
+def pid_alive(pid):
+    # Whether a process with this pid exists; shared with rate_limit.py, which
+    # frees the in-flight slots of dead workers
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Metric():
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._keys = {}
+
+    def _key(self, labelvalues, extra=None):
+        # Keys are cached, so the JSON encoding happens once per label set
+        cache_key = (labelvalues, extra)
+        key = self._keys.get(cache_key)
+        if key is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+            key = json.dumps([self.name, [str(value) for value in labelvalues], extra])
+            self._keys[cache_key] = key
+        return key
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1.0):
+        self.registry.store.add(self._key(labelvalues), amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, *labelvalues, amount=1.0):
+        self.registry.store.add(self._key(labelvalues), amount)
+
+    def dec(self, *labelvalues, amount=1.0):
+        self.registry.store.add(self._key(labelvalues), -amount)
+
+    @contextmanager
+    def track_inprogress(self, *labelvalues):
+        self.inc(*labelvalues)
+        try:
+            yield
+        finally:
+            self.dec(*labelvalues)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        # Buckets are stored non-cumulatively (one add per observation) and
+        # accumulated when rendering
+        store = self.registry.store
+        index = bisect.bisect_left(self.buckets, value)
+        bound = self.buckets[index] if index < len(self.buckets) else math.inf
+        store.add(self._key(labelvalues, bound), 1.0)
+        store.add(self._key(labelvalues, 'sum'), value)
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+
+class Registry():
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._metrics = {}
+        self._store = None
+        self._store_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        # Opened lazily per process, so workers forked from a preloaded app each
+        # get their own file
+        store = self._store
+        if store is None or self._store_pid != os.getpid():
+            with self._lock:
+                if self._store is None or self._store_pid != os.getpid():
+                    if self.directory:
+                        os.makedirs(self.directory, exist_ok=True)
+                        path = os.path.join(self.directory, f'metrics-{os.getpid()}.db')
+                        self._store = _MmapStore(path)
+                    else:
+                        self._store = _MemoryStore()
+                    self._store_pid = os.getpid()
+                store = self._store
+        return store
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def clear_directory(self):
+        # Removes the files of earlier runs; call before any worker starts
+        if not self.directory:
+            return
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.db')):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def mark_process_dead(self, pid):
+        # Retires the file of a process that exited: its counters and
+        # histograms still count, its gauges no longer do, and a new process
+        # with the same pid starts a file of its own
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f'metrics-{pid}.db')
+        try:
+            os.replace(path, os.path.join(self.directory, f'metrics-{pid}-dead-{time.time_ns()}.db'))
+        except FileNotFoundError:
+            pass
+
+    def collect(self):
+        # Returns {key: value} summed over every process sharing the directory
+        if not self.directory:
+            return self.store.snapshot()
+        gauges = {name for name, metric in self._metrics.items() if metric.kind == 'gauge'}
+        own_pid = os.getpid()
+        totals = {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.db')):
+            pid, _, retired = os.path.basename(path)[len('metrics-'):-len('.db')].partition('-dead-')
+            try:
+                pid = int(pid)
+                values = self.store.snapshot() if pid == own_pid and not retired else _read_file(path)
+            except (ValueError, OSError):
+                continue
+            alive = not retired and (pid == own_pid or pid_alive(pid))
+            for key, value in values.items():
+                if not alive and json.loads(key)[0] in gauges:
+                    continue
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def render(self):
+        samples = {}
+        for key, value in self.collect().items():
+            name, labelvalues, extra = json.loads(key)
+            samples.setdefault(name, {}).setdefault(tuple(labelvalues), {})[extra] = value
+
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labelvalues, values in sorted(samples.get(name, {}).items()):
+                labels = list(zip(metric.labelnames, labelvalues))
+                if metric.kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(values[None])}")
+                    continue
+                cumulative = 0.0
+                for bound in metric.buckets + (math.inf,):
+                    cumulative += values.get(bound, 0.0)
+                    le = '+Inf' if bound == math.inf else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + [('le', le)])} {_format_value(cumulative)}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(values.get('sum', 0.0))}")
+                lines.append(f"{name}_count{_format_labels(labels)} {_format_value(cumulative)}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# Process-wide registry used by the app and TorrentDB
+REGISTRY = Registry(os.environ.get('METRICS_DIR') or None)
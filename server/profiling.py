@@ -0,0 +1,186 @@
+# server/profiling.py
+# Opt-in capture of slow requests. While a request runs, a timing breakdown
+# per phase (auth, parse, upstream, response) is kept, and one background
+# thread samples the stacks of all threads serving requests. A request that
+# took longer than slow_seconds is written to disk with its stack samples; a
+# request picked by sample_rate, or sent by an admin with the profiling token,
+# additionally runs under cProfile. Captures go to a ring buffer of at most
+# max_files requests in one directory, which all workers may share:
+#   <time_ns>-<pid>-<route>.json   timings, phases and collapsed stacks
+#   <time_ns>-<pid>-<route>.prof   cProfile stats, if profiled (pstats/snakeviz)
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+PROFILES_CAPTURED = REGISTRY.counter(
+    'request_profiles_captured_total', 'Requests written to PROFILE_DIR, by what triggered the capture', ['trigger'],
+)
+
+
+def _collapse(frame):
+    # 'outer (file.py:12);inner (other.py:34)', the format flame graph tools read
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfile():
+    def __init__(self, trigger=None, thread_id=None):
+        self.trigger = trigger  # 'header' or 'sampled'; 'slow' is decided at the end
+        self.thread_id = thread_id  # None: not stack-sampled, e.g. async views
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.phases = {}
+        self.samples = Counter()
+        self.cprofile = None
+        self._response_started = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def response_started(self):
+        # Called once the view returned; the rest of the request is 'response'
+        self._response_started = time.perf_counter()
+
+
+class Profiler():
+    # slow_seconds or sample_rate of 0 turn that trigger off; without a token
+    # the X-Profile header is ignored
+    def __init__(self, directory, slow_seconds=0.0, sample_rate=0.0, token=None, max_files=100, interval=0.01):
+        self.directory = directory
+        self.slow_seconds = slow_seconds
+        self.sample_rate = sample_rate
+        self.token = token
+        self.max_files = max_files
+        self.interval = interval
+        self._active = {}  # thread ID -> RequestProfile
+        self._lock = threading.Lock()
+        self._sampler_pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and bool(self.slow_seconds or self.sample_rate or self.token)
+
+    def start(self, forced=False, threaded=True):
+        # Returns the RequestProfile to record the request in, or None if it
+        # can't be captured
+        trigger = 'header' if forced else 'sampled' if self.sample_rate and random.random() < self.sample_rate else None
+        if trigger is None and not self.slow_seconds:
+            return None
+        profile = RequestProfile(trigger, threading.get_ident() if threaded else None)
+        if threaded:
+            self._ensure_sampler()
+            with self._lock:
+                self._active[profile.thread_id] = profile
+            if trigger:
+                # cProfile only sees the calling thread, so async views, whose
+                # event loop interleaves other requests, are not profiled
+                profile.cprofile = cProfile.Profile()
+                try:
+                    profile.cprofile.enable()
+                except ValueError:
+                    profile.cprofile = None  # Python 3.12+: another thread is being profiled
+        return profile
+
+    def finish(self, profile, route, method, status, user=None):
+        # Writes the capture if the request was triggered or slow; returns its path
+        duration = time.perf_counter() - profile.started
+        self.discard(profile)
+        trigger = profile.trigger
+        if trigger is None:
+            if duration < self.slow_seconds:
+                return None
+            trigger = 'slow'
+        phases = dict(profile.phases)
+        if profile._response_started is not None:
+            phases['response'] = time.perf_counter() - profile._response_started
+        phases['other'] = max(0.0, duration - sum(phases.values()))
+        capture = {
+            'route': route, 'method': method, 'status': status, 'user': user, 'trigger': trigger,
+            'started_at': profile.started_at, 'duration': duration, 'pid': os.getpid(),
+            'phases': phases, 'stack_samples': dict(profile.samples.most_common()),
+            'sample_interval': self.interval, 'cprofile': None,
+        }
+        name = f"{time.time_ns()}-{os.getpid()}-{re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'}"
+        os.makedirs(self.directory, exist_ok=True)
+        if profile.cprofile is not None:
+            capture['cprofile'] = name + '.prof'
+            profile.cprofile.dump_stats(os.path.join(self.directory, name + '.prof'))
+        path = os.path.join(self.directory, name + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(capture, f, indent=1)
+        os.replace(path + '.tmp', path)
+        PROFILES_CAPTURED.inc(trigger)
+        self._prune()
+        return path
+
+    def discard(self, profile):
+        # Stops recording the request, e.g. a streamed response that would
+        # always look slow
+        if profile.cprofile is not None:
+            profile.cprofile.disable()
+        if profile.thread_id is not None:
+            with self._lock:
+                self._active.pop(profile.thread_id, None)
+
+    def captures(self):
+        # Capture names, oldest first
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len('.json')] for name in names if name.endswith('.json'))
+
+    def _prune(self):
+        # Workers may prune at the same time; whoever comes second finds the
+        # files already gone
+        for name in self.captures()[:-self.max_files or None]:
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def stop(self):
+        self._sampler_pid = None
+
+    def _ensure_sampler(self):
+        # One sampler thread per process, restarted in forked workers
+        if self._sampler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sampler_pid != os.getpid():
+                self._sampler_pid = os.getpid()
+                threading.Thread(target=self._sample_loop, name='request-profiler', daemon=True).start()
+
+    def _sample_loop(self):
+        pid = os.getpid()
+        while self._sampler_pid == pid:
+            time.sleep(self.interval)
+            # Under the lock, so finish() never sees samples change
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, profile in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.samples[_collapse(frame)] += 1
+                del frames
@@ -0,0 +1,136 @@
+# server/rate_limit.py
+# Admission control for the add routes: a token bucket per user, one for the
+# whole server, and a cap on adds in flight to qBittorrent. Requests over a
+# limit are turned away with a retry delay instead of queueing up in front of
+# the workers. State is kept in SQLite: with the default ':memory:' database
+# each process limits on its own; with a file path every gunicorn worker
+# shares the same buckets and slots.
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import pid_alive
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class RateLimiter():
+    # Rates are tokens per second, one token per request; bursts default to
+    # one second's worth. A rate or max_inflight of 0 turns that limit off.
+    # A slot whose holder died is reclaimed once its process is gone, or at
+    # the latest after lease seconds.
+    def __init__(self, path=':memory:', user_rate=0.0, user_burst=None, global_rate=0.0, global_burst=None,
+                 max_inflight=0, lease=300.0):
+        self.path = path
+        self.user_rate = user_rate
+        self.user_burst = user_burst or max(1.0, user_rate)
+        self.global_rate = global_rate
+        self.global_burst = global_burst or max(1.0, global_rate)
+        self.max_inflight = max_inflight
+        self.lease = lease
+        self._lock = threading.Lock()  # One connection per process, shared by all threads
+        self._conn = None
+        self._conn_pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.user_rate or self.global_rate or self.max_inflight)
+
+    def _connection(self):
+        # Callers hold _lock. Opened lazily per process, so workers forked from
+        # a preloaded app don't share a connection.
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            if self.path != ':memory:':
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.execute('PRAGMA busy_timeout=5000')
+            self._conn.executescript(_SCHEMA)
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _take(self, conn, key, rate, burst, now):
+        # Returns (tokens left after taking one, seconds until one is available)
+        row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+        if tokens >= 1.0:
+            return tokens - 1.0, 0.0
+        return tokens, (1.0 - tokens) / rate
+
+    def check(self, user):
+        # Takes a token from the user's and the global bucket. Returns None if
+        # the request may go ahead, otherwise (limit, seconds to wait); nothing
+        # is taken from either bucket then.
+        buckets = []
+        if self.user_rate and user:
+            buckets.append(('user', 'user:' + user, self.user_rate, self.user_burst))
+        if self.global_rate:
+            buckets.append(('global', 'global', self.global_rate, self.global_burst))
+        if not buckets:
+            return None
+        with self._lock:
+            conn = self._connection()
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                taken = []
+                for limit, key, rate, burst in buckets:
+                    tokens, wait = self._take(conn, key, rate, burst, now)
+                    if wait:
+                        conn.execute('ROLLBACK')
+                        return limit, wait
+                    taken.append((key, tokens, now))
+                conn.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)', taken)
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        return None
+
+    def acquire(self):
+        # Returns a slot ID, or None if max_inflight adds are already in flight
+        if not self.max_inflight:
+            return 0
+        with self._lock:
+            conn = self._connection()
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM slots WHERE expires_at <= ?', (now,))
+                rows = conn.execute('SELECT id, pid FROM slots').fetchall()
+                if len(rows) >= self.max_inflight:
+                    dead = [(slot_id,) for slot_id, pid in rows if pid != os.getpid() and not pid_alive(pid)]
+                    conn.executemany('DELETE FROM slots WHERE id = ?', dead)
+                    if len(rows) - len(dead) >= self.max_inflight:
+                        conn.execute('COMMIT')
+                        return None
+                slot_id = conn.execute('INSERT INTO slots (pid, expires_at) VALUES (?, ?)',
+                                       (os.getpid(), now + self.lease)).lastrowid
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+        return slot_id
+
+    def release(self, slot_id):
+        if not slot_id:
+            return
+        with self._lock:
+            self._connection().execute('DELETE FROM slots WHERE id = ?', (slot_id,))
+
+    def inflight(self):
+        with self._lock:
+            return self._connection().execute('SELECT COUNT(*) FROM slots').fetchone()[0]
@@ -0,0 +1,203 @@
+# server/save_policy.py
+# Where each category's torrents are saved and how much it may store. A
+# category is the target of an add: a username or 'common'. Rules are matched
+# in order against the category (fnmatch patterns), the first match decides:
+#   [{"match": "common", "save_path": "/srv/shared", "quota": "2T"},
+#    {"match": "guest-*", "route_to": "common"},
+#    {"match": "*", "save_path": "/data/{category}", "quota": "500G"}]
+# route_to sends the adds of matching categories to another category. Without
+# a matching rule, torrents go to DEFAULT_SAVE_PATH and have no quota.
+#
+# Quota checks never touch the filesystem. A category's usage is the larger
+# of what qBittorrent reports for its torrents (kept current by the
+# sync/maindata poller) and what the last background scan of its save path
+# found, plus adds accepted since that qBittorrent has not reported yet.
+import fnmatch
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAVE_PATH = '/home/fcstorrent/downloads/qbittorrent/{category}'
+
+ADDS_OVER_QUOTA = REGISTRY.counter('adds_rejected_over_quota_total', 'Adds rejected because the category was over its quota')
+SAVE_PATH_SCAN_SECONDS = REGISTRY.histogram('save_path_scan_duration_seconds', 'Duration of one scan of all save paths with a quota')
+
+Placement = namedtuple('Placement', ['category', 'save_path', 'quota'])
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
+
+
+def parse_size(value):
+    # 1073741824, '1G', '1.5T' or '1GiB' -> bytes; None stays None
+    if value is None or isinstance(value, int):
+        return value
+    text = str(value).strip().upper().removesuffix('IB').removesuffix('B')
+    unit = text[-1:] if text[-1:] in _UNITS else ''
+    try:
+        return int(float(text[:len(text) - len(unit)]) * _UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid size '{value}'") from None
+
+
+def load_rules(value):
+    # SAVE_POLICY: the rules as JSON, or the path of a JSON file holding them
+    if not value.strip():
+        return []
+    if not value.lstrip().startswith('['):
+        with open(value, encoding='utf-8') as f:
+            value = f.read()
+    rules = json.loads(value)
+    if not isinstance(rules, list) or not all(isinstance(rule, dict) and 'match' in rule for rule in rules):
+        raise ValueError("SAVE_POLICY must be a list of rules, each with a 'match' pattern")
+    return rules
+
+
+def disk_usage(path):
+    # Bytes allocated to the files under path, which need not exist
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return total
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, placement, used):
+        super().__init__(f"Quota of {placement.category} exceeded: {used} of {placement.quota} bytes used")
+        self.placement = placement
+        self.used = used
+
+
+class SavePolicy():
+    # reported_usage(category) returns the bytes qBittorrent reports for the
+    # category's torrents and is_known(info_hash) whether it reports the
+    # torrent at all (see TorrentStateCache); both must be cheap. Placements
+    # are resolved once per category. scan_interval 0 turns the background
+    # scan off; pending adds are forgotten once reported or after pending_ttl.
+    def __init__(self, rules=(), reported_usage=None, is_known=None, scan_interval=300.0, pending_ttl=600.0):
+        self.rules = [dict(rule, quota=parse_size(rule.get('quota'))) for rule in rules]
+        self.reported_usage = reported_usage or (lambda category: 0)
+        self.is_known = is_known or (lambda info_hash: False)
+        self.scan_interval = scan_interval
+        self.pending_ttl = pending_ttl
+        self._placements = {}
+        self._scanned = {}  # save path -> bytes found by the last scan
+        self._pending = {}  # info-hash -> (category, size, expires_at)
+        self._lock = threading.Lock()
+        self._scanner_pid = None
+
+    @property
+    def has_quotas(self):
+        return any(rule.get('quota') for rule in self.rules)
+
+    def resolve(self, category):
+        placement = self._placements.get(category)
+        if placement is None:
+            placement = self._resolve(category, set())
+            self._placements[category] = placement
+        return placement
+
+    def _resolve(self, category, seen):
+        for rule in self.rules:
+            if not fnmatch.fnmatchcase(category, rule['match']):
+                continue
+            route_to = rule.get('route_to')
+            if route_to and route_to != category:
+                if route_to in seen:
+                    raise ValueError(f"SAVE_POLICY routes {category} in a loop")
+                return self._resolve(route_to, seen | {category})
+            template = rule.get('save_path') or DEFAULT_SAVE_PATH
+            return Placement(category, template.format(category=category), rule.get('quota'))
+        return Placement(category, DEFAULT_SAVE_PATH.format(category=category), None)
+
+    def save_path(self, category):
+        # For TorrentDB's save_paths
+        return self.resolve(category).save_path
+
+    def usage(self, category):
+        placement = self.resolve(category)
+        now = time.monotonic()
+        # If qBittorrent's view is not available, the last scan and the
+        # pending adds are all there is to go on
+        try:
+            reported = self.reported_usage(category)
+            is_known = self.is_known
+        except Exception:
+            logger.warning("Usage of category %s as reported by qBittorrent is unavailable", category, exc_info=True)
+            reported, is_known = 0, lambda info_hash: False
+        with self._lock:
+            for info_hash, (_, _, expires_at) in list(self._pending.items()):
+                if expires_at < now or is_known(info_hash):
+                    del self._pending[info_hash]
+            pending = sum(size for pending_category, size, _ in self._pending.values() if pending_category == category)
+            scanned = self._scanned.get(placement.save_path, 0)
+        return max(reported, scanned) + pending
+
+    def admit(self, category, size=0):
+        # Returns the Placement for an add of size bytes (0 if not known, as
+        # for most magnets) to category, or raises QuotaExceeded
+        placement = self.resolve(category)
+        if placement.quota is None:
+            return placement
+        self._ensure_scanner()
+        used = self.usage(placement.category)
+        if used >= placement.quota or used + size > placement.quota:
+            ADDS_OVER_QUOTA.inc()
+            raise QuotaExceeded(placement, used)
+        return placement
+
+    def record_add(self, category, info_hash, size):
+        # Counts an accepted add until qBittorrent reports the torrent
+        placement = self.resolve(category)
+        if info_hash and size and placement.quota is not None:
+            with self._lock:
+                self._pending[info_hash] = (placement.category, size, time.monotonic() + self.pending_ttl)
+
+    def scan(self):
+        # Measures the save paths of the categories with a quota seen so far
+        started = time.perf_counter()
+        paths = {placement.save_path for placement in list(self._placements.values()) if placement.quota is not None}
+        scanned = {path: disk_usage(path) for path in paths}
+        with self._lock:
+            self._scanned.update(scanned)
+        SAVE_PATH_SCAN_SECONDS.observe(time.perf_counter() - started)
+        return scanned
+
+    def stop(self):
+        self._scanner_pid = None
+
+    def _ensure_scanner(self):
+        # One scanner thread per process, restarted in forked workers
+        if not self.scan_interval or self._scanner_pid == os.getpid():
+            return
+        with self._lock:
+            if self._scanner_pid != os.getpid():
+                self._scanner_pid = os.getpid()
+                threading.Thread(target=self._scan_loop, name='save-path-scan', daemon=True).start()
+
+    def _scan_loop(self):
+        pid = os.getpid()
+        while self._scanner_pid == pid:
+            try:
+                self.scan()
+            except Exception:
+                logger.warning("Scanning the save paths failed", exc_info=True)
+            time.sleep(self.scan_interval)
@@ -0,0 +1,335 @@
+# server/submission_queue.py
+# Queue for add requests when ASYNC_SUBMISSIONS is on: the routes enqueue a job
+# and answer 202 straight away, and dispatcher threads drain the queue into
+# TorrentDB. Jobs are kept in SQLite. With the default ':memory:' database they
+# live in this process only; with a file path queued adds survive restarts, and
+# several gunicorn workers can share (and drain) the same queue.
+#
+# With ADD_OUTBOX on, the queue is also the outbox for adds that could not
+# reach qBittorrent. A submission is acknowledged once its transaction is
+# synced to disk. Submissions arriving while another one is being synced are
+# group-committed in the next transaction, so a burst of adds costs one fsync
+# rather than one each.
+import io
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SUBMISSION_COMMIT_SIZE = REGISTRY.histogram(
+    'submission_queue_commit_jobs', 'Submissions written to the queue per transaction',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+SUBMISSION_JOBS = REGISTRY.counter(
+    'submission_queue_jobs_total',
+    'Queued adds handled by the dispatchers: added, already present, retried or failed', ['result'],
+)
+
+QUEUED, RUNNING, ADDED, FAILED = 'queued', 'running', 'added', 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    target_user TEXT NOT NULL,
+    submitted_by TEXT,
+    info_hash TEXT,
+    magnet_link TEXT,
+    filename TEXT,
+    torrent BLOB,
+    status TEXT NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS jobs_info_hash ON jobs (info_hash, target_user, status);
+CREATE TABLE IF NOT EXISTS job_submitters (
+    job_id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    PRIMARY KEY (job_id, user)
+);
+"""
+
+# Columns reported by get(); the torrent file itself is never handed back
+_JOB_FIELDS = ('id', 'kind', 'target_user', 'submitted_by', 'info_hash', 'magnet_link', 'filename',
+               'status', 'error', 'attempts', 'created_at', 'updated_at')
+
+
+class _Submission():
+    # A job waiting for the group commit that writes it
+    __slots__ = ('values', 'job', 'error')
+
+    def __init__(self, values):
+        self.values = values
+        self.job = None
+        self.error = None
+
+
+class SubmissionQueue():
+    def __init__(self, db_factory, path=':memory:', workers=2, batch_size=50, max_attempts=5,
+                 retry_backoff=2.0, max_retry_delay=300.0, lease=300.0, retention=86400.0, poll_interval=1.0,
+                 on_added=None, is_present=None, is_transient=None):
+        # db_factory returns the TorrentDB to submit to; it is only called from
+        # the dispatcher threads. on_added receives the info-hashes of every
+        # batch that qBittorrent accepted. Jobs whose info-hash is_present
+        # reports as already in qBittorrent are finished without resubmitting
+        # them, and failures is_transient reports as an outage are retried
+        # until qBittorrent is back rather than max_attempts times.
+        self.db_factory = db_factory
+        self.path = path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_delay = max_retry_delay
+        self.lease = lease  # A claimed job is handed out again if its dispatcher died
+        self.retention = retention  # Seconds finished jobs stay queryable
+        self.poll_interval = poll_interval
+        self.on_added = on_added
+        self.is_present = is_present
+        self.is_transient = is_transient
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=FULL')  # Every commit is synced to disk
+            self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()  # One connection, shared by all threads
+        self._waiting_lock = threading.Lock()
+        self._waiting = []  # Submissions for the next group commit
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_purge = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'submission-dispatcher-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+        with self._lock:
+            self._conn.close()
+
+    def submit_magnet(self, magnet_link, target_user, info_hash=None, submitted_by=None):
+        return self._submit('magnet', target_user, submitted_by, info_hash, magnet_link=magnet_link)
+
+    def submit_file(self, filename, data, target_user, info_hash=None, submitted_by=None):
+        return self._submit('file', target_user, submitted_by, info_hash, filename=filename, torrent=bytes(data))
+
+    def _submit(self, kind, target_user, submitted_by, info_hash, magnet_link=None, filename=None, torrent=None):
+        # Returns the job dict once the job is durable. A torrent that is
+        # already queued (or in flight) for the same user is coalesced into the
+        # existing job.
+        submission = _Submission((kind, target_user, submitted_by, info_hash, magnet_link, filename, torrent))
+        with self._waiting_lock:
+            self._waiting.append(submission)
+        with self._lock:
+            # Whoever gets the connection first commits everything waiting
+            if submission.job is None and submission.error is None:
+                self._commit_waiting()
+        if submission.error is not None:
+            raise submission.error
+        with self._wakeup:
+            self._wakeup.notify()
+        return submission.job
+
+    def _commit_waiting(self):
+        # Called with _lock held
+        with self._waiting_lock:
+            batch, self._waiting = self._waiting, []
+        if not batch:
+            return
+        now = time.time()
+        try:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                jobs = [self._insert(now, *submission.values) for submission in batch]
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        except Exception as e:
+            for submission in batch:
+                submission.error = e
+            return
+        SUBMISSION_COMMIT_SIZE.observe(len(batch))
+        for submission, job in zip(batch, jobs):
+            submission.job = job
+
+    def _insert(self, now, kind, target_user, submitted_by, info_hash, magnet_link, filename, torrent):
+        if info_hash:
+            row = self._conn.execute(
+                'SELECT * FROM jobs WHERE info_hash = ? AND target_user = ? AND status IN (?, ?) LIMIT 1',
+                (info_hash, target_user, QUEUED, RUNNING),
+            ).fetchone()
+            if row is not None:
+                # Whoever else submitted it may follow the job too
+                if submitted_by is not None and submitted_by != row['submitted_by']:
+                    self._conn.execute('INSERT OR IGNORE INTO job_submitters (job_id, user) VALUES (?, ?)',
+                                       (row['id'], submitted_by))
+                return self._to_job(row)
+        job_id = uuid.uuid4().hex
+        self._conn.execute(
+            'INSERT INTO jobs (id, kind, target_user, submitted_by, info_hash, magnet_link, filename, torrent,'
+            ' status, available_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, kind, target_user, submitted_by, info_hash, magnet_link, filename, torrent,
+             QUEUED, now, now, now),
+        )
+        return self._to_job(self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def get(self, job_id, submitted_by=None):
+        # With submitted_by, only returns the job if that user submitted it,
+        # first or coalesced into it
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is not None and submitted_by is not None and row['submitted_by'] != submitted_by:
+                if self._conn.execute('SELECT 1 FROM job_submitters WHERE job_id = ? AND user = ?',
+                                      (job_id, submitted_by)).fetchone() is None:
+                    row = None
+        return self._to_job(row) if row is not None else None
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)', (QUEUED, RUNNING)).fetchone()[0]
+
+    @staticmethod
+    def _to_job(row):
+        return {field: row[field] for field in _JOB_FIELDS}
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._purge_finished()
+                jobs = self._claim()
+            except sqlite3.Error:
+                logger.warning("Claiming submission jobs failed", exc_info=True)
+                jobs = []
+            if not jobs:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            self._dispatch(jobs)
+
+    def _claim(self):
+        # Takes up to batch_size due jobs of the oldest job's kind and user, so
+        # they can go to qBittorrent in one request. The IMMEDIATE transaction
+        # keeps claims atomic across processes sharing the database file.
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                first = self._conn.execute(
+                    'SELECT kind, target_user FROM jobs WHERE status IN (?, ?) AND available_at <= ?'
+                    ' ORDER BY created_at LIMIT 1', (QUEUED, RUNNING, now),
+                ).fetchone()
+                if first is None:
+                    self._conn.execute('COMMIT')
+                    return []
+                rows = self._conn.execute(
+                    'SELECT * FROM jobs WHERE status IN (?, ?) AND available_at <= ? AND kind = ? AND target_user = ?'
+                    ' ORDER BY created_at LIMIT ?',
+                    (QUEUED, RUNNING, now, first['kind'], first['target_user'], self.batch_size),
+                ).fetchall()
+                self._conn.executemany(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1, available_at = ?, updated_at = ? WHERE id = ?',
+                    [(RUNNING, now + self.lease, now, row['id']) for row in rows],
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+    def _dispatch(self, jobs):
+        # Jobs for the same torrent are coalesced into a single upstream item
+        groups = {}
+        for job in jobs:
+            groups.setdefault(job['info_hash'] or job['id'], []).append(job)
+        groups = list(groups.values())
+        if self.is_present is not None:
+            # Idempotent replay: a torrent qBittorrent already has (added by an
+            # earlier attempt whose answer was lost, or by someone else) is not
+            # sent again
+            remaining = []
+            for group in groups:
+                if group[0]['info_hash'] and self.is_present(group[0]['info_hash']):
+                    self._finish(group, ADDED, None)
+                    SUBMISSION_JOBS.inc('already_present', amount=len(group))
+                else:
+                    remaining.append(group)
+            groups = remaining
+            if not groups:
+                return
+        kind, target_user = jobs[0]['kind'], jobs[0]['target_user']
+        try:
+            db = self.db_factory()
+            if kind == 'magnet':
+                db.add_downloads_by_links([group[0]['magnet_link'] for group in groups], target_user)
+                results = [None] * len(groups)
+            else:
+                files = [(group[0]['filename'], io.BytesIO(group[0]['torrent'])) for group in groups]
+                results = db.add_downloads_by_files(files, target_user, batch_size=self.batch_size)
+        except Exception as e:
+            results = [e] * len(groups)
+
+        added_hashes = []
+        for group, result in zip(groups, results):
+            if isinstance(result, Exception):
+                self._fail(group, result)
+            else:
+                self._finish(group, ADDED, None)
+                SUBMISSION_JOBS.inc('added', amount=len(group))
+                added_hashes.extend(job['info_hash'] for job in group if job['info_hash'])
+        if added_hashes and self.on_added is not None:
+            self.on_added(added_hashes)
+
+    def _fail(self, group, error):
+        attempts = group[0]['attempts']
+        transient = self.is_transient is not None and self.is_transient(error)
+        if attempts >= self.max_attempts and not transient:
+            logger.error("Giving up on %d queued %s job(s) after %d attempts: %s", len(group), group[0]['kind'], attempts, error)
+            self._finish(group, FAILED, str(error))
+            SUBMISSION_JOBS.inc('failed', amount=len(group))
+            return
+        # Exponential backoff rides out qBittorrent restarts and outages
+        delay = min(self.retry_backoff * (2 ** min(attempts - 1, 30)), self.max_retry_delay)
+        logger.warning("Queued %s job(s) failed (attempt %d), retrying in %.1fs: %s", group[0]['kind'], attempts, delay, error)
+        self._finish(group, QUEUED, str(error), available_at=time.time() + delay)
+        SUBMISSION_JOBS.inc('retried', amount=len(group))
+
+    def _finish(self, group, status, error, available_at=None):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE jobs SET status = ?, error = ?, available_at = ?, updated_at = ? WHERE id = ?',
+                [(status, error, available_at if available_at is not None else now, now, job['id']) for job in group],
+            )
+
+    def _purge_finished(self):
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?', (ADDED, FAILED, now - self.retention))
+            self._conn.execute('DELETE FROM job_submitters WHERE job_id NOT IN (SELECT id FROM jobs)')
@@ -0,0 +1,233 @@
+"""
+A small stand-in for the qBittorrent Web API (v2) used by tests that need a
+real HTTP server, e.g. to check connection reuse and timeouts, and by the load
+test in benchmarks/load_test.py.
+
+Only the endpoints TorrentDB talks to are implemented. Requests are served
+with HTTP/1.1 keep-alive, and every accepted TCP connection is counted.
+Latency, session expiry and failures of torrents/add can be injected.
+
+Run standalone with `python tests/fake_qbittorrent.py --port 8080`; the URL
+it listens on is printed on the first line of stdout.
+"""
+import argparse
+import io
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from werkzeug.formparser import parse_form_data
+
+
+class FakeQBittorrent():
+    def __init__(self, username='admin', password='adminadmin', host='127.0.0.1', port=0,
+                 latency=0.0, session_ttl=None, failure_rate=0.0, seed=None, record=True):
+        self.username = username
+        self.password = password
+        self.connections = 0
+        self.requests = []  # (method, path) of every request served
+        self.added = []  # one dict per torrents/add call
+        self.torrents = []  # what torrents/info returns
+        self.sids = {}  # SID -> time it was last used
+        self.add_delay = 0.0  # seconds torrents/add takes to answer
+        self.login_delay = 0.0  # seconds auth/login takes to answer
+        self.latency = latency  # seconds added to every response
+        self.session_ttl = session_ttl  # SIDs idle for longer get 403, like the WebUI session timeout
+        self.failure_rate = failure_rate  # fraction of torrents/add calls answered with a 500
+        self.failures = 0
+        self.record = record  # keep requests/added; off for long load tests
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._open_connections = set()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Also drops open keep-alive connections, like a qBittorrent that went away
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            connections, self._open_connections = self._open_connections, set()
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def expire_sessions(self):
+        with self._lock:
+            self.sids.clear()
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+                    fake._open_connections.add(self.connection)
+
+            def finish(self):
+                with fake._lock:
+                    fake._open_connections.discard(self.connection)
+                super().finish()
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body=b'', headers=None):
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _authenticated(self):
+                cookies = self.headers.get('Cookie', '')
+                now = time.monotonic()
+                for cookie in cookies.split(';'):
+                    name, _, value = cookie.strip().partition('=')
+                    if name != 'SID':
+                        continue
+                    with fake._lock:
+                        used_at = fake.sids.get(value)
+                        if used_at is None:
+                            continue
+                        if fake.session_ttl is not None and now - used_at > fake.session_ttl:
+                            del fake.sids[value]
+                            continue
+                        fake.sids[value] = now
+                    return True
+                return False
+
+            def _log_request(self, method, path):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.record:
+                    with fake._lock:
+                        fake.requests.append((method, path))
+
+            def _read_form(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                environ = {
+                    'REQUEST_METHOD': 'POST',
+                    'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+                    'CONTENT_LENGTH': str(length),
+                    'wsgi.input': io.BytesIO(body),
+                }
+                _, form, files = parse_form_data(environ)
+                return form, files
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                self._log_request('GET', path)
+                if not self._authenticated():
+                    self._reply(403, 'Forbidden')
+                elif path == '/api/v2/app/preferences':
+                    self._reply(200, '{}')
+                elif path == '/api/v2/torrents/info':
+                    self._reply(200, json.dumps(fake.torrents))
+                elif path == '/api/v2/sync/maindata':
+                    # Always a full update; enough for tests of the rid handling client side
+                    torrents = {t['hash']: {k: v for k, v in t.items() if k != 'hash'} for t in fake.torrents}
+                    self._reply(200, json.dumps({'rid': len(fake.requests), 'full_update': True, 'torrents': torrents}))
+                else:
+                    self._reply(404, 'Not Found')
+
+            def do_POST(self):
+                path = urlsplit(self.path).path
+                self._log_request('POST', path)
+                if path == '/api/v2/auth/login':
+                    length = int(self.headers.get('Content-Length', 0))
+                    credentials = parse_qs(self.rfile.read(length).decode('utf-8'))
+                    if fake.login_delay:
+                        time.sleep(fake.login_delay)
+                    if (credentials.get('username') == [fake.username]
+                            and credentials.get('password') == [fake.password]):
+                        sid = uuid.uuid4().hex
+                        with fake._lock:
+                            fake.sids[sid] = time.monotonic()
+                        self._reply(200, 'Ok.', {'Set-Cookie': f'SID={sid}; HttpOnly; path=/'})
+                    else:
+                        self._reply(200, 'Fails.')
+                elif path == '/api/v2/torrents/add':
+                    form, files = self._read_form()
+                    if not self._authenticated():
+                        self._reply(403, 'Forbidden')
+                        return
+                    if fake.add_delay:
+                        time.sleep(fake.add_delay)
+                    with fake._lock:
+                        failed = fake.failure_rate and fake._random.random() < fake.failure_rate
+                        if failed:
+                            fake.failures += 1
+                        elif fake.record:
+                            fake.added.append({
+                                'urls': [url for url in form.get('urls', '').split('\n') if url],
+                                'files': [(f.filename, f.read()) for _, f in files.items(multi=True)],
+                                'category': form.get('category'),
+                                'savepath': form.get('savepath'),
+                            })
+                    if failed:
+                        self._reply(500, 'Injected failure')
+                    else:
+                        self._reply(200, 'Ok.')
+                else:
+                    self._reply(404, 'Not Found')
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake qBittorrent Web API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='adminadmin')
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--session-ttl', type=float, default=None, help="idle seconds before a SID expires")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of adds answered with a 500")
+    args = parser.parse_args()
+
+    fake = FakeQBittorrent(args.username, args.password, host=args.host, port=args.port, latency=args.latency,
+                           session_ttl=args.session_ttl, failure_rate=args.failure_rate, record=False)
+    print(fake.url, flush=True)
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
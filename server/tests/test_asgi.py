@@ -0,0 +1,225 @@
+import asyncio
+import io
+import json
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import httpx
+import pytest
+
+from asgi import create_asgi_app
+
+
+@pytest.fixture
+def asgi_app(monkeypatch):
+    """Creates the ASGI app in async mode with a mocked AsyncTorrentDB."""
+    monkeypatch.setenv('APP_USERS', 'testuser:testpass,user2:anotherpass')
+    monkeypatch.setenv('CORS_ORIGINS', '*')
+
+    with patch('app.AsyncTorrentDB', autospec=True) as MockedAsyncTorrentDB:
+        mock_db_instance = MagicMock()
+        mock_db_instance.add_download_by_link = AsyncMock(return_value="Ok.")
+        mock_db_instance.add_downloads_by_links = AsyncMock(return_value="Ok.")
+        mock_db_instance.add_download_by_file = AsyncMock(return_value="Ok.")
+        mock_db_instance.add_downloads_by_files = AsyncMock(return_value=["Ok."])
+        mock_db_instance.close = AsyncMock()
+        MockedAsyncTorrentDB.return_value = mock_db_instance
+
+        application = create_asgi_app({
+            'TESTING': True,
+            'SECRET_KEY': 'test_secret_key_for_asgi_tests',
+        })
+        application.mock_torrent_client = mock_db_instance
+        yield application
+
+
+def run_requests(asgi_app, *requests_to_send):
+    """Sends the requests in order through one cookie-keeping client and returns the responses."""
+    async def send_all():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            responses = []
+            for method, url, kwargs in requests_to_send:
+                responses.append(await client.request(method, url, **kwargs))
+            return responses
+    return asyncio.run(send_all())
+
+
+LOGIN = ('POST', '/login', {'json': {'username': 'testuser', 'password': 'testpass'}})
+
+
+def test_async_views_registered(asgi_app):
+    import inspect
+    view = asgi_app.app.view_functions['add_magnet_link_route']
+    assert inspect.iscoroutinefunction(view)
+    assert not inspect.iscoroutinefunction(asgi_app.app.view_functions['login'])
+
+
+def test_asgi_add_magnet_link(asgi_app):
+    magnet_link = "magnet:?xt=urn:btih:ASYNCHASH"
+    login_response, response = run_requests(
+        asgi_app, LOGIN, ('POST', '/add_magnet_link', {'json': {'magnet_link': magnet_link}})
+    )
+    assert login_response.status_code == 200
+    assert response.status_code == 200, response.text
+    assert response.json()["message"] == "Magnet link added successfully for user testuser"
+    asgi_app.mock_torrent_client.add_download_by_link.assert_awaited_once_with(magnet_link, "testuser")
+
+
+def test_asgi_add_magnet_link_not_logged_in(asgi_app):
+    (response,) = run_requests(
+        asgi_app, ('POST', '/add_magnet_link', {'json': {'magnet_link': "magnet:?xt=urn:btih:X"}})
+    )
+    assert response.status_code == 401
+    asgi_app.mock_torrent_client.add_download_by_link.assert_not_called()
+
+
+def test_asgi_add_magnet_link_upstream_error(asgi_app):
+    asgi_app.mock_torrent_client.add_download_by_link.side_effect = Exception("qBittorrent unavailable")
+    _, response = run_requests(
+        asgi_app, LOGIN, ('POST', '/add_magnet_link', {'json': {'magnet_link': "magnet:?xt=urn:btih:X"}})
+    )
+    assert response.status_code == 500
+    assert response.json() == {"error": "qBittorrent unavailable"}
+
+
+def test_asgi_add_magnet_links(asgi_app):
+    links = ["magnet:?xt=urn:btih:A", "magnet:?xt=urn:btih:B"]
+    _, response = run_requests(
+        asgi_app, LOGIN, ('POST', '/add_magnet_links', {'json': {'magnet_links': links, 'target_user': 'common'}})
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["message"] == "2 of 2 magnet links added successfully for user common"
+    asgi_app.mock_torrent_client.add_downloads_by_links.assert_awaited_once_with(links, "common")
+
+
+ASYNC_TORRENT = b"d4:infod6:lengthi1e4:name5:async12:piece lengthi16384e6:pieces20:" + b"p" * 20 + b"ee"
+
+
+def test_asgi_add_torrent_file(asgi_app):
+    captured = {}
+
+    async def capture(stream, user):
+        captured['content'] = stream.read()
+
+    asgi_app.mock_torrent_client.add_download_by_file.side_effect = capture
+    _, response = run_requests(
+        asgi_app, LOGIN,
+        ('POST', '/add_torrent_file', {'files': {'file': ('async.torrent', io.BytesIO(ASYNC_TORRENT))}})
+    )
+    assert response.status_code == 200, response.text
+    assert b"Torrent file from async.torrent added successfully for user testuser" in response.content
+    assert response.json()["torrent"]["name"] == "async"
+    assert captured['content'] == ASYNC_TORRENT
+
+
+def test_asgi_sync_routes_still_served(asgi_app):
+    _, status_response, logout_response = run_requests(
+        asgi_app, LOGIN, ('GET', '/status', {}), ('POST', '/logout', {})
+    )
+    assert status_response.status_code == 200
+    assert status_response.json()["message"] == "Logged in as testuser"
+    assert logout_response.status_code == 200
+
+
+def test_asgi_rejects_oversized_body(asgi_app):
+    asgi_app.max_body_size = 10
+    (response,) = run_requests(asgi_app, ('POST', '/login', {'content': json.dumps({'username': 'x' * 50})}))
+    assert response.status_code == 413
+
+
+def test_asgi_add_through_torrent_pool(asgi_app, monkeypatch):
+    monkeypatch.setenv('QB_BACKENDS', 'http://qb1:8080/,http://qb2:8080/')
+    monkeypatch.setenv('QB_HEALTH_INTERVAL', '0')
+    backend = MagicMock()
+    backend.count_active_torrents.return_value = 0
+    with patch('app.TorrentDB', return_value=backend):
+        login_response, response = run_requests(
+            asgi_app, LOGIN, ('POST', '/add_magnet_link', {'json': {'magnet_link': "magnet:?xt=urn:btih:" + "a" * 40}})
+        )
+    assert response.status_code == 200
+    backend.add_download_by_link.assert_called_once_with("magnet:?xt=urn:btih:" + "a" * 40, "testuser")
+    asgi_app.mock_torrent_client.add_download_by_link.assert_not_called()
+
+
+def test_asgi_blocking_steps_run_off_the_event_loop(asgi_app):
+    import threading
+    import app as app_module
+    from torrent_meta import parse_magnet
+    threads = {}
+
+    def recording(name, f):
+        def record(*args, **kwargs):
+            threads[name] = threading.get_ident()
+            return f(*args, **kwargs)
+        return record
+
+    app_module._rate_limiter.user_rate = 100
+    with patch('app._authenticated_user', recording('auth', app_module._authenticated_user)), \
+            patch('app._admit', recording('admit', app_module._admit)), \
+            patch('app.parse_magnet', recording('parse', parse_magnet)):
+        login_response, response = run_requests(
+            asgi_app, LOGIN, ('POST', '/add_magnet_link', {'json': {'magnet_link': "magnet:?xt=urn:btih:" + "d" * 40}})
+        )
+    assert response.status_code == 200
+    # asyncio.run() runs the event loop in this thread
+    assert set(threads) == {'auth', 'admit', 'parse'}
+    assert threading.get_ident() not in threads.values()
+
+
+def test_asgi_rate_limit(asgi_app):
+    import app as app_module
+    app_module._rate_limiter.user_rate = 0.01
+    app_module._rate_limiter.user_burst = 1
+    add = ('POST', '/add_magnet_link', {'json': {'magnet_link': "magnet:?xt=urn:btih:" + "b" * 40}})
+    login_response, first, second = run_requests(asgi_app, LOGIN, add, add)
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert second.headers['Retry-After'] == '100'
+
+
+def test_asgi_profiled_request(asgi_app, tmp_path):
+    import os
+    import app as app_module
+    app_module._profiler.directory = str(tmp_path)
+    app_module._profiler.token = 'profile-secret'
+    add = ('POST', '/add_magnet_link', {'json': {'magnet_link': "magnet:?xt=urn:btih:" + "c" * 40},
+                                        'headers': {'X-Profile': 'profile-secret'}})
+    login_response, response = run_requests(asgi_app, LOGIN, add)
+    assert response.status_code == 200
+    captures = [name for name in os.listdir(tmp_path) if name.endswith('.json')]
+    with open(tmp_path / captures[0]) as f:
+        capture = json.load(f)
+    # The async view shares the event loop with other requests: phases only
+    assert capture['cprofile'] is None
+    assert capture['stack_samples'] == {}
+    assert {'auth', 'parse', 'upstream'} <= set(capture['phases'])
+
+
+def test_asgi_events_stream(asgi_app, monkeypatch):
+    import threading
+    import time
+    import app as app_module
+    monkeypatch.setenv('TORRENT_CACHE_POLL_INTERVAL', '3600')
+    asgi_app.app.config.update(EVENTS_HEARTBEAT=0.05, EVENTS_MAX_DURATION=0.3)
+    backend = MagicMock()
+    backend.sync_maindata.return_value = {'rid': 1, 'full_update': True, 'torrents': {
+        'aaa': {'name': 'A', 'category': 'testuser', 'progress': 0.5},
+    }}
+    with patch('app.TorrentDB', return_value=backend):
+        cache = app_module.get_torrent_state_cache()
+        cache.sync_once()
+
+        def complete_once_subscribed():
+            while cache.subscriber_count() == 0:
+                time.sleep(0.01)
+            cache.apply({'rid': 2, 'torrents': {'aaa': {'progress': 1.0}}})
+
+        threading.Thread(target=complete_once_subscribed, daemon=True).start()
+        login_response, response = run_requests(asgi_app, LOGIN, ('GET', '/events', {}))
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = [json.loads(line[len('data: '):]) for line in response.text.splitlines() if line.startswith('data: ')]
+    assert [event['type'] for event in events] == ['snapshot', 'update', 'completed']
+    assert ": keep-alive" in response.text
+    assert cache.subscriber_count() == 0
@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import time
+from unittest.mock import patch
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from auth import (
+    ApiTokens, CredentialCache, EnvUserStore, FileUserStore, SQLiteUserStore, hash_users, is_password_hash,
+    open_user_store,
+)
+
+HASH = generate_password_hash("secret")
+
+
+def test_api_token_round_trip():
+    tokens = ApiTokens("signing-key")
+    token = tokens.issue("alice")
+    assert tokens.verify(token) == "alice"
+
+
+def test_api_token_rejects_tampering_and_other_secrets():
+    token = ApiTokens("signing-key").issue("alice")
+    payload, _, signature = token.rpartition(".")
+    assert ApiTokens("signing-key").verify(payload + "." + signature[::-1]) is None
+    assert ApiTokens("other-key").verify(token) is None
+    assert ApiTokens("signing-key").verify("not-a-token") is None
+
+
+def test_api_token_expires():
+    token = ApiTokens("signing-key").issue("alice")
+    assert ApiTokens("signing-key", ttl=-1).verify(token) is None
+
+
+def test_credential_cache_skips_repeated_hashing():
+    cache = CredentialCache(ttl=60)
+    with patch('auth.check_password_hash', wraps=check_password_hash) as check:
+        assert cache.verify("alice", "secret", HASH)
+        assert cache.verify("alice", "secret", HASH)
+        assert check.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_credential_cache_never_caches_failures():
+    cache = CredentialCache(ttl=60)
+    with patch('auth.check_password_hash', wraps=check_password_hash) as check:
+        assert not cache.verify("alice", "wrong", HASH)
+        assert not cache.verify("alice", "wrong", HASH)
+        assert check.call_count == 2
+
+
+def test_credential_cache_rechecks_changed_hash_and_expired_entries():
+    cache = CredentialCache(ttl=0.05)
+    assert cache.verify("alice", "secret", HASH)
+    # Password changed: the cached success no longer applies
+    assert not cache.verify("alice", "secret", generate_password_hash("new secret"))
+    time.sleep(0.06)
+    with patch('auth.check_password_hash', return_value=False):
+        assert not cache.verify("alice", "secret", HASH)
+
+
+def test_credential_cache_is_bounded():
+    cache = CredentialCache(ttl=60, max_size=2)
+    with patch('auth.check_password_hash', return_value=True) as check:
+        for user in ("a", "b", "c"):
+            cache.verify(user, "pw", HASH)
+        cache.verify("a", "pw", HASH)  # Evicted as the oldest entry
+        assert check.call_count == 4
+        assert len(cache._entries) == 2
+
+
+def test_credential_cache_disabled():
+    cache = CredentialCache(ttl=0)
+    with patch('auth.check_password_hash', wraps=check_password_hash) as check:
+        cache.verify("alice", "secret", HASH)
+        cache.verify("alice", "secret", HASH)
+        assert check.call_count == 2
+
+
+def test_hash_users():
+    hashes = dict(pair.split(':', 1) for pair in hash_users("alice:secret, bob : other ,malformed").split(','))
+    assert sorted(hashes) == ["alice", "bob"]
+    assert all(is_password_hash(value) for value in hashes.values())
+    assert check_password_hash(hashes["bob"], "other")
+
+
+def test_is_password_hash():
+    assert is_password_hash(HASH)
+    assert is_password_hash(generate_password_hash("x", method="pbkdf2:sha256"))
+    assert not is_password_hash("plaintext")
+    assert not is_password_hash("scrypt:but$not-a-hash")
+
+
+def test_env_user_store_hashes_on_first_use():
+    with patch('auth.generate_password_hash', return_value=HASH) as generate:
+        store = EnvUserStore("alice:secret,malformed", "bob:" + HASH + ",carol:plaintext")
+        generate.assert_not_called()
+        assert store.get("alice") == HASH
+        assert "bob" in store and "carol" not in store and "malformed" not in store
+        assert len(store) == 2
+        generate.assert_called_once_with("secret")
+
+
+def test_file_user_store_reloads_when_the_file_changes(tmp_path):
+    path = str(tmp_path / "users.txt")
+    with open(path, "w") as f:
+        f.write("# comment\nalice:" + HASH + "\nbob:plaintext\n")
+    store = FileUserStore(path, check_interval=0)
+    assert store.get("alice") == HASH
+    assert "bob" not in store
+
+    store.set("bob", HASH)
+    store.set("alice", None)
+    assert "alice" not in store
+    assert store.get("bob") == HASH
+    with open(path) as f:
+        assert f.read() == "bob:" + HASH + "\n"
+
+
+def test_file_user_store_checks_at_most_every_interval(tmp_path):
+    path = str(tmp_path / "users.txt")
+    with open(path, "w") as f:
+        f.write("alice:" + HASH)
+    store = FileUserStore(path, check_interval=60)
+    assert "alice" in store
+    with patch('auth.os.stat') as stat:
+        for _ in range(100):
+            assert "alice" in store
+        stat.assert_not_called()
+
+
+def test_file_user_store_keeps_users_when_the_file_is_gone(tmp_path):
+    path = str(tmp_path / "users.txt")
+    assert len(FileUserStore(path)) == 0
+    with open(path, "w") as f:
+        f.write("alice:" + HASH)
+    store = FileUserStore(path, check_interval=0)
+    assert "alice" in store
+    os.remove(path)
+    assert "alice" in store
+
+
+def test_sqlite_user_store_sees_other_connections(tmp_path):
+    path = str(tmp_path / "users.sqlite3")
+    store = open_user_store(path, check_interval=0)
+    assert isinstance(store, SQLiteUserStore)
+    assert len(store) == 0
+
+    # Another worker, or python auth.py, adds a user
+    with sqlite3.connect(path) as db:
+        db.execute("INSERT INTO users VALUES ('alice', ?)", (HASH,))
+    assert store.get("alice") == HASH
+
+    store.set("bob", HASH)
+    assert "bob" in store
+    assert "bob" in SQLiteUserStore(path)
+    store.set("alice", None)
+    assert "alice" not in store
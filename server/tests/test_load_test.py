@@ -0,0 +1,46 @@
+import os
+import shutil
+import sys
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import load_test  # noqa: E402
+
+
+@pytest.mark.skipif(shutil.which('gunicorn') is None, reason="gunicorn is not installed")
+def test_load_test_smoke():
+    report = load_test.run(mode='sync', workers=1, concurrency=2, duration=0.5, scenarios=('magnet', 'file'),
+                           latency=0.001)
+    assert [result['scenario'] for result in report['results']] == ['magnet', 'file']
+    for result in report['results']:
+        assert result['requests'] > 0
+        assert result['errors'] == {}
+        assert result['p50_ms'] <= result['p99_ms']
+    if sys.platform.startswith('linux'):
+        assert len(report['worker_rss_kib']) == 1
+
+
+@pytest.mark.skipif(shutil.which('gunicorn') is None, reason="gunicorn is not installed")
+def test_workers_are_ready_before_first_request():
+    # gunicorn.conf.py logs each worker in to qBittorrent before it accepts requests
+    fake, qb_url = load_test.start_fake_qbittorrent(0.0, None, 0.0)
+    try:
+        server, base_url = load_test.start_server('sync', 2, 1, qb_url, {})
+        try:
+            for _ in range(4):
+                response = requests.get(base_url + '/ready', timeout=5)
+                assert response.status_code == 200
+                assert response.json() == {"ready": True, "qbittorrent_session": "live"}
+        finally:
+            load_test.stop(server)
+    finally:
+        load_test.stop(fake)
+
+
+def test_percentile():
+    values = [i / 100 for i in range(1, 101)]
+    assert load_test.percentile(values, 0.50) == 0.51
+    assert load_test.percentile(values, 0.99) == 1.0
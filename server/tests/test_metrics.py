@@ -0,0 +1,133 @@
+import multiprocessing
+import os
+
+import pytest
+
+from metrics import Registry, _read_file
+
+
+def parse_samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def make_metrics(registry):
+    return (
+        registry.counter('jobs_total', 'Jobs', ['kind']),
+        registry.gauge('jobs_in_progress', 'Jobs in flight'),
+        registry.histogram('job_seconds', 'Job duration', ['kind'], buckets=(0.1, 1.0)),
+    )
+
+
+def test_render_counter_gauge_histogram():
+    registry = Registry()
+    counter, gauge, histogram = make_metrics(registry)
+    counter.inc('magnet')
+    counter.inc('magnet', amount=2)
+    gauge.inc()
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value, 'file')
+
+    text = registry.render()
+    assert '# TYPE job_seconds histogram' in text
+    samples = parse_samples(text)
+    assert samples['jobs_total{kind="magnet"}'] == 3
+    assert samples['jobs_in_progress'] == 1
+    assert samples['job_seconds_bucket{kind="file",le="0.1"}'] == 1
+    assert samples['job_seconds_bucket{kind="file",le="1"}'] == 3
+    assert samples['job_seconds_bucket{kind="file",le="+Inf"}'] == 4
+    assert samples['job_seconds_count{kind="file"}'] == 4
+    assert samples['job_seconds_sum{kind="file"}'] == pytest.approx(4.05)
+
+
+def test_label_values_are_escaped_and_checked():
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests', ['route'])
+    counter.inc('/a"b\\c')
+    assert 'requests_total{route="/a\\"b\\\\c"} 1' in registry.render()
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_register_is_idempotent():
+    registry = Registry()
+    assert registry.counter('x_total', 'X') is registry.counter('x_total', 'X')
+    with pytest.raises(ValueError):
+        registry.gauge('x_total', 'X')
+
+
+def _worker(directory, increments, hold=None, release=None):
+    registry = Registry(directory)
+    counter, gauge, histogram = make_metrics(registry)
+    for _ in range(increments):
+        counter.inc('magnet')
+        histogram.observe(0.5, 'magnet')
+    gauge.inc()
+    if hold is not None:
+        hold.set()
+        release.wait(10)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_values_are_summed_across_processes(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    directory = str(tmp_path)
+    workers = [ctx.Process(target=_worker, args=(directory, n)) for n in (1, 2, 3)]
+    hold, release = ctx.Event(), ctx.Event()
+    live = ctx.Process(target=_worker, args=(directory, 4, hold, release))
+    for process in workers + [live]:
+        process.start()
+    for process in workers:
+        process.join(10)
+    assert hold.wait(10)
+
+    registry = Registry(directory)
+    make_metrics(registry)
+    samples = parse_samples(registry.render())
+    assert samples['jobs_total{kind="magnet"}'] == 10
+    assert samples['job_seconds_count{kind="magnet"}'] == 10
+    # Only the live process still counts towards the gauge
+    assert samples['jobs_in_progress'] == 1
+
+    release.set()
+    live.join(10)
+    samples = parse_samples(registry.render())
+    assert samples['jobs_total{kind="magnet"}'] == 10
+    assert 'jobs_in_progress' not in samples
+
+
+def test_retired_files_keep_counters_but_not_gauges(tmp_path):
+    exited = Registry(str(tmp_path))
+    jobs, in_progress, _ = make_metrics(exited)
+    jobs.inc('magnet', amount=5)
+    in_progress.inc()
+    exited.store.close()
+    exited.mark_process_dead(os.getpid())
+
+    # A new worker that got the same pid starts from zero
+    reused = Registry(str(tmp_path))
+    jobs, in_progress, _ = make_metrics(reused)
+    jobs.inc('magnet')
+    in_progress.inc()
+    samples = parse_samples(reused.render())
+    assert samples['jobs_total{kind="magnet"}'] == 6
+    assert samples['jobs_in_progress'] == 1
+
+    reused.clear_directory()
+    assert os.listdir(tmp_path) == []
+    reused.store.close()
+
+
+def test_mmap_store_grows(tmp_path):
+    registry = Registry(str(tmp_path))
+    counter = registry.counter('many_total', 'Many', ['n'])
+    for n in range(3000):
+        counter.inc(str(n), amount=n)
+    values = _read_file(registry.store.path)
+    assert len(values) == 3000
+    assert os.path.getsize(registry.store.path) > 64 * 1024
+    assert parse_samples(registry.render())['many_total{n="2999"}'] == 2999
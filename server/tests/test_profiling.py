@@ -0,0 +1,105 @@
+import json
+import os
+import pstats
+import threading
+import time
+
+from profiling import Profiler
+
+
+def load(directory, name):
+    with open(os.path.join(directory, name + '.json')) as f:
+        return json.load(f)
+
+
+def slow_work(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_fast_requests_are_not_captured(tmp_path):
+    profiler = Profiler(str(tmp_path), slow_seconds=1.0)
+    profile = profiler.start()
+    assert profiler.finish(profile, '/add_magnet_link', 'POST', 200) is None
+    assert profiler.captures() == []
+
+
+def test_disabled_without_a_trigger(tmp_path):
+    assert not Profiler(str(tmp_path)).enabled
+    assert not Profiler('', slow_seconds=1.0).enabled
+    assert Profiler(str(tmp_path), token='secret').enabled
+    assert Profiler(str(tmp_path)).start() is None
+
+
+def test_slow_request_is_captured_with_phases_and_stack_samples(tmp_path):
+    profiler = Profiler(str(tmp_path), slow_seconds=0.05, interval=0.005)
+    profile = profiler.start()
+    with profile.phase('auth'):
+        pass
+    with profile.phase('upstream'):
+        slow_work(0.1)
+    profile.response_started()
+    path = profiler.finish(profile, '/add_magnet_link', 'POST', 200, user='testuser')
+
+    capture = load(str(tmp_path), profiler.captures()[0])
+    assert path.endswith('-add_magnet_link.json')
+    assert capture['trigger'] == 'slow'
+    assert capture['user'] == 'testuser'
+    assert capture['cprofile'] is None
+    assert set(capture['phases']) == {'auth', 'upstream', 'response', 'other'}
+    assert capture['phases']['upstream'] >= 0.1
+    assert capture['duration'] >= sum(capture['phases'].values()) - 1e-6
+    assert any('slow_work' in stack for stack in capture['stack_samples'])
+    profiler.stop()
+
+
+def test_forced_request_runs_under_cprofile(tmp_path):
+    profiler = Profiler(str(tmp_path), token='secret')
+    profile = profiler.start(forced=True)
+    slow_work(0.01)
+    profiler.finish(profile, '/status', 'GET', 200)
+
+    capture = load(str(tmp_path), profiler.captures()[0])
+    assert capture['trigger'] == 'header'
+    stats = pstats.Stats(os.path.join(str(tmp_path), capture['cprofile']))
+    assert any(function == 'slow_work' for _, _, function in stats.stats)
+    profiler.stop()
+
+
+def test_async_requests_get_phases_only(tmp_path):
+    profiler = Profiler(str(tmp_path), token='secret')
+    profile = profiler.start(forced=True, threaded=False)
+    assert profile.cprofile is None
+    profiler.finish(profile, '/add_magnet_link', 'POST', 200)
+    assert load(str(tmp_path), profiler.captures()[0])['stack_samples'] == {}
+
+
+def test_ring_buffer_keeps_the_newest_captures(tmp_path):
+    profiler = Profiler(str(tmp_path), token='secret', max_files=3)
+    for i in range(5):
+        profiler.finish(profiler.start(forced=True), f'/route{i}', 'GET', 200)
+    names = profiler.captures()
+    assert [name.rsplit('-', 1)[1] for name in names] == ['route2', 'route3', 'route4']
+    assert len(os.listdir(str(tmp_path))) == 6  # .json and .prof each
+    profiler.stop()
+
+
+def test_concurrent_requests_are_sampled_separately(tmp_path):
+    profiler = Profiler(str(tmp_path), slow_seconds=0.05, interval=0.005)
+    captured = {}
+
+    def handle(name, seconds):
+        profile = profiler.start()
+        slow_work(seconds)
+        captured[name] = profiler.finish(profile, '/' + name, 'GET', 200)
+
+    threads = [threading.Thread(target=handle, args=('slow', 0.1)), threading.Thread(target=handle, args=('fast', 0))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert captured['fast'] is None
+    with open(captured['slow']) as f:
+        assert sum(json.load(f)['stack_samples'].values()) > 5
+    profiler.stop()
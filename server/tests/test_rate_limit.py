@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from rate_limit import RateLimiter
+
+
+def test_user_bucket_allows_burst_then_limits():
+    limiter = RateLimiter(user_rate=1, user_burst=3)
+    assert [limiter.check("alice") for _ in range(3)] == [None, None, None]
+    limit, wait = limiter.check("alice")
+    assert limit == 'user'
+    assert 0.9 < wait <= 1.0
+    # Every user has a bucket of their own
+    assert limiter.check("bob") is None
+
+
+def test_bucket_refills():
+    limiter = RateLimiter(user_rate=20, user_burst=1)
+    assert limiter.check("alice") is None
+    assert limiter.check("alice") is not None
+    time.sleep(0.06)
+    assert limiter.check("alice") is None
+
+
+def test_global_bucket_is_shared_by_users():
+    limiter = RateLimiter(user_rate=100, global_rate=1, global_burst=2)
+    assert limiter.check("alice") is None
+    assert limiter.check("bob") is None
+    assert limiter.check("carol")[0] == 'global'
+
+
+def test_rejected_request_takes_no_tokens():
+    limiter = RateLimiter(user_rate=0.001, user_burst=1, global_rate=0.001, global_burst=3)
+    assert limiter.check("alice") is None
+    assert limiter.check("alice")[0] == 'user'
+    # The rejected request did not use up a global token
+    assert limiter.check("bob") is None
+    assert limiter.check("carol") is None
+    assert limiter.check("dave")[0] == 'global'
+
+
+def test_disabled_limiter():
+    limiter = RateLimiter()
+    assert not limiter.enabled
+    assert limiter.check("alice") is None
+    assert limiter.acquire() == 0
+
+
+def test_inflight_cap():
+    limiter = RateLimiter(max_inflight=2)
+    first, second = limiter.acquire(), limiter.acquire()
+    assert first and second
+    assert limiter.acquire() is None
+    limiter.release(first)
+    assert limiter.acquire() is not None
+    assert limiter.inflight() == 2
+
+
+def test_expired_slots_are_reclaimed():
+    limiter = RateLimiter(max_inflight=1, lease=0.05)
+    assert limiter.acquire()
+    assert limiter.acquire() is None
+    time.sleep(0.06)
+    assert limiter.acquire()
+
+
+def test_state_is_shared_through_the_database_file(tmp_path):
+    path = str(tmp_path / "limits.sqlite3")
+    worker1 = RateLimiter(path, user_rate=0.001, user_burst=2, max_inflight=1)
+    worker2 = RateLimiter(path, user_rate=0.001, user_burst=2, max_inflight=1)
+    assert worker1.check("alice") is None
+    assert worker2.check("alice") is None
+    assert worker1.check("alice")[0] == 'user'
+    slot = worker1.acquire()
+    assert worker2.acquire() is None
+    worker1.release(slot)
+    assert worker2.acquire()
+
+
+def _hold_slot(path):
+    RateLimiter(path, max_inflight=1).acquire()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_slots_of_dead_processes_are_reclaimed(tmp_path):
+    path = str(tmp_path / "limits.sqlite3")
+    process = multiprocessing.get_context('fork').Process(target=_hold_slot, args=(path,))
+    process.start()
+    process.join(10)
+    limiter = RateLimiter(path, max_inflight=1)
+    assert limiter.inflight() == 1
+    assert limiter.acquire()
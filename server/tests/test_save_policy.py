@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from save_policy import DEFAULT_SAVE_PATH, QuotaExceeded, SavePolicy, disk_usage, load_rules, parse_size
+
+RULES = [
+    {"match": "common", "save_path": "/srv/shared", "quota": "1K"},
+    {"match": "guest-*", "route_to": "common"},
+    {"match": "alice", "save_path": "/data/{category}", "quota": 1000},
+]
+
+
+def test_parse_size():
+    assert parse_size(None) is None
+    assert parse_size(512) == 512
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5 GiB") == 3 * 1024 ** 3 // 2
+    assert parse_size("10TB") == 10 * 1024 ** 4
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_load_rules(tmp_path):
+    assert load_rules("") == []
+    path = tmp_path / "policy.json"
+    path.write_text('[{"match": "*", "quota": "1M"}]')
+    assert load_rules(str(path)) == [{"match": "*", "quota": "1M"}]
+    with pytest.raises(ValueError):
+        load_rules('[{"save_path": "/no/match"}]')
+
+
+def test_rules_resolve_save_paths_and_routes():
+    policy = SavePolicy(RULES)
+    assert policy.resolve("alice") == ("alice", "/data/alice", 1000)
+    assert policy.resolve("guest-1") == ("common", "/srv/shared", 1024)
+    assert policy.save_path("bob") == DEFAULT_SAVE_PATH.format(category="bob")
+    assert policy.resolve("bob").quota is None
+    with pytest.raises(ValueError):
+        SavePolicy([{"match": "a", "route_to": "b"}, {"match": "b", "route_to": "a"}]).resolve("a")
+
+
+def test_admit_counts_reported_scanned_and_pending_usage():
+    reported = {"alice": 600}
+    known = set()
+    policy = SavePolicy(RULES, reported_usage=reported.get, is_known=known.__contains__, scan_interval=0)
+    assert policy.admit("alice", 400).category == "alice"
+    with pytest.raises(QuotaExceeded) as e:
+        policy.admit("alice", 401)
+    assert e.value.used == 600
+
+    # Accepted, not yet reported by qBittorrent
+    policy.record_add("alice", "aaa", 300)
+    assert policy.usage("alice") == 900
+    reported["alice"] = 900
+    known.add("aaa")
+    assert policy.usage("alice") == 900
+
+    # Files qBittorrent does not know about, found by the scan
+    policy._scanned["/data/alice"] = 2000
+    with pytest.raises(QuotaExceeded):
+        policy.admit("alice")
+    assert policy.admit("bob", 10 ** 12).quota is None
+
+
+def test_usage_falls_back_to_scanned_and_pending_without_qbittorrent():
+    def unreachable(category):
+        raise ConnectionError("refused")
+
+    policy = SavePolicy(RULES, reported_usage=unreachable, scan_interval=0)
+    policy._scanned["/data/alice"] = 500
+    policy.record_add("alice", "aaa", 300)
+    assert policy.usage("alice") == 800
+    with pytest.raises(QuotaExceeded):
+        policy.admit("alice", 201)
+
+
+def test_scan_measures_save_paths_with_a_quota(tmp_path):
+    os.makedirs(tmp_path / "alice" / "nested")
+    (tmp_path / "alice" / "nested" / "file.bin").write_bytes(b"x" * 10000)
+    policy = SavePolicy([{"match": "*", "save_path": str(tmp_path / "{category}"), "quota": "1G"}], scan_interval=0)
+    policy.admit("alice")
+    policy.admit("nobody")
+    scanned = policy.scan()
+    assert scanned[str(tmp_path / "alice")] == disk_usage(str(tmp_path / "alice")) >= 10000
+    assert scanned[str(tmp_path / "nobody")] == 0
+    assert policy.usage("alice") == scanned[str(tmp_path / "alice")]
@@ -0,0 +1,245 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+import submission_queue
+from submission_queue import SubmissionQueue
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def db():
+    db = MagicMock()
+    db.add_downloads_by_files.side_effect = lambda files, user, batch_size: ["Ok."] * len(files)
+    return db
+
+
+@pytest.fixture
+def make_queue(db):
+    queues = []
+
+    def make(**kwargs):
+        kwargs.setdefault('poll_interval', 0.02)
+        queue = SubmissionQueue(lambda: db, **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        if queue._threads:
+            queue.stop()
+
+
+def test_submit_returns_queued_job(make_queue):
+    queue = make_queue()
+    job = queue.submit_magnet("magnet:?xt=urn:btih:" + "a" * 40, "user1", "a" * 40, submitted_by="user1")
+    assert job["status"] == "queued"
+    assert job["kind"] == "magnet"
+    assert queue.get(job["id"]) == job
+    assert queue.get("missing") is None
+
+
+def test_dispatcher_batches_per_user(make_queue, db):
+    queue = make_queue(workers=1)
+    jobs = [queue.submit_magnet(f"magnet:?xt=urn:btih:{i:040d}", "user1", f"{i:040d}") for i in range(3)]
+    other = queue.submit_magnet("magnet:?xt=urn:btih:" + "f" * 40, "user2", "f" * 40)
+    queue.start()
+
+    assert wait_for(lambda: all(queue.get(job["id"])["status"] == "added" for job in jobs + [other]))
+    assert db.add_downloads_by_links.call_count == 2
+    first_call = db.add_downloads_by_links.call_args_list[0]
+    assert first_call.args == ([job["magnet_link"] for job in jobs], "user1")
+
+
+def test_duplicate_submissions_are_coalesced(make_queue, db):
+    queue = make_queue(workers=1)
+    first = queue.submit_magnet("magnet:?xt=urn:btih:" + "a" * 40, "user1", "a" * 40)
+    second = queue.submit_magnet("magnet:?xt=urn:btih:" + "a" * 40 + "&dn=again", "user1", "a" * 40)
+    other_user = queue.submit_magnet("magnet:?xt=urn:btih:" + "a" * 40, "user2", "a" * 40)
+    assert second["id"] == first["id"]
+    assert other_user["id"] != first["id"]
+
+
+def test_coalesced_jobs_are_visible_to_every_submitter(make_queue):
+    queue = make_queue()
+    magnet_link = "magnet:?xt=urn:btih:" + "a" * 40
+    first = queue.submit_magnet(magnet_link, "common", "a" * 40, submitted_by="alice")
+    second = queue.submit_magnet(magnet_link, "common", "a" * 40, submitted_by="bob")
+    assert second["id"] == first["id"]
+    assert queue.get(first["id"], submitted_by="alice") == first
+    assert queue.get(first["id"], submitted_by="bob") == first
+    assert queue.get(first["id"], submitted_by="carol") is None
+
+
+def test_files_are_submitted_with_their_content(make_queue, db):
+    captured = []
+    db.add_downloads_by_files.side_effect = lambda files, user, batch_size: [
+        captured.append((name, stream.read(), user)) or "Ok." for name, stream in files
+    ]
+    added = []
+    queue = make_queue(workers=1, on_added=added.extend)
+    job = queue.submit_file("a.torrent", b"torrent bytes", "user1", "b" * 40)
+    queue.start()
+
+    assert wait_for(lambda: queue.get(job["id"])["status"] == "added")
+    assert captured == [("a.torrent", b"torrent bytes", "user1")]
+    assert added == ["b" * 40]
+    assert "torrent" not in queue.get(job["id"])
+
+
+def test_failed_submission_is_retried(make_queue, db):
+    db.add_downloads_by_links.side_effect = [Exception("qBittorrent restarting"), None]
+    queue = make_queue(workers=1, retry_backoff=0.05)
+    job = queue.submit_magnet("magnet:?xt=urn:btih:" + "c" * 40, "user1", "c" * 40)
+    queue.start()
+
+    assert wait_for(lambda: queue.get(job["id"])["status"] == "added")
+    job = queue.get(job["id"])
+    assert job["attempts"] == 2
+    assert job["error"] is None
+
+
+def test_submission_fails_after_max_attempts(make_queue, db):
+    db.add_downloads_by_links.side_effect = Exception("still down")
+    queue = make_queue(workers=1, retry_backoff=0.01, max_attempts=3)
+    job = queue.submit_magnet("magnet:?xt=urn:btih:" + "d" * 40, "user1", "d" * 40)
+    queue.start()
+
+    assert wait_for(lambda: queue.get(job["id"])["status"] == "failed")
+    job = queue.get(job["id"])
+    assert job["attempts"] == 3
+    assert job["error"] == "still down"
+    assert db.add_downloads_by_links.call_count == 3
+
+
+def test_per_file_failures_only_affect_their_job(make_queue, db):
+    db.add_downloads_by_files.side_effect = lambda files, user, batch_size: ["Ok.", Exception("rejected")]
+    queue = make_queue(workers=1, max_attempts=1)
+    good = queue.submit_file("good.torrent", b"good", "user1", "1" * 40)
+    bad = queue.submit_file("bad.torrent", b"bad", "user1", "2" * 40)
+    queue.start()
+
+    assert wait_for(lambda: queue.pending() == 0)
+    assert queue.get(good["id"])["status"] == "added"
+    assert queue.get(bad["id"])["status"] == "failed"
+
+
+def test_queue_survives_restart(tmp_path, make_queue, db):
+    path = str(tmp_path / "queue.sqlite3")
+    queue = make_queue(path=path)
+    job = queue.submit_magnet("magnet:?xt=urn:btih:" + "e" * 40, "user1", "e" * 40)
+    queue._conn.close()  # Process went away before dispatching
+
+    restarted = make_queue(path=path, workers=1).start()
+    assert wait_for(lambda: restarted.get(job["id"])["status"] == "added")
+    db.add_downloads_by_links.assert_called_once_with([job["magnet_link"]], "user1")
+
+
+def test_expired_lease_is_reclaimed(tmp_path, make_queue, db):
+    # A dispatcher that died mid-submission leaves its jobs 'running'; they are
+    # handed out again once the lease runs out
+    path = str(tmp_path / "queue.sqlite3")
+    crashed = make_queue(path=path, lease=0.1)
+    job = crashed.submit_magnet("magnet:?xt=urn:btih:" + "9" * 40, "user1", "9" * 40)
+    assert [claimed["id"] for claimed in crashed._claim()] == [job["id"]]
+    crashed._conn.close()
+
+    survivor = make_queue(path=path, workers=1).start()
+    assert wait_for(lambda: survivor.get(job["id"])["status"] == "added")
+    assert survivor.get(job["id"])["attempts"] == 2
+
+
+def test_concurrent_dispatchers_claim_each_job_once(tmp_path, make_queue, db):
+    submitted = []
+    lock = threading.Lock()
+
+    def record(links, user):
+        with lock:
+            submitted.extend(links)
+
+    db.add_downloads_by_links.side_effect = record
+    path = str(tmp_path / "queue.sqlite3")
+    producer = make_queue(path=path)
+    jobs = [producer.submit_magnet(f"magnet:?xt=urn:btih:{i:040x}", "user1", f"{i:040x}") for i in range(200)]
+    workers = [make_queue(path=path, workers=2, batch_size=7).start() for _ in range(3)]
+
+    assert wait_for(lambda: producer.pending() == 0)
+    assert sorted(submitted) == sorted(job["magnet_link"] for job in jobs)
+    for queue in workers:
+        queue.stop()
+
+
+def test_waiting_submissions_are_group_committed(tmp_path, make_queue, monkeypatch):
+    commits = []
+    monkeypatch.setattr(submission_queue.SUBMISSION_COMMIT_SIZE, "observe", commits.append)
+    queue = make_queue(path=str(tmp_path / "queue.sqlite3"))
+    jobs = []
+    threads = [threading.Thread(target=lambda i=i: jobs.append(
+        queue.submit_magnet(f"magnet:?xt=urn:btih:{i:040x}", "user1", f"{i:040x}"))) for i in range(20)]
+    with queue._lock:  # A commit in progress: everyone submitting meanwhile waits for the next one
+        for thread in threads:
+            thread.start()
+        assert wait_for(lambda: len(queue._waiting) == 20)
+    for thread in threads:
+        thread.join()
+
+    assert commits == [20]
+    assert len({job["id"] for job in jobs}) == 20
+    assert all(queue.get(job["id"])["status"] == "queued" for job in jobs)
+
+
+def test_outages_are_retried_past_max_attempts(make_queue, db):
+    db.add_downloads_by_links.side_effect = [ConnectionError("qBittorrent down")] * 9 + [None]
+    queue = make_queue(workers=1, max_attempts=2, retry_backoff=0.01, max_retry_delay=0.02,
+                       is_transient=lambda error: isinstance(error, ConnectionError))
+    job = queue.submit_magnet("magnet:?xt=urn:btih:" + "c" * 40, "user1", "c" * 40)
+    queue.start()
+
+    # Uncapped, the tenth attempt would wait 0.01 * 2**8 seconds
+    assert wait_for(lambda: queue.get(job["id"])["status"] == "added", timeout=2.0)
+    assert queue.get(job["id"])["attempts"] == 10
+
+
+def test_present_torrents_are_not_resubmitted(make_queue, db):
+    queue = make_queue(workers=1, is_present=lambda info_hash: info_hash == "a" * 40)
+    present = queue.submit_magnet("magnet:?xt=urn:btih:" + "a" * 40, "user1", "a" * 40)
+    missing = queue.submit_magnet("magnet:?xt=urn:btih:" + "b" * 40, "user1", "b" * 40)
+    queue.start()
+
+    assert wait_for(lambda: queue.pending() == 0)
+    assert queue.get(present["id"])["status"] == "added"
+    assert queue.get(missing["id"])["status"] == "added"
+    db.add_downloads_by_links.assert_called_once_with([missing["magnet_link"]], "user1")
+
+
+def test_replay_throughput(tmp_path, make_queue, db, record_property):
+    # Drains a backlog left by an outage from a file-backed queue; the rate
+    # ends up in the JUnit report
+    path = str(tmp_path / "queue.sqlite3")
+    outbox = make_queue(path=path)
+    threads = [threading.Thread(target=lambda t=t: [
+        outbox.submit_magnet(f"magnet:?xt=urn:btih:{t:08x}{i:032x}", f"user{t % 4}", f"{t:08x}{i:032x}")
+        for i in range(250)]) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outbox.pending() == 2000
+
+    started = time.perf_counter()
+    replayer = make_queue(path=path, workers=2, is_present=lambda info_hash: False).start()
+    assert wait_for(lambda: replayer.pending() == 0, timeout=30.0)
+    rate = 2000 / (time.perf_counter() - started)
+    record_property("replay_jobs_per_second", round(rate))
+    assert sum(len(call.args[0]) for call in db.add_downloads_by_links.call_args_list) == 2000
+    assert rate > 200
@@ -1,7 +1,19 @@
+import asyncio
+import io
+import json
+import os
 import pytest
 from unittest.mock import patch, Mock, call, MagicMock
+import threading
+import time
 import requests  # Required for requests.exceptions.HTTPError
-from torrent_lib import TorrentDB  # Adjusted import path
+from contextlib import ExitStack
+from torrent_lib import TorrentDB, MultipartStream, AsyncTorrentDB, TorrentStateCache, InfoHashIndex, MagnetCache  # Adjusted import path
+from torrent_lib import TorrentPool, ConsistentHashPlacement, UserPlacement, LeastLoadedPlacement, NoBackendAvailable
+from torrent_lib import CircuitBreaker, CircuitOpenError, BulkheadFullError
+from torrent_meta import magnet_info_hash
+from fake_qbittorrent import FakeQBittorrent
+from metrics import REGISTRY
 
 # Define a constant for the base save path to avoid repetition
 BASE_SAVE_PATH = "/home/fcstorrent/downloads/qbittorrent/"
@@ -76,6 +88,60 @@ def test_add_download_by_link_retry_success(mock_qb_client):
     assert calls[1] == call("magnet:?xt=urn:btih:testlink", category="test_user_category", savepath=expected_savepath)
 
 
+def test_add_download_by_link_is_traced_with_its_retry(mock_qb_client, tmp_path):
+    from tracing import Tracer
+    mock_qb_client.download_from_link.side_effect = [
+        requests.exceptions.HTTPError(response=Mock(status_code=403)),
+        "success_value_link"
+    ]
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+    tracer = Tracer(str(tmp_path / "traces.jsonl"), slow_seconds=0, sample_rate=1.0)
+    trace = tracer.start()
+    db.add_download_by_link("magnet:?xt=urn:btih:testlink", "test_user_category")
+    tracer.finish(trace, '/add_magnet_link', 'POST', 200)
+    tracer.stop()
+
+    assert [(span['name'], span['parent']) for span in trace.spans] == [
+        ('qbittorrent.add_download_by_link', None), ('qbittorrent.retry', 0), ('qbittorrent.login', 1),
+    ]
+    assert trace.spans[1]['status'] == 403
+
+
+def metric_value(name, *labelvalues):
+    # Current value of a counter/gauge, or observation count of a histogram, in the global registry
+    total = 0.0
+    for key, value in REGISTRY.collect().items():
+        key_name, key_labels, extra = json.loads(key)
+        if key_name == name and key_labels == list(labelvalues) and extra != 'sum':
+            total += value
+    return total
+
+
+def test_torrent_db_metrics(mock_qb_client):
+    mock_qb_client.download_from_link.side_effect = [
+        requests.exceptions.HTTPError(response=Mock(status_code=403)),
+        "ok",
+        requests.exceptions.HTTPError(response=Mock(status_code=500)),
+    ]
+    before = {
+        'ok': metric_value('qbittorrent_call_duration_seconds', 'add_download_by_link', 'ok'),
+        'error': metric_value('qbittorrent_call_duration_seconds', 'add_download_by_link', 'error'),
+        'retries': metric_value('qbittorrent_session_events_total', 'retries'),
+        'logins': metric_value('qbittorrent_session_events_total', 'logins'),
+    }
+
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+    db.add_download_by_link("magnet:?xt=urn:btih:testlink", "user")
+    with pytest.raises(requests.exceptions.HTTPError):
+        db.add_download_by_link("magnet:?xt=urn:btih:testlink", "user")
+
+    assert metric_value('qbittorrent_call_duration_seconds', 'add_download_by_link', 'ok') == before['ok'] + 1
+    assert metric_value('qbittorrent_call_duration_seconds', 'add_download_by_link', 'error') == before['error'] + 1
+    assert metric_value('qbittorrent_session_events_total', 'retries') == before['retries'] + 1
+    assert metric_value('qbittorrent_session_events_total', 'logins') == before['logins'] + 2
+    assert metric_value('qbittorrent_calls_in_progress', 'add_download_by_link') == 0
+
+
 def test_add_download_by_link_non_403_error(mock_qb_client):
     # Simulate a non-403 HTTPError
     mock_qb_client.download_from_link.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=500))
@@ -138,69 +204,1031 @@ def test_add_download_by_link_retry_second_download_fails(mock_qb_client):
 
 # Tests for add_download_by_file
 def test_add_download_by_file_retry_success(mock_qb_client):
-    mock_qb_client.download_from_file.side_effect = [
-        requests.exceptions.HTTPError(response=Mock(status_code=403)),
-        "success_value_file"
-    ]
+    sent_bodies = []
+
+    def post_side_effect(endpoint, data, headers):
+        sent_bodies.append(data.read())
+        if len(sent_bodies) == 1:
+            raise requests.exceptions.HTTPError(response=Mock(status_code=403))
+        return "success_value_file"
 
+    mock_qb_client._post.side_effect = post_side_effect
     db = TorrentDB("http://testurl", "testuser", "testpass")
-    mock_file_descriptor = Mock()  # Simulate a file descriptor or path
-    result = db.add_download_by_file(mock_file_descriptor, "test_user_category_file")
+    result = db.add_download_by_file(io.BytesIO(b"torrent content"), "test_user_category_file")
 
     assert result == "success_value_file"
     assert mock_qb_client.login.call_count == 2
-    assert mock_qb_client.download_from_file.call_count == 2
-    expected_savepath = BASE_SAVE_PATH + "test_user_category_file"
-    calls = mock_qb_client.download_from_file.call_args_list
-    assert calls[0] == call(mock_file_descriptor, category="test_user_category_file", savepath=expected_savepath)
-    assert calls[1] == call(mock_file_descriptor, category="test_user_category_file", savepath=expected_savepath)
+    assert mock_qb_client._post.call_count == 2
+    mock_qb_client.download_from_file.assert_not_called()
+    assert sent_bodies[0] == sent_bodies[1]
+    assert b"torrent content" in sent_bodies[0]
+    assert (BASE_SAVE_PATH + "test_user_category_file").encode() in sent_bodies[0]
 
 
 def test_add_download_by_file_non_403_error(mock_qb_client):
-
-
-    mock_qb_client.download_from_file.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=401))  # Unauthorized
+    mock_qb_client._post.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=401))  # Unauthorized
 
     db = TorrentDB("http://testurl", "testuser", "testpass")
-    mock_file_descriptor = Mock() # Simulate a file descriptor or path
 
     with pytest.raises(requests.exceptions.HTTPError) as excinfo:
-        db.add_download_by_file(mock_file_descriptor, "test_user_category_file")
+        db.add_download_by_file(io.BytesIO(b"torrent content"), "test_user_category_file")
     assert excinfo.value.response.status_code == 401
     assert mock_qb_client.login.call_count == 1
-    assert mock_qb_client.download_from_file.call_count == 1
+    assert mock_qb_client._post.call_count == 1
 
 
 def test_add_download_by_file_retry_login_fails(mock_qb_client):
-    mock_qb_client.download_from_file.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=403))
+    mock_qb_client._post.side_effect = requests.exceptions.HTTPError(response=Mock(status_code=403))
     mock_qb_client.login.side_effect = [
         None, # Initial __init__ login
         requests.exceptions.HTTPError(response=Mock(status_code=403)) # Retry login
     ]
 
     db = TorrentDB("http://testurl", "testuser", "testpass")
-    mock_file_descriptor = Mock()
 
     with pytest.raises(requests.exceptions.HTTPError) as excinfo:
-        db.add_download_by_file(mock_file_descriptor, "test_user_category_file")
+        db.add_download_by_file(io.BytesIO(b"torrent content"), "test_user_category_file")
 
     assert excinfo.value.response.status_code == 403  # Error from login
     assert mock_qb_client.login.call_count == 2
-    assert mock_qb_client.download_from_file.call_count == 1
+    assert mock_qb_client._post.call_count == 1
 
 
 def test_add_download_by_file_retry_second_download_fails(mock_qb_client):
-    mock_qb_client.download_from_file.side_effect = [
+    mock_qb_client._post.side_effect = [
         requests.exceptions.HTTPError(response=Mock(status_code=403)),
         requests.exceptions.HTTPError(response=Mock(status_code=403))
     ]
 
     db = TorrentDB("http://testurl", "testuser", "testpass")
-    mock_file_descriptor = Mock()
 
     with pytest.raises(requests.exceptions.HTTPError) as excinfo:
-        db.add_download_by_file(mock_file_descriptor, "test_user_category_file")
+        db.add_download_by_file(io.BytesIO(b"torrent content"), "test_user_category_file")
 
     assert excinfo.value.response.status_code == 403  # Error from second download
     assert mock_qb_client.login.call_count == 2
-    assert mock_qb_client.download_from_file.call_count == 2
+    assert mock_qb_client._post.call_count == 2
+
+
+# Tests for add_downloads_by_links
+def test_add_downloads_by_links_single_request(mock_qb_client):
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+    links = ["magnet:?xt=urn:btih:one", "magnet:?xt=urn:btih:two", "magnet:?xt=urn:btih:one"]
+    db.add_downloads_by_links(links, "test_user_category")
+
+    expected_savepath = BASE_SAVE_PATH + "test_user_category"
+    mock_qb_client.download_from_link.assert_called_once_with(
+        ["magnet:?xt=urn:btih:one", "magnet:?xt=urn:btih:two"],
+        category="test_user_category", savepath=expected_savepath
+    )
+
+
+def test_add_downloads_by_links_empty(mock_qb_client):
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+    assert db.add_downloads_by_links([], "test_user_category") is None
+    mock_qb_client.download_from_link.assert_not_called()
+
+
+def test_add_downloads_by_links_retry_success(mock_qb_client):
+    mock_qb_client.download_from_link.side_effect = [
+        requests.exceptions.HTTPError(response=Mock(status_code=403)),
+        "Ok."
+    ]
+
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+    result = db.add_downloads_by_links(["magnet:?xt=urn:btih:one"], "test_user_category")
+
+    assert result == "Ok."
+    assert mock_qb_client.login.call_count == 2
+    assert mock_qb_client.download_from_link.call_count == 2
+
+
+# Tests for MultipartStream and add_downloads_by_files
+def _parse_multipart(body):
+    from werkzeug.formparser import parse_form_data
+    from werkzeug.test import EnvironBuilder
+    environ = EnvironBuilder(method='POST', data=body.read(), content_type=body.content_type).get_environ()
+    _, form, files = parse_form_data(environ)
+    return form, files
+
+
+def test_multipart_stream_encodes_fields_and_files():
+    files = [('torrents', 'a.torrent', io.BytesIO(b"first" * 1000)), ('torrents', 'b"x.torrent', io.BytesIO(b"second"))]
+    body = MultipartStream({'category': 'cat', 'savepath': '/tmp/cat'}, files)
+    expected_length = len(body)
+
+    form, parsed_files = _parse_multipart(body)
+
+    assert form['category'] == 'cat'
+    assert form['savepath'] == '/tmp/cat'
+    uploaded = parsed_files.getlist('torrents')
+    assert [f.read() for f in uploaded] == [b"first" * 1000, b"second"]
+    body.rewind()
+    assert len(b"".join(iter(body))) == expected_length
+
+
+def test_multipart_stream_reads_in_bounded_chunks():
+    stream = io.BytesIO(b"x" * 100000)
+    body = MultipartStream({}, [('torrents', 'big.torrent', stream)])
+    chunks = []
+    while True:
+        chunk = body.read(4096)
+        if not chunk:
+            break
+        assert len(chunk) <= 4096
+        chunks.append(chunk)
+    assert sum(len(c) for c in chunks) == len(body)
+
+
+def test_multipart_stream_sends_spooled_files_from_mmap():
+    import tempfile
+    import tracemalloc
+    content = os.urandom(4 * 1024 * 1024)
+    with tempfile.SpooledTemporaryFile(max_size=1024) as spooled:
+        spooled.write(content)
+        spooled.seek(0)
+        with MultipartStream({'category': 'cat'}, [('torrents', 'big.torrent', spooled)]) as body:
+            tracemalloc.start()
+            try:
+                chunks = [chunk for chunk in iter(lambda: body.read(256 * 1024), b'')]
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            # Slices of the mapped temp file, not copies in this process's heap
+            assert any(isinstance(chunk, memoryview) for chunk in chunks)
+            assert peak < 256 * 1024
+            assert b''.join(chunks).count(content) == 1
+            del chunks
+        assert body._mapped == {}
+        assert spooled.tell() == 0
+
+
+def test_add_downloads_by_files_batches(mock_qb_client):
+    mock_qb_client._post.return_value = "Ok."
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+    files = [('%d.torrent' % i, io.BytesIO(b"content %d" % i)) for i in range(5)]
+
+    results = db.add_downloads_by_files(files, "test_user_category", batch_size=2)
+
+    assert results == ["Ok."] * 5
+    assert mock_qb_client._post.call_count == 3
+    args, kwargs = mock_qb_client._post.call_args_list[0]
+    assert args[0] == 'torrents/add'
+    form, parsed_files = _parse_multipart(kwargs['data'])
+    assert form['category'] == "test_user_category"
+    assert form['savepath'] == BASE_SAVE_PATH + "test_user_category"
+    assert [f.filename for f in parsed_files.getlist('torrents')] == ['0.torrent', '1.torrent']
+    assert kwargs['headers']['Content-Type'] == kwargs['data'].content_type
+
+
+def test_add_downloads_by_files_failed_batch(mock_qb_client):
+    error = requests.exceptions.HTTPError(response=Mock(status_code=500))
+    mock_qb_client._post.side_effect = ["Ok.", error]
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+    files = [('%d.torrent' % i, io.BytesIO(b"content")) for i in range(3)]
+
+    results = db.add_downloads_by_files(files, "test_user_category", batch_size=2)
+
+    assert results == ["Ok.", "Ok.", error]
+
+
+def test_add_downloads_by_files_retry_resends_body(mock_qb_client):
+    sent_bodies = []
+
+    def post_side_effect(endpoint, data, headers):
+        sent_bodies.append(data.read())
+        if len(sent_bodies) == 1:
+            raise requests.exceptions.HTTPError(response=Mock(status_code=403))
+        return "Ok."
+
+    mock_qb_client._post.side_effect = post_side_effect
+    db = TorrentDB("http://testurl", "testuser", "testpass")
+
+    results = db.add_downloads_by_files([('a.torrent', io.BytesIO(b"content"))], "test_user_category")
+
+    assert results == ["Ok."]
+    assert mock_qb_client.login.call_count == 2
+    assert sent_bodies[0] == sent_bodies[1]
+
+
+# Tests for AsyncTorrentDB
+def _async_db_with_transport(handler):
+    import httpx
+    db = AsyncTorrentDB("http://testurl", "testuser", "testpass")
+    db.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return db
+
+
+def test_async_add_download_by_link_logs_in_first():
+    seen = []
+
+    def handler(request):
+        seen.append(request.url.path)
+        if request.url.path.endswith('auth/login'):
+            return httpx_response(200, "Ok.")
+        return httpx_response(200, "Ok.")
+
+    db = _async_db_with_transport(handler)
+    result = asyncio.run(db.add_download_by_link("magnet:?xt=urn:btih:async", "test_user_category"))
+
+    assert result == "Ok."
+    assert seen == ['/api/v2/auth/login', '/api/v2/torrents/add']
+
+
+def test_async_add_download_by_link_retry_on_403():
+    calls = {'add': 0, 'login': 0, 'bodies': []}
+
+    def handler(request):
+        if request.url.path.endswith('auth/login'):
+            calls['login'] += 1
+            return httpx_response(200, "Ok.")
+        calls['add'] += 1
+        calls['bodies'].append(request.read())
+        if calls['add'] == 1:
+            return httpx_response(403, "Forbidden")
+        return httpx_response(200, "Ok.")
+
+    db = _async_db_with_transport(handler)
+    result = asyncio.run(db.add_download_by_link("magnet:?xt=urn:btih:async", "test_user_category"))
+
+    assert result == "Ok."
+    assert calls['login'] == 2
+    assert calls['add'] == 2
+    assert calls['bodies'][0] == calls['bodies'][1]
+    assert b"magnet:?xt=urn:btih:async" in calls['bodies'][0]
+    assert (BASE_SAVE_PATH + "test_user_category").encode() in calls['bodies'][0]
+
+
+def test_async_concurrent_403s_share_one_relogin():
+    session = {'valid': False, 'logins': 0, 'adds': 0}
+
+    async def handler(request):
+        # Slow answers, so all the adds are in flight when the SID expires
+        if request.url.path.endswith('auth/login'):
+            session['logins'] += 1
+            session['valid'] = True
+            await asyncio.sleep(0.01)
+            return httpx_response(200, "Ok.")
+        session['adds'] += 1
+        valid = session['valid']
+        await asyncio.sleep(0.01)
+        return httpx_response(200, "Ok.") if valid else httpx_response(403, "Forbidden")
+
+    db = _async_db_with_transport(handler)
+
+    async def expire_then_add():
+        await db.login()
+        session['valid'] = False  # qBittorrent dropped the SID
+        return await asyncio.gather(*(
+            db.add_download_by_link("magnet:?xt=urn:btih:async%d" % i, "user") for i in range(5)
+        ))
+
+    assert asyncio.run(expire_then_add()) == ["Ok."] * 5
+    assert session['logins'] == 2
+    assert session['adds'] == 10
+
+
+def test_async_add_download_by_link_counted_once(monkeypatch):
+    import torrent_lib
+    observed = []
+    monkeypatch.setattr(torrent_lib.QB_CALL_SECONDS, "observe", lambda value, name, outcome: observed.append(name))
+    db = _async_db_with_transport(lambda request: httpx_response(200, "Ok."))
+
+    asyncio.run(db.add_download_by_link("magnet:?xt=urn:btih:async", "user"))
+
+    assert observed == ['add_download_by_link']
+
+
+def test_async_add_download_by_link_non_403_error():
+    import httpx
+
+    def handler(request):
+        if request.url.path.endswith('auth/login'):
+            return httpx_response(200, "Ok.")
+        return httpx_response(500, "Internal error")
+
+    db = _async_db_with_transport(handler)
+    with pytest.raises(httpx.HTTPStatusError) as excinfo:
+        asyncio.run(db.add_download_by_link("magnet:?xt=urn:btih:async", "test_user_category"))
+    assert excinfo.value.response.status_code == 500
+
+
+def test_async_circuit_opens_on_server_errors():
+    import httpx
+    adds = []
+
+    def handler(request):
+        if request.url.path.endswith('auth/login'):
+            return httpx_response(200, "Ok.")
+        adds.append(request)
+        return httpx_response(502, "Bad gateway")
+
+    db = _async_db_with_transport(handler)
+    db.breaker.failure_threshold = 2
+
+    async def add_three():
+        for i in range(2):
+            with pytest.raises(httpx.HTTPStatusError):
+                await db.add_download_by_link("magnet:?xt=urn:btih:async%d" % i, "user")
+        with pytest.raises(CircuitOpenError):
+            await db.add_download_by_link("magnet:?xt=urn:btih:async_rejected", "user")
+
+    asyncio.run(add_three())
+    assert len(adds) == 2
+    assert db.breaker.state == CircuitBreaker.OPEN
+
+
+def test_async_add_downloads_by_files_batches():
+    bodies = []
+
+    def handler(request):
+        if request.url.path.endswith('auth/login'):
+            return httpx_response(200, "Ok.")
+        bodies.append(request.read())
+        assert int(request.headers['Content-Length']) == len(bodies[-1])
+        return httpx_response(200, "Ok.")
+
+    db = _async_db_with_transport(handler)
+    files = [('%d.torrent' % i, io.BytesIO(b"async content %d" % i)) for i in range(3)]
+    results = asyncio.run(db.add_downloads_by_files(files, "test_user_category", batch_size=2))
+
+    assert results == ["Ok."] * 3
+    assert len(bodies) == 2
+    assert b"async content 0" in bodies[0] and b"async content 1" in bodies[0]
+    assert b"async content 2" in bodies[1]
+
+
+def httpx_response(status_code, text):
+    import httpx
+    return httpx.Response(status_code, text=text)
+
+
+# Tests against a local stand-in qBittorrent server (no mocks)
+@pytest.fixture
+def fake_qb():
+    with FakeQBittorrent(username="testuser", password="testpass") as server:
+        yield server
+
+
+def test_connections_reused_across_adds(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass")
+    db.add_download_by_link("magnet:?xt=urn:btih:warmup", "test_user_category")
+    connections_after_warmup = fake_qb.connections
+
+    for i in range(20):
+        db.add_download_by_link("magnet:?xt=urn:btih:%d" % i, "test_user_category")
+    db.add_downloads_by_files([('a.torrent', io.BytesIO(b"content"))], "test_user_category")
+
+    assert fake_qb.connections == connections_after_warmup
+    assert len(fake_qb.added) == 22
+    assert fake_qb.added[-1]['files'] == [('a.torrent', b"content")]
+    assert fake_qb.added[-1]['savepath'] == BASE_SAVE_PATH + "test_user_category"
+
+
+def test_connections_reused_after_relogin(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass")
+    db.add_download_by_link("magnet:?xt=urn:btih:warmup", "test_user_category")
+    connections_after_warmup = fake_qb.connections
+
+    fake_qb.expire_sessions()
+    db.add_download_by_link("magnet:?xt=urn:btih:after_expiry", "test_user_category")
+    db.add_download_by_link("magnet:?xt=urn:btih:after_expiry_2", "test_user_category")
+
+    # The re-login and the adds all go over the pooled connection
+    assert fake_qb.connections == connections_after_warmup
+    assert fake_qb.added[-1]['urls'] == ["magnet:?xt=urn:btih:after_expiry_2"]
+
+
+def test_large_spooled_upload_arrives_intact(fake_qb):
+    import tempfile
+    content = os.urandom(3 * 1024 * 1024)
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", background_refresh=False)
+    with tempfile.SpooledTemporaryFile(max_size=1024) as spooled:
+        spooled.write(content)
+        spooled.seek(0)
+        db.add_download_by_file(spooled, "test_user_category")
+        db.add_downloads_by_files([('big.torrent', spooled)], "test_user_category")
+    assert fake_qb.added[0]['files'] == [('upload.torrent', content)]
+    assert fake_qb.added[1]['files'] == [('big.torrent', content)]
+
+
+def test_hung_upstream_fails_fast(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", read_timeout=0.2)
+    fake_qb.add_delay = 1.0
+
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        db.add_download_by_link("magnet:?xt=urn:btih:slow", "test_user_category")
+    assert time.monotonic() - start < 1.0
+
+
+def test_hung_login_fails_fast(fake_qb):
+    fake_qb.login_delay = 2.0
+
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        TorrentDB(fake_qb.url, "testuser", "testpass", read_timeout=0.2)
+    assert time.monotonic() - start < 1.0
+
+    fake_qb.login_delay = 0.0
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", read_timeout=0.2)
+    assert db.session_live()
+
+
+def test_relogin_does_not_queue_behind_a_stuck_login(mock_qb_client):
+    from torrent_lib import UpstreamUnavailable
+    db = TorrentDB("http://testurl", "testuser", "testpass", connect_timeout=0.05, read_timeout=0.05)
+    with db._login_lock:  # Another thread's login hangs
+        start = time.monotonic()
+        with pytest.raises(UpstreamUnavailable):
+            db._relogin(db._session_generation)
+        assert time.monotonic() - start < 0.5
+    assert db._relogin(db._session_generation)
+
+
+def test_pool_configuration(mock_qb_client):
+    db = TorrentDB("http://testurl", "testuser", "testpass", pool_maxsize=4, max_retries=2, backoff_factor=0.1)
+
+    assert db.adapter._pool_maxsize == 4
+    assert db.adapter.max_retries.connect == 2
+    assert db.adapter.max_retries.read == 0
+    assert db.adapter.max_retries.backoff_factor == 0.1
+    mock_qb_client.session.mount.assert_any_call('http://', db.adapter)
+
+
+# Tests for session management
+def test_idle_session_expiry_is_recovered(fake_qb):
+    fake_qb.session_ttl = 0.2
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", session_ttl=0, background_refresh=False)
+    db.add_download_by_link("magnet:?xt=urn:btih:first", "user")
+    time.sleep(0.3)
+    db.add_download_by_link("magnet:?xt=urn:btih:second", "user")
+
+    assert [add['urls'] for add in fake_qb.added] == [["magnet:?xt=urn:btih:first"], ["magnet:?xt=urn:btih:second"]]
+    assert db.session_stats()['relogins_after_403'] == 1
+
+
+def test_injected_failures(fake_qb):
+    fake_qb.failure_rate = 1.0
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", background_refresh=False)
+    with pytest.raises(requests.exceptions.HTTPError) as excinfo:
+        db.add_download_by_link("magnet:?xt=urn:btih:fails", "user")
+    assert excinfo.value.response.status_code == 500
+    assert fake_qb.failures == 1
+    assert fake_qb.added == []
+
+
+def test_concurrent_relogins_are_coalesced(fake_qb):
+    import threading
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", pool_maxsize=10)
+    db.add_download_by_link("magnet:?xt=urn:btih:warmup", "test_user_category")
+    fake_qb.expire_sessions()
+    barrier = threading.Barrier(8)
+
+    def add(i):
+        barrier.wait()
+        db.add_download_by_link("magnet:?xt=urn:btih:%d" % i, "test_user_category")
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    logins = [r for r in fake_qb.requests if r == ('POST', '/api/v2/auth/login')]
+    assert len(logins) == 2  # initial login + one coalesced re-login
+    assert db.stats['logins'] == 2
+    assert db.stats['relogins_after_403'] == 1
+    assert db.stats['retries'] >= 1
+    assert len(fake_qb.added) == 9
+
+
+def test_idle_session_refreshed_before_call(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass",
+                   session_ttl=0.2, refresh_margin=0.1, background_refresh=False)
+    time.sleep(0.15)
+    fake_qb.expire_sessions()  # qBittorrent dropped the idle SID
+
+    db.add_download_by_link("magnet:?xt=urn:btih:idle", "test_user_category")
+
+    # No failed torrents/add round trip: the session was refreshed up front
+    assert [r for r in fake_qb.requests if r[1] == '/api/v2/torrents/add'] == [('POST', '/api/v2/torrents/add')]
+    assert db.stats['proactive_refreshes'] == 1
+    assert db.stats['retries'] == 0
+
+
+def test_background_refresh(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", session_ttl=0.3, refresh_margin=0.2)
+    try:
+        deadline = time.monotonic() + 2
+        while db.stats['proactive_refreshes'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        db.close()
+
+    assert db.stats['proactive_refreshes'] >= 1
+    assert db.stats['logins'] == 1 + db.stats['proactive_refreshes']
+
+
+def test_session_stats(mock_qb_client):
+    mock_qb_client.download_from_link.side_effect = [
+        requests.exceptions.HTTPError(response=Mock(status_code=403)),
+        "Ok."
+    ]
+    db = TorrentDB("http://testurl", "testuser", "testpass", background_refresh=False)
+    db.add_download_by_link("magnet:?xt=urn:btih:stats", "test_user_category")
+
+    stats = db.session_stats()
+    assert stats['logins'] == 2
+    assert stats['retries'] == 1
+    assert stats['relogins_after_403'] == 1
+    assert stats['session_age'] < 1
+
+
+# Tests for TorrentStateCache
+def test_state_cache_applies_deltas():
+    db = Mock()
+    db.sync_maindata.side_effect = [
+        {'rid': 1, 'full_update': True, 'torrents': {
+            'aaa': {'name': 'A', 'category': 'alice', 'progress': 0.1},
+            'bbb': {'name': 'B', 'category': 'bob', 'progress': 0.5},
+        }},
+        {'rid': 2, 'torrents': {'aaa': {'progress': 0.7}, 'ccc': {'name': 'C', 'category': 'alice'}}},
+        {'rid': 3, 'torrents': {'bbb': {'category': 'alice'}}, 'torrents_removed': ['aaa']},
+    ]
+    removed = []
+    cache = TorrentStateCache(db, on_removed=removed.extend)
+
+    cache.sync_once()
+    assert [t['name'] for t in cache.torrents_for_category('alice')] == ['A']
+    assert cache.rid == 1
+
+    cache.sync_once()
+    assert cache.get('aaa') == {'hash': 'aaa', 'name': 'A', 'category': 'alice', 'progress': 0.7}
+    assert sorted(t['name'] for t in cache.torrents_for_category('alice')) == ['A', 'C']
+
+    cache.sync_once()
+    assert sorted(t['name'] for t in cache.torrents_for_category('alice')) == ['B', 'C']
+    assert cache.torrents_for_category('bob') == []
+    assert cache.get('aaa') is None
+    assert len(cache) == 2
+    assert [c.args for c in db.sync_maindata.call_args_list] == [(0,), (1,), (2,)]
+    assert removed == ['aaa']
+
+
+def test_state_cache_full_update_resets():
+    db = Mock()
+    db.sync_maindata.side_effect = [
+        {'rid': 5, 'full_update': True, 'torrents': {'aaa': {'name': 'A', 'category': 'alice'}}},
+        {'rid': 1, 'full_update': True, 'torrents': {'bbb': {'name': 'B', 'category': 'alice'}}},
+    ]
+    removed = []
+    cache = TorrentStateCache(db, on_removed=removed.extend)
+    cache.sync_once()
+    cache.sync_once()
+
+    assert [t['hash'] for t in cache.torrents_for_category('alice')] == ['bbb']
+    assert cache.rid == 1
+    assert removed == ['aaa']
+
+
+def test_state_cache_versions_change_with_the_category():
+    db = Mock()
+    db.sync_maindata.side_effect = [
+        {'rid': 1, 'full_update': True, 'torrents': {'aaa': {'category': 'alice'}, 'bbb': {'category': 'bob'}}},
+        {'rid': 2, 'torrents': {'aaa': {'progress': 0.5}}},
+        {'rid': 3, 'torrents': {'bbb': {'category': 'alice'}}},
+        {'rid': 4, 'torrents_removed': ['aaa']},
+    ]
+    cache = TorrentStateCache(db)
+    versions = []
+    for _ in range(4):
+        cache.sync_once()
+        versions.append((cache.version('alice'), cache.version('bob')))
+
+    alice, bob = zip(*versions)
+    assert len(set(alice)) == 4
+    assert bob[0] == bob[1] != bob[2] == bob[3]
+    assert cache.version('carol') == (1, 0)
+
+
+def test_state_cache_tracks_category_sizes():
+    db = Mock()
+    db.sync_maindata.side_effect = [
+        {'rid': 1, 'full_update': True, 'torrents': {
+            'aaa': {'category': 'alice', 'size': 100},
+            'bbb': {'category': 'alice', 'total_size': 50},
+            'ccc': {'category': 'bob', 'size': 7},
+        }},
+        {'rid': 2, 'torrents': {'aaa': {'size': 40}, 'ccc': {'category': 'alice'}}},
+        {'rid': 3, 'torrents_removed': ['bbb']},
+        {'rid': 1, 'full_update': True, 'torrents': {'ddd': {'category': 'bob', 'size': 1}}},
+    ]
+    cache = TorrentStateCache(db)
+    sizes = []
+    for _ in range(4):
+        cache.sync_once()
+        sizes.append((cache.category_size('alice'), cache.category_size('bob')))
+    assert sizes == [(150, 7), (97, 0), (47, 0), (0, 1)]
+
+
+def test_state_cache_against_fake_qbittorrent(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", background_refresh=False)
+    fake_qb.torrents = [{'hash': 'abc', 'name': 'Fake', 'category': 'test_user_category'}]
+    cache = TorrentStateCache(db)
+
+    cache.sync_once()
+
+    assert cache.torrents_for_category('test_user_category') == [
+        {'hash': 'abc', 'name': 'Fake', 'category': 'test_user_category'}
+    ]
+
+
+# Tests for TorrentStateCache subscriptions
+def make_subscribed_cache():
+    cache = TorrentStateCache(MagicMock())
+    cache.apply({'rid': 1, 'full_update': True, 'torrents': {
+        'aaa': {'name': 'A', 'category': 'alice', 'progress': 0.5},
+        'bbb': {'name': 'B', 'category': 'bob', 'progress': 0.1},
+    }})
+    return cache
+
+
+def test_subscription_starts_with_snapshot_then_gets_changes():
+    cache = make_subscribed_cache()
+    alice = cache.subscribe('alice')
+    bob = cache.subscribe('bob')
+    assert alice.wait(0) == [{'type': 'snapshot',
+                              'torrents': [{'hash': 'aaa', 'name': 'A', 'category': 'alice', 'progress': 0.5}]}]
+    bob.wait(0)
+
+    cache.apply({'rid': 2, 'torrents': {'aaa': {'progress': 1.0}, 'ccc': {'name': 'C', 'category': 'alice', 'progress': 0}}})
+    assert alice.wait(0) == [
+        {'type': 'update', 'hash': 'aaa', 'changes': {'progress': 1.0}},
+        {'type': 'completed', 'hash': 'aaa', 'name': 'A'},
+        {'type': 'update', 'hash': 'ccc', 'changes': {'name': 'C', 'category': 'alice', 'progress': 0}},
+    ]
+    assert bob.wait(0) == []
+
+    cache.apply({'rid': 3, 'torrents_removed': ['ccc'], 'torrents': {'bbb': {'category': 'alice'}}})
+    assert alice.wait(0) == [
+        {'type': 'update', 'hash': 'bbb', 'changes': {'hash': 'bbb', 'name': 'B', 'category': 'alice', 'progress': 0.1}},
+        {'type': 'removed', 'hash': 'ccc'},
+    ]
+    assert bob.wait(0) == [{'type': 'removed', 'hash': 'bbb'}]
+
+
+def test_subscription_resyncs_after_full_update_or_overflow():
+    cache = make_subscribed_cache()
+    alice = cache.subscribe('alice', max_pending=2)
+    alice.wait(0)
+    for i in range(3):
+        cache.apply({'rid': 2 + i, 'torrents': {'aaa': {'progress': 0.6 + i / 10}}})
+    assert alice.wait(0) == [{'type': 'snapshot', 'torrents': cache.torrents_for_category('alice')}]
+
+    cache.apply({'rid': 10, 'full_update': True, 'torrents': {'ddd': {'name': 'D', 'category': 'alice'}}})
+    assert alice.wait(0) == [{'type': 'snapshot', 'torrents': [{'hash': 'ddd', 'name': 'D', 'category': 'alice'}]}]
+
+
+def test_subscription_wait_blocks_until_an_event():
+    cache = make_subscribed_cache()
+    alice = cache.subscribe('alice')
+    alice.wait(0)
+    started = time.monotonic()
+    assert alice.wait(0.05) == []
+    assert time.monotonic() - started >= 0.05
+
+    timer = threading.Timer(0.05, cache.apply, [{'rid': 2, 'torrents': {'aaa': {'progress': 0.7}}}])
+    timer.start()
+    assert alice.wait(5) == [{'type': 'update', 'hash': 'aaa', 'changes': {'progress': 0.7}}]
+
+    alice.close()
+    assert cache.subscriber_count() == 0
+
+
+def test_subscription_wait_async():
+    cache = make_subscribed_cache()
+
+    async def scenario():
+        alice = cache.subscribe('alice')
+        assert (await alice.wait_async(0))[0]['type'] == 'snapshot'
+        assert await alice.wait_async(0.01) == []
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.02, lambda: threading.Thread(
+            target=cache.apply, args=({'rid': 2, 'torrents': {'aaa': {'progress': 0.9}}},)).start())
+        return await alice.wait_async(5)
+
+    assert asyncio.run(scenario()) == [{'type': 'update', 'hash': 'aaa', 'changes': {'progress': 0.9}}]
+
+
+# Tests for InfoHashIndex
+def test_info_hash_index_lru_eviction():
+    index = InfoHashIndex(max_size=2)
+    index.add("AAA")
+    index.add("bbb")
+    assert "aaa" in index  # Refreshes 'aaa', so 'bbb' is now least recently used
+    index.add("ccc")
+
+    assert "aaa" in index
+    assert "bbb" not in index
+    assert "ccc" in index
+    assert len(index) == 2
+
+
+def test_info_hash_index_ttl():
+    index = InfoHashIndex(ttl=0.05)
+    index.add("aaa")
+    assert "aaa" in index
+    time.sleep(0.1)
+    assert "aaa" not in index
+    assert None not in index
+
+
+def test_info_hash_index_seed():
+    index = InfoHashIndex()
+    index.seed([{'hash': 'AAA', 'name': 'A'}, {'name': 'no hash'}])
+    assert "aaa" in index
+    assert len(index) == 1
+
+
+def test_info_hash_index_replace_drops_removed_torrents():
+    index = InfoHashIndex()
+    index.seed([{'hash': 'aaa'}, {'hash': 'bbb'}])
+    started_at = time.monotonic()
+    index.add('ccc')  # Added while the list was being fetched
+    index.replace([{'hash': 'BBB'}], started_at)
+    assert 'aaa' not in index
+    assert 'bbb' in index
+    assert 'ccc' in index
+
+
+# Tests for MagnetCache
+def test_magnet_cache_remembers_names_by_info_hash():
+    cache = MagnetCache(max_size=2)
+    named = cache.resolve("magnet:?xt=urn:btih:c12fe1c06bba254a9dc9f519b335aa7c1367a88a&dn=Example&xl=10")
+    # The base32 form of the same info-hash, without a name
+    bare = cache.resolve("magnet:?xt=urn:btih:YEX6DQDLXISUVHOJ6UM3GNNKPQJWPKEK")
+    assert bare == named == ("c12fe1c06bba254a9dc9f519b335aa7c1367a88a", "Example", 10)
+    assert cache.resolve("magnet:?dn=no+hash") == (None, "no hash", None)
+    assert cache.resolve("https://example.com/") is None
+
+    cache.resolve("magnet:?xt=urn:btih:%040x" % 1)
+    cache.resolve("magnet:?xt=urn:btih:%040x" % 2)
+    assert len(cache) == 2
+    assert cache.resolve("magnet:?xt=urn:btih:c12fe1c06bba254a9dc9f519b335aa7c1367a88a").name is None
+
+
+# Tests for TorrentPool, against several local stand-in qBittorrent servers
+@pytest.fixture
+def fake_qbs():
+    with ExitStack() as stack:
+        yield [stack.enter_context(FakeQBittorrent(username="testuser", password="testpass")) for _ in range(3)]
+
+
+def make_pool(urls, **kwargs):
+    kwargs.setdefault('health_interval', 0)
+    return TorrentPool(
+        [(url, lambda url=url: TorrentDB(url, "testuser", "testpass", max_retries=0, connect_timeout=1,
+                                         background_refresh=False)) for url in urls],
+        **kwargs,
+    )
+
+
+def make_torrent(name):
+    name = name.encode('utf-8')
+    info = b"d6:lengthi10e4:name%d:%s12:piece lengthi16384e6:pieces20:" % (len(name), name) + b"p" * 20 + b"e"
+    return b"d8:announce14:http://tracker4:info" + info + b"e"
+
+
+def added_urls(fake):
+    return [url for add in fake.added for url in add['urls']]
+
+
+def test_pool_hash_placement_is_stable(fake_qbs):
+    pool = make_pool([fake.url for fake in fake_qbs])
+    links = ["magnet:?xt=urn:btih:%040x" % i for i in range(30)]
+    for link in links:
+        pool.add_download_by_link(link, "user1")
+    placed = {link: fake.url for fake in fake_qbs for link in added_urls(fake)}
+    assert len(placed) == 30
+    assert all(added_urls(fake) for fake in fake_qbs)
+
+    # The same torrent goes to the same backend again, also in a batch
+    pool.add_downloads_by_links(links[:10], "user2")
+    for fake in fake_qbs:
+        batch_urls = [url for add in fake.added if add['category'] == "user2" for url in add['urls']]
+        assert all(placed[url] == fake.url for url in batch_urls)
+    assert sum(1 for fake in fake_qbs for add in fake.added if add['category'] == "user2") <= 3
+
+
+def test_consistent_hash_moves_few_torrents_when_a_backend_is_added():
+    class Backend():
+        def __init__(self, name):
+            self.name = name
+
+    backends = [Backend(f"qb{i}") for i in range(4)]
+    placement = ConsistentHashPlacement()
+    keys = ["%040x" % i for i in range(2000)]
+    before = {key: placement.order(backends[:3], key, None)[0].name for key in keys}
+    after = {key: placement.order(backends, key, None)[0].name for key in keys}
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(after[key] == "qb3" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+
+
+def test_pool_user_placement(fake_qbs):
+    pool = make_pool([fake.url for fake in fake_qbs], placement=UserPlacement())
+    for i in range(10):
+        pool.add_download_by_link("magnet:?xt=urn:btih:%040x" % i, "user1")
+    assert sorted(len(fake.added) for fake in fake_qbs) == [0, 0, 10]
+
+
+def test_pool_least_loaded_placement(fake_qbs):
+    fake_qbs[0].torrents = [{'hash': 'a'}, {'hash': 'b'}]
+    fake_qbs[1].torrents = [{'hash': 'c'}]
+    fake_qbs[2].torrents = [{'hash': 'd'}, {'hash': 'e'}, {'hash': 'f'}]
+    pool = make_pool([fake.url for fake in fake_qbs], placement=LeastLoadedPlacement())
+    assert [status['active_torrents'] for status in pool.status().values()] == [2, 1, 3]
+
+    for i in range(3):
+        pool.add_download_by_link("magnet:?xt=urn:btih:%040x" % i, "user1")
+    # Placed adds count towards the load until the next health check
+    assert [len(fake.added) for fake in fake_qbs] == [1, 2, 0]
+
+
+def test_pool_fails_over_on_connection_error(fake_qbs):
+    pool = make_pool([fake.url for fake in fake_qbs])
+    link = next("magnet:?xt=urn:btih:%040x" % i for i in range(100)
+                if pool._candidates("%040x" % i, "user1")[0].name == fake_qbs[0].url)
+    failovers = metric_value('qbittorrent_backend_failovers_total', fake_qbs[0].url)
+    fake_qbs[0].stop()
+
+    pool.add_download_by_link(link, "user1")
+    assert sum(len(fake.added) for fake in fake_qbs[1:]) == 1
+    assert pool.status()[fake_qbs[0].url]['healthy'] is False
+    assert metric_value('qbittorrent_backend_failovers_total', fake_qbs[0].url) == failovers + 1
+
+    # Unhealthy backends are tried last, so later adds don't wait on them
+    pool.add_download_by_link(link + "&dn=again", "user1")
+    assert metric_value('qbittorrent_backend_failovers_total', fake_qbs[0].url) == failovers + 1
+
+
+def test_pool_files_keep_order_and_fail_over(fake_qbs):
+    pool = make_pool([fake.url for fake in fake_qbs[:2]])
+    fake_qbs[1].stop()
+    files = [(f"{i}.torrent", io.BytesIO(make_torrent(f"t{i}"))) for i in range(6)]
+    results = pool.add_downloads_by_files(files, "user1", batch_size=2)
+    assert results == ["Ok."] * 6
+    assert sorted(name for add in fake_qbs[0].added for name, _ in add['files']) == sorted(name for name, _ in files)
+    assert all(content.startswith(b"d8:announce") for add in fake_qbs[0].added for _, content in add['files'])
+
+
+def test_pool_starts_with_a_backend_down(fake_qbs):
+    fake_qbs[2].stop()
+    pool = make_pool([fake.url for fake in fake_qbs])
+    status = pool.status()
+    assert status[fake_qbs[0].url]['healthy'] and status[fake_qbs[1].url]['healthy']
+    assert status[fake_qbs[2].url]['healthy'] is False
+    assert pool.session_live()
+
+    fake_qbs[0].stop()
+    fake_qbs[1].stop()
+    with pytest.raises(NoBackendAvailable):
+        make_pool([fake.url for fake in fake_qbs])
+
+
+def test_pool_state_cache_merges_backends(fake_qbs):
+    pool = make_pool([fake.url for fake in fake_qbs[:2]])
+    fake_qbs[0].torrents = [{'hash': 'aaa', 'category': 'user1'}, {'hash': 'bbb', 'category': 'user1'}]
+    fake_qbs[1].torrents = [{'hash': 'ccc', 'category': 'user1'}]
+    cache = TorrentStateCache(pool)
+    cache.sync_once()
+    assert sorted(t['hash'] for t in cache.torrents_for_category('user1')) == ['aaa', 'bbb', 'ccc']
+
+    # The fake always answers with a full update; only the torrent it dropped goes
+    fake_qbs[0].torrents = [{'hash': 'aaa', 'category': 'user1'}]
+    cache.sync_once()
+    assert sorted(t['hash'] for t in cache.torrents_for_category('user1')) == ['aaa', 'ccc']
+    assert sorted(t['hash'] for t in pool.get_torrents()) == ['aaa', 'ccc']
+
+
+# Tests for the circuit breaker and bulkheads
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+
+def test_circuit_breaker_opens_and_recovers_through_half_open():
+    breaker = CircuitBreaker("qb", failure_threshold=2, reset_timeout=0.1)
+    breaker.record(0.01, requests.exceptions.ConnectionError("down"))
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record(0.01, requests.exceptions.ConnectionError("down"))
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.before_call()
+    assert 0 < excinfo.value.retry_after <= 0.1
+
+    # After the reset timeout a single probe goes through
+    time.sleep(0.15)
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.status() == {'state': 'closed', 'failures': 0, 'last_error': 'down'}
+
+
+def test_circuit_breaker_failed_probe_reopens():
+    breaker = CircuitBreaker("qb", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure("down")
+    time.sleep(0.1)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        with breaker.guard():
+            raise requests.exceptions.ReadTimeout("still down")
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.status()['retry_after'] > 0
+
+
+def test_circuit_breaker_counts_slow_calls_but_not_client_errors():
+    breaker = CircuitBreaker("qb", failure_threshold=2, slow_call_seconds=0.5)
+    breaker.record(0.1, http_error(415))
+    breaker.record(0.1, ValueError("not an upstream error"))
+    breaker.record(0.1, http_error(503))
+    assert breaker.failures == 1
+    breaker.record(0.1)
+    assert breaker.failures == 0
+
+    breaker.record(0.6)
+    breaker.record(0.7)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert "over the 0.5s limit" in breaker.last_error
+
+
+def test_circuit_breaker_ignores_unclassified_errors():
+    breaker = CircuitBreaker("qb", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure("down")
+    time.sleep(0.1)
+    with pytest.raises(TypeError):
+        with breaker.guard():
+            raise TypeError("bug in the caller")
+    # The probe neither closed the circuit nor used up the half-open call
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.failures == 1
+    breaker.before_call()
+
+
+def test_breaker_fails_fast_against_hung_upstream(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", read_timeout=0.2, background_refresh=False,
+                   breaker_options={'failure_threshold': 2, 'reset_timeout': 0.3})
+    fake_qb.add_delay = 1.0
+    for i in range(2):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            db.add_download_by_link("magnet:?xt=urn:btih:hung%d" % i, "user")
+    adds_sent = fake_qb.requests.count(('POST', '/api/v2/torrents/add'))
+    assert adds_sent == 2
+
+    start = time.monotonic()
+    with pytest.raises(CircuitOpenError):
+        db.add_download_by_link("magnet:?xt=urn:btih:rejected", "user")
+    assert time.monotonic() - start < 0.1
+    assert fake_qb.requests.count(('POST', '/api/v2/torrents/add')) == adds_sent
+    assert db.upstream_status()[db.breaker.name]['state'] == 'open'
+
+    fake_qb.add_delay = 0.0
+    time.sleep(0.35)
+    db.add_download_by_link("magnet:?xt=urn:btih:recovered", "user")
+    assert db.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_file_bulkhead_leaves_room_for_magnets(fake_qb):
+    db = TorrentDB(fake_qb.url, "testuser", "testpass", background_refresh=False, file_concurrency=1)
+    fake_qb.add_delay = 0.3
+    upload = threading.Thread(target=db.add_download_by_file, args=(io.BytesIO(make_torrent("slow")), "user"))
+    upload.start()
+    while db.bulkheads['file'].in_use == 0:
+        time.sleep(0.01)
+
+    results = db.add_downloads_by_files([("a.torrent", io.BytesIO(b"a")), ("b.torrent", io.BytesIO(b"b"))], "user")
+    assert [type(result) for result in results] == [BulkheadFullError, BulkheadFullError]
+    with pytest.raises(BulkheadFullError):
+        db.add_download_by_file(io.BytesIO(make_torrent("other")), "user")
+    db.add_download_by_link("magnet:?xt=urn:btih:fast", "user")
+    upload.join()
+
+    assert db.bulkheads['file'].in_use == 0
+    assert db.breaker.state == CircuitBreaker.CLOSED
+    assert len(fake_qb.added) == 2
+
+
+def test_pool_fails_over_when_circuit_is_open(fake_qbs):
+    pool = make_pool([fake.url for fake in fake_qbs])
+    link = "magnet:?xt=urn:btih:%040x" % 7
+    first = pool._candidates(magnet_info_hash(link), "user1")[0]
+    for _ in range(5):
+        first.get_db().breaker.record_failure("down")
+
+    pool.add_download_by_link(link, "user1")
+    assert not first.healthy
+    assert sum(len(fake.added) for fake in fake_qbs) == 1
+    assert pool.upstream_status()[first.get_db().breaker.name]['state'] == 'open'
@@ -0,0 +1,137 @@
+import hashlib
+import io
+import tempfile
+
+import pytest
+
+from torrent_meta import (
+    magnet_info_hash, parse_magnet, torrent_info_hash, parse_torrent, parse_torrent_upload, InvalidTorrentError,
+)
+
+INFO = b"d6:lengthi10e4:name5:a.bin12:piece lengthi16384e6:pieces20:" + b"p" * 20 + b"e"
+TORRENT = b"d8:announce14:http://tracker4:info" + INFO + b"7:comment3:fooe"
+
+
+def test_magnet_info_hash_hex():
+    magnet = "magnet:?xt=urn:btih:C12FE1C06BBA254A9DC9F519B335AA7C1367A88A&dn=Example"
+    assert magnet_info_hash(magnet) == "c12fe1c06bba254a9dc9f519b335aa7c1367a88a"
+
+
+def test_magnet_info_hash_base32():
+    magnet = "magnet:?dn=Example&xt=urn:btih:YEX6DQDLXISUVHOJ6UM3GNNKPQJWPKEK"
+    assert magnet_info_hash(magnet) == "c12fe1c06bba254a9dc9f519b335aa7c1367a88a"
+
+
+def test_magnet_info_hash_invalid():
+    assert magnet_info_hash("magnet:?dn=NoHash") is None
+    assert magnet_info_hash("magnet:?xt=urn:btih:nothex") is None
+    assert magnet_info_hash("magnet:?xt=urn:btih:" + "z" * 40) is None
+    assert magnet_info_hash("http://example.com/file.torrent") is None
+
+
+def test_parse_magnet():
+    magnet = "magnet:?xt=urn:btih:C12FE1C06BBA254A9DC9F519B335AA7C1367A88A&dn=Some+Name%21&xl=1024&tr=udp://t"
+    info = parse_magnet(magnet)
+    assert info.info_hash == "c12fe1c06bba254a9dc9f519b335aa7c1367a88a"
+    assert info.name == "Some Name!"
+    assert info.size == 1024
+    assert parse_magnet("magnet:?dn=NoHash&xl=big") == (None, "NoHash", None)
+    assert parse_magnet("https://example.com/") is None
+
+
+def test_torrent_info_hash():
+    assert torrent_info_hash(TORRENT) == hashlib.sha1(INFO).hexdigest()
+
+
+def test_torrent_info_hash_invalid():
+    assert torrent_info_hash(b"not bencode") is None
+    assert torrent_info_hash(b"d8:announce3:fooe") is None  # No info dict
+    assert torrent_info_hash(TORRENT[:40]) is None  # Truncated
+    assert torrent_info_hash(b"di1e4:infoe") is None  # Non-string key
+
+
+def bencode_string(value):
+    return b"%d:%s" % (len(value), value)
+
+
+def multi_file_info(count, name=b"album"):
+    files = b"".join(
+        b"d6:lengthi%de4:pathl" % (i + 1) + bencode_string(b"dir") + bencode_string(b"file%d.bin" % i) + b"ee"
+        for i in range(count)
+    )
+    return (b"d5:filesl" + files + b"e4:name" + bencode_string(name)
+            + b"12:piece lengthi16384e6:pieces40:" + b"p" * 40 + b"e")
+
+
+def test_parse_torrent_single_file():
+    metadata = parse_torrent(TORRENT)
+    assert metadata.name == "a.bin"
+    assert metadata.info_hash == hashlib.sha1(INFO).hexdigest()
+    assert metadata.total_size == 10
+    assert metadata.file_count == 1
+
+
+def test_parse_torrent_multi_file():
+    info = multi_file_info(3)
+    metadata = parse_torrent(bytearray(b"d4:info" + info + b"e"))
+    assert metadata == ("album", hashlib.sha1(info).hexdigest(), 1 + 2 + 3, 3)
+
+
+def test_parse_torrent_v2_only():
+    tree = b"d5:a.txtd0:d6:lengthi7e11:pieces root32:" + b"r" * 32 + b"ee5:b.txtd0:d6:lengthi5eeee"
+    info = b"d9:file tree" + tree + b"12:meta versioni2e4:name2:v212:piece lengthi16384ee"
+    metadata = parse_torrent(b"d4:info" + info + b"e")
+    assert metadata == ("v2", hashlib.sha256(info).hexdigest()[:40], 12, 2)
+
+
+@pytest.mark.parametrize("data, error", [
+    (b"", "Not a bencoded dictionary"),
+    (b"d4:infod", "Unexpected end of data"),
+    (TORRENT + b"x", "Trailing data"),
+    (b"d4:info" + INFO.replace(b"i10e", b"i010e") + b"e", "Invalid integer"),
+    (b"d4:info" + INFO.replace(b"i10e", b"i-0e") + b"e", "Invalid integer"),
+    (b"d4:info" + INFO.replace(b"pieces20:", b"pieces99:") + b"e", "runs past the end"),
+    (b"d4:info" + INFO.replace(b"pieces20:" + b"p" * 20, b"pieces19:" + b"p" * 19) + b"e", "not a multiple of 20"),
+    (b"d4:infoli1eee", "'info' is not a dictionary"),
+    (b"d4:info" + INFO.replace(b"4:name5:a.bin", b"") + b"e", "Missing torrent name"),
+    (b"d4:info" + INFO.replace(b"6:lengthi10e", b"") + b"e", "Exactly one of"),
+    (b"d4:info" + multi_file_info(2).replace(b"6:lengthi2e", b"") + b"e", "needs a length"),
+    (b"d4:info" + INFO + b"4:infoe", "Missing value"),
+])
+def test_parse_torrent_rejects_malformed(data, error):
+    with pytest.raises(InvalidTorrentError, match=error):
+        parse_torrent(data)
+
+
+def test_parse_torrent_rejects_deep_nesting():
+    with pytest.raises(InvalidTorrentError, match="Nesting too deep"):
+        parse_torrent(b"d1:x" + b"l" * 100 + b"e" * 100 + b"e")
+
+
+def test_parse_torrent_upload_in_memory_and_spilled():
+    data = b"d4:info" + multi_file_info(50) + b"e"
+    expected = parse_torrent(data)
+
+    in_memory = tempfile.SpooledTemporaryFile(max_size=len(data) + 1)
+    spilled = tempfile.SpooledTemporaryFile(max_size=10)
+    in_memory.write(data)
+    spilled.write(data)
+    assert not in_memory._rolled and spilled._rolled
+
+    for stream in (io.BytesIO(data), in_memory, spilled):
+        stream.seek(5)
+        assert parse_torrent_upload(stream) == expected
+        assert stream.tell() == 5  # Position is restored for the upload to qBittorrent
+        stream.seek(0, io.SEEK_END)
+        stream.write(b"x")  # Fails if the zero-copy view of the buffer was not released
+
+
+def test_parse_torrent_upload_restores_position_on_invalid_data():
+    data = b"d4:infod6:lengthi10e"  # Truncated
+    spilled = tempfile.SpooledTemporaryFile(max_size=1)
+    spilled.write(data)
+    for stream in (io.BytesIO(data), spilled, io.BufferedReader(io.BytesIO(data))):
+        stream.seek(3)
+        with pytest.raises(InvalidTorrentError):
+            parse_torrent_upload(stream)
+        assert stream.tell() == 3
@@ -0,0 +1,130 @@
+import json
+import time
+
+import pytest
+
+import tracing
+from tracing import Tracer, current_trace, span
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def make_tracer(tmp_path):
+    tracers = []
+
+    def make(**kwargs):
+        kwargs.setdefault('flush_interval', 60)
+        tracer = Tracer(str(tmp_path / "traces.jsonl"), **kwargs)
+        tracers.append(tracer)
+        return tracer
+
+    yield make
+    for tracer in tracers:
+        tracer.stop()
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_request_ids_are_kept_only_if_well_formed(make_tracer):
+    tracer = make_tracer()
+    for request_id, kept in [("abc-123.x:y_z", True), ("a" * 65, False), ("bad id", False), ("", False), (None, False)]:
+        trace = tracer.start(request_id)
+        assert (trace.request_id == request_id) is kept
+        assert len(trace.request_id) == 32 or kept
+        tracer.finish(trace, '/status', 'GET', 200)
+
+
+def test_fast_requests_get_a_summary(make_tracer):
+    tracer = make_tracer(slow_seconds=1.0)
+    trace = tracer.start()
+    assert current_trace() is trace
+    with span('auth'):
+        pass
+    record = tracer.finish(trace, '/status', 'GET', 200, user='testuser')
+
+    assert current_trace() is None
+    assert 'spans' not in record
+    assert record['route'] == '/status'
+    assert record['user'] == 'testuser'
+    assert record['request_id'] == trace.request_id
+
+
+def test_failed_slow_and_sampled_requests_keep_their_spans(make_tracer):
+    tracer = make_tracer(slow_seconds=0.05)
+    assert tracer.finish(tracer.start(), '/add_magnet_link', 'POST', 503)['trace'] == 'error'
+    assert tracer.finish(tracer.start(), '/add_magnet_link', 'POST', 200, error=ValueError("boom"))['trace'] == 'error'
+
+    trace = tracer.start()
+    time.sleep(0.05)
+    assert tracer.finish(trace, '/add_magnet_link', 'POST', 200)['trace'] == 'slow'
+    trace = tracer.start()
+    time.sleep(0.05)
+    assert 'trace' not in tracer.finish(trace, '/events', 'GET', 200, streamed=True)
+
+    sampled = make_tracer(slow_seconds=0, sample_rate=1.0)
+    assert sampled.finish(sampled.start(), '/status', 'GET', 200)['trace'] == 'sampled'
+
+
+def test_spans_nest_and_record_errors(make_tracer):
+    tracer = make_tracer(slow_seconds=0, sample_rate=1.0)
+    trace = tracer.start()
+    with span('upstream'):
+        with span('qbittorrent.add_download_by_link'):
+            with pytest.raises(ConnectionError):
+                with span('qbittorrent.retry', status=403):
+                    raise ConnectionError("refused")
+    with span('response'):
+        pass
+    spans = tracer.finish(trace, '/add_magnet_link', 'POST', 200)['spans']
+
+    assert [(s['name'], s['parent']) for s in spans] == [
+        ('upstream', None), ('qbittorrent.add_download_by_link', 0), ('qbittorrent.retry', 1), ('response', None),
+    ]
+    assert spans[2]['status'] == 403
+    assert spans[2]['error'] == 'ConnectionError'
+    assert spans[0]['duration'] >= spans[1]['duration'] >= spans[2]['duration']
+    assert spans[3]['start'] >= spans[0]['start'] + spans[0]['duration']
+
+
+def test_spans_are_not_recorded_without_a_log():
+    tracer = Tracer('')
+    trace = tracer.start()
+    with span('auth') as recorded:
+        assert recorded is None
+    assert trace.spans == []
+    assert tracer.finish(trace, '/status', 'GET', 500) is None
+    with span('outside a request'):
+        pass
+
+
+def test_writer_thread_appends_json_lines(make_tracer, tmp_path):
+    tracer = make_tracer(flush_interval=0.01)
+    for i in range(3):
+        tracer.finish(tracer.start(f"req-{i}"), '/status', 'GET', 200)
+    path = tmp_path / "traces.jsonl"
+
+    assert wait_for(lambda: path.exists() and len(path.read_text().splitlines()) == 3)
+    assert [record['request_id'] for record in read_records(path)] == ["req-0", "req-1", "req-2"]
+
+
+def test_records_beyond_the_buffer_are_dropped(make_tracer, tmp_path, monkeypatch):
+    dropped = []
+    monkeypatch.setattr(tracing.TRACE_RECORDS_DROPPED, "inc", lambda: dropped.append(1))
+    tracer = make_tracer(buffer_size=2)
+    for i in range(5):
+        tracer.finish(tracer.start(f"req-{i}"), '/status', 'GET', 200)
+    tracer.flush()
+
+    assert [record['request_id'] for record in read_records(str(tmp_path / "traces.jsonl"))] == ["req-0", "req-1"]
+    assert len(dropped) == 3
@@ -1,44 +1,1456 @@
+import asyncio
+import bisect
+import hashlib
+import inspect
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlsplit
+
 import requests
-from qbittorrent import Client
+from qbittorrent import Client as _QBittorrentClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import REGISTRY
+from save_policy import DEFAULT_SAVE_PATH
+from torrent_meta import InvalidTorrentError, MagnetInfo, magnet_info_hash, map_file, parse_magnet, parse_torrent_upload
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+QB_CALL_SECONDS = REGISTRY.histogram(
+    'qbittorrent_call_duration_seconds',
+    'Duration of TorrentDB calls to qBittorrent, including re-logins and retries',
+    ['method', 'outcome'],
+)
+QB_CALLS_IN_PROGRESS = REGISTRY.gauge(
+    'qbittorrent_calls_in_progress', 'TorrentDB calls currently waiting on qBittorrent', ['method'],
+)
+QB_SESSION_EVENTS = REGISTRY.counter(
+    'qbittorrent_session_events_total',
+    'qBittorrent logins, 403 retries, re-logins after a 403 and proactive session refreshes',
+    ['event'],
+)
+QB_LOGIN_SECONDS = REGISTRY.histogram('qbittorrent_login_duration_seconds', 'Duration of qBittorrent logins')
+QB_BACKEND_FAILOVERS = REGISTRY.counter(
+    'qbittorrent_backend_failovers_total', 'Calls a TorrentPool moved off an unreachable backend', ['backend'],
+)
+QB_CIRCUITS_OPEN = REGISTRY.gauge(
+    'qbittorrent_circuits_open', 'Workers whose circuit breaker for a qBittorrent backend is open or half-open',
+    ['backend'],
+)
+QB_CIRCUIT_TRANSITIONS = REGISTRY.counter(
+    'qbittorrent_circuit_transitions_total', 'Circuit breaker state changes, by the state entered', ['backend', 'state'],
+)
+QB_CALLS_REJECTED = REGISTRY.counter(
+    'qbittorrent_calls_rejected_total',
+    'Calls failed fast without contacting qBittorrent, because the circuit was open or a bulkhead was full',
+    ['backend', 'reason'],
+)
+MAGNET_CACHE_LOOKUPS = REGISTRY.counter(
+    'magnet_cache_lookups_total', 'Magnet URIs resolved, by whether their info-hash was cached', ['result'],
+)
+
+
+def instrumented(method):
+    # Records the duration and outcome of a TorrentDB / AsyncTorrentDB method,
+    # and how many calls of it are in flight, and traces each call as a span
+    # of the current request (see tracing.py)
+    name = method.__name__
+    span_name = 'qbittorrent.' + name
+    if inspect.iscoroutinefunction(method):
+        @wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            QB_CALLS_IN_PROGRESS.inc(name)
+            try:
+                with span(span_name):
+                    result = await method(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                QB_CALLS_IN_PROGRESS.dec(name)
+                QB_CALL_SECONDS.observe(time.perf_counter() - start, name, outcome)
+        return async_wrapper
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        outcome = 'error'
+        QB_CALLS_IN_PROGRESS.inc(name)
+        try:
+            with span(span_name):
+                result = method(*args, **kwargs)
+            outcome = 'ok'
+            return result
+        finally:
+            QB_CALLS_IN_PROGRESS.dec(name)
+            QB_CALL_SECONDS.observe(time.perf_counter() - start, name, outcome)
+    return wrapper
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    # The call was turned away before it reached qBittorrent, so it is safe to
+    # retry, here or on another backend, after retry_after seconds
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class BulkheadFullError(UpstreamUnavailable):
+    pass
+
+
+_OUTAGE_STATUSES = {502, 503, 504}
+
+
+def is_upstream_outage(error):
+    # Whether an add failed because qBittorrent could not be reached or did not
+    # answer in time, rather than because it rejected the add. Replaying such
+    # an add later is safe: qBittorrent ignores torrents it already has.
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    httpx = sys.modules.get('httpx')  # Errors of the async client, if it is in use
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None) in _OUTAGE_STATUSES
+
+
+class CircuitBreaker():
+    # Stops calling a qBittorrent instance that keeps failing. After
+    # failure_threshold consecutive failures, or as many consecutive calls
+    # slower than slow_call_seconds (0 turns the latency check off), the
+    # circuit opens and calls fail fast with CircuitOpenError. After
+    # reset_timeout seconds it goes half-open and lets half_open_calls probes
+    # through: a success closes it, a failure opens it again. Only errors of
+    # failure_types count, and not those qBittorrent answered with a 4xx: the
+    # instance is up then. Any other exception (a bug on our side, say) counts
+    # as neither success nor failure.
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, slow_call_seconds=0.0, reset_timeout=30.0, half_open_calls=1,
+                 failure_types=(requests.exceptions.RequestException,)):
+        self.name = name
+        self.failure_types = failure_types
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        # Callers hold _lock
+        if state == self.state:
+            return
+        if self.state == self.CLOSED:
+            QB_CIRCUITS_OPEN.inc(self.name)
+        elif state == self.CLOSED:
+            QB_CIRCUITS_OPEN.dec(self.name)
+        if state == self.OPEN:
+            logger.warning("Circuit for qBittorrent %s opened: %s", self.name, self.last_error)
+        elif state == self.CLOSED:
+            logger.info("Circuit for qBittorrent %s closed again", self.name)
+        QB_CIRCUIT_TRANSITIONS.inc(self.name, state)
+        self.state = state
+        self._probes = 0
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+
+    def before_call(self):
+        # Raises CircuitOpenError unless the call may go ahead
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    QB_CALLS_REJECTED.inc(self.name, 'circuit_open')
+                    raise CircuitOpenError(f"qBittorrent {self.name} is unavailable (circuit open)", remaining)
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    QB_CALLS_REJECTED.inc(self.name, 'circuit_open')
+                    raise CircuitOpenError(f"qBittorrent {self.name} is being probed (circuit half-open)",
+                                           min(self.reset_timeout, 1.0))
+                self._probes += 1
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._transition(self.CLOSED)
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._transition(self.OPEN)
+
+    def _is_failure(self, error):
+        if not isinstance(error, self.failure_types):
+            return False
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+        return status_code is None or status_code >= 500
+
+    def record(self, elapsed, error=None):
+        if error is not None and not isinstance(error, self.failure_types):
+            self._release_probe()  # Says nothing about qBittorrent
+            return
+        if error is not None and self._is_failure(error):
+            self.record_failure(error)
+        elif self.slow_call_seconds and elapsed > self.slow_call_seconds:
+            self.record_failure(f"call took {elapsed:.1f}s, over the {self.slow_call_seconds:g}s limit")
+        else:
+            self.record_success()
+
+    @contextmanager
+    def guard(self):
+        # Wraps one call to qBittorrent; works around an await as well
+        self.before_call()
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record(time.perf_counter() - start, e)
+            raise
+        except BaseException:
+            self._release_probe()  # Cancelled; says nothing about qBittorrent
+            raise
+        self.record(time.perf_counter() - start)
+
+    def _release_probe(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def status(self):
+        with self._lock:
+            status = {'state': self.state, 'failures': self.failures, 'last_error': self.last_error}
+            if self.state == self.OPEN:
+                status['retry_after'] = max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+            return status
+
+
+class Bulkhead():
+    # Caps the calls of one kind in flight to a qBittorrent instance, so e.g.
+    # slow batches of file uploads can't take every connection and starve
+    # magnet adds. A call over the cap fails at once with BulkheadFullError
+    # rather than queueing. A limit of 0 means no cap.
+    def __init__(self, name, kind, limit=0):
+        self.name = name
+        self.kind = kind
+        self.limit = limit
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            if self.limit and self.in_use >= self.limit:
+                QB_CALLS_REJECTED.inc(self.name, 'bulkhead_full')
+                raise BulkheadFullError(f"Too many {self.kind} adds in progress on qBittorrent {self.name}")
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_use -= 1
+
+    def status(self):
+        return {'in_use': self.in_use, 'limit': self.limit}
+
+
+def _upstream_name(url):
+    return urlsplit(url).netloc.rpartition('@')[2] or url
+
+
+class MultipartStream():
+    # multipart/form-data body that is produced lazily while the HTTP client
+    # reads from it. File parts are copied in chunks straight from their
+    # streams, so a batch of uploads is never held in memory at once, while
+    # __len__ still lets requests send a proper Content-Length. Parts backed by
+    # a file on disk (large uploads Werkzeug spooled to a temp file) are read
+    # as slices of an mmap instead, which the socket sends without a copy in
+    # between. Use it as a context manager so those mmaps are closed.
+    def __init__(self, fields, files, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self._mapped = {}  # part index -> (memoryview, mmap) or None, opened on first read
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        # Each part is either literal bytes or a (stream, start, size) slice
+        self._parts = []
+        for name, value in fields.items():
+            self._parts.append(self._part_header(name) + str(value).encode('utf-8') + b'\r\n')
+        for name, filename, stream in files:
+            start = stream.tell()
+            stream.seek(0, os.SEEK_END)
+            size = stream.tell() - start
+            stream.seek(start)
+            self._parts.append(self._part_header(name, filename))
+            self._parts.append((stream, start, size))
+            self._parts.append(b'\r\n')
+        self._parts.append(('--%s--\r\n' % self.boundary).encode('ascii'))
+        self._length = sum(len(part) if isinstance(part, bytes) else part[2] for part in self._parts)
+        self.rewind()
+
+    def _part_header(self, name, filename=None):
+        disposition = 'form-data; name="%s"' % name
+        header = ''
+        if filename is not None:
+            disposition += '; filename="%s"' % filename.replace('"', '%22').replace('\r', '').replace('\n', '')
+            header = 'Content-Type: application/x-bittorrent\r\n'
+        return ('--%s\r\nContent-Disposition: %s\r\n%s\r\n' % (self.boundary, disposition, header)).encode('utf-8')
+
+    def __len__(self):
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        mapped, self._mapped = self._mapped, {}
+        for entry in mapped.values():
+            if entry is not None:
+                view, mm = entry
+                view.release()
+                try:
+                    mm.close()
+                except BufferError:
+                    pass  # A chunk is still referenced; closed when it's collected
+
+    def _view(self, index, stream):
+        if index not in self._mapped:
+            mm = map_file(stream)
+            self._mapped[index] = (memoryview(mm), mm) if mm is not None else None
+        entry = self._mapped[index]
+        return entry[0] if entry is not None else None
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    def rewind(self):
+        # Allows the same body to be sent again, e.g. after a 403 re-login
+        self._index = 0
+        self._offset = 0
+
+    def read(self, size=-1):
+        read_all = size is None or size < 0
+        if read_all:
+            size = self._length
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, bytes):
+                chunk = part[self._offset:self._offset + size]
+                part_size = len(part)
+            else:
+                stream, start, part_size = part
+                view = self._view(self._index, stream)
+                if view is not None:
+                    if chunks and not read_all:
+                        break  # Return the mmap slice on its own next time, uncopied
+                    chunk = view[start + self._offset:start + min(self._offset + size, part_size)]
+                    if not read_all:
+                        size = len(chunk)  # Ends this read
+                else:
+                    stream.seek(start + self._offset)
+                    chunk = stream.read(min(size, part_size - self._offset))
+                if not chunk:
+                    raise IOError("Upload stream ended before its expected size")
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._offset += len(chunk)
+            if self._offset >= part_size:
+                self._index += 1
+                self._offset = 0
+        if len(chunks) == 1:
+            return chunks[0]  # Possibly an mmap slice; sent as is
+        return b''.join(chunks)
+
+
+class Client(_QBittorrentClient):
+    # python-qbittorrent's login() posts on a fresh requests.Session without a
+    # timeout, so a hung qBittorrent would block the caller (and whoever waits
+    # for its lock) for good. This login mounts the given adapter on the new
+    # session first and posts with the client's timeouts.
+    def __init__(self, url, verify=True, timeout=None, adapter=None):
+        self.adapter = adapter
+        super().__init__(url, verify=verify, timeout=timeout)
+
+    def login(self, username='admin', password='admin'):
+        session = requests.Session()
+        if self.adapter is not None:
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+        response = session.post(self.url + 'auth/login', data={'username': username, 'password': password},
+                                verify=self.verify, timeout=self.timeout)
+        self.session = session
+        if response.text == 'Ok.':
+            self._is_authenticated = True
+            return None
+        return response.text
 
 
 class TorrentDB():
-    def __init__(self, url, user, passw):
+    def __init__(self, url, user, passw, pool_maxsize=10, pool_block=False,
+                 connect_timeout=5.0, read_timeout=30.0, max_retries=3, backoff_factor=0.5,
+                 session_ttl=3600.0, refresh_margin=60.0, background_refresh=True,
+                 breaker_options=None, magnet_concurrency=0, file_concurrency=None, send_blocksize=256 * 1024,
+                 save_paths=None):
         self.url = url
         self.user = user
         self.passw = passw
-        self.client = Client(self.url)
-        self.client.login(self.user, self.passw)
+        if save_paths is not None:
+            self.gen_savepath = save_paths  # e.g. SavePolicy.save_path
+        # Every call goes through the circuit breaker, and the adds through the
+        # bulkhead of their kind. File uploads may use half the connection pool
+        # by default, so magnet adds always find a connection.
+        name = _upstream_name(url)
+        self.breaker = CircuitBreaker(name, **(breaker_options or {}))
+        if file_concurrency is None:
+            file_concurrency = max(1, pool_maxsize // 2)
+        self.bulkheads = {'magnet': Bulkhead(name, 'magnet', magnet_concurrency),
+                          'file': Bulkhead(name, 'file', file_concurrency)}
+        # One adapter (and so one urllib3 connection pool) for the lifetime of this
+        # TorrentDB. Client.login() creates a fresh requests.Session every time and
+        # mounts the adapter on it before posting, so logins are bounded by the
+        # timeouts and warm keep-alive connections survive re-logins. Connection errors are retried with
+        # backoff; nothing is retried once a request may have reached qBittorrent.
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=Retry(
+                total=max_retries, connect=max_retries, read=0, status=0, other=0,
+                backoff_factor=backoff_factor, raise_on_status=False
+            ),
+        )
+        # Request bodies go out in send_blocksize reads instead of urllib3's
+        # 16 KiB, so large uploads take fewer reads and send calls
+        self.adapter.init_poolmanager(1, pool_maxsize, block=pool_block, blocksize=send_blocksize)
+        # qBittorrent drops a SID after session_ttl seconds without use (the WebUI
+        # "session timeout"). The session is refreshed refresh_margin seconds
+        # before that, either by the background refresher or inline before a call,
+        # so adds don't pay for a 403 + login + retry. Concurrent re-logins are
+        # coalesced: each login bumps _session_generation, and a thread only logs
+        # in if the session it saw fail is still the current one.
+        self.session_ttl = session_ttl
+        self.refresh_margin = refresh_margin
+        self._login_lock = threading.Lock()
+        self._login_wait = connect_timeout + read_timeout  # Longest a login may take
+        self._stats_lock = threading.Lock()
+        self._session_generation = 0
+        self._session_used_at = time.monotonic()
+        self._logged_in = False
+        self._closed = threading.Event()
+        self.stats = {'logins': 0, 'relogins_after_403': 0, 'retries': 0, 'proactive_refreshes': 0}
+        self.client = Client(self.url, timeout=(connect_timeout, read_timeout), adapter=self.adapter)
+        with self._login_lock:
+            self._login()
+        if background_refresh and session_ttl:
+            threading.Thread(target=self._refresh_loop, name='qbittorrent-session-refresh', daemon=True).start()
+
+    def _login(self):
+        # Callers must hold _login_lock
+        with span('qbittorrent.login'), QB_LOGIN_SECONDS.time():
+            result = self.client.login(self.user, self.passw)
+        session = getattr(self.client, 'session', None)
+        if session is not None:
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+        self._session_generation += 1
+        self._session_used_at = time.monotonic()
+        # Client.login() returns None on success and qBittorrent's reply otherwise
+        self._logged_in = result is None
+        self._count('logins')
+        return result
+
+    def _relogin(self, stale_generation):
+        # Logins are bounded by the client timeouts, so waiting longer than one
+        # login for the lock means the upstream is stuck: give up rather than
+        # queue every thread behind it
+        if not self._login_lock.acquire(timeout=self._login_wait):
+            raise UpstreamUnavailable(f"qBittorrent {self.breaker.name} login is taking too long", self._login_wait)
+        try:
+            if self._session_generation != stale_generation:
+                return False  # Another thread already replaced that session
+            self._login()
+            return True
+        finally:
+            self._login_lock.release()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+        QB_SESSION_EVENTS.inc(name)
+
+    def session_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['session_age'] = time.monotonic() - self._session_used_at
+        return stats
+
+    def session_live(self):
+        # Whether the last login succeeded and its SID is within qBittorrent's
+        # idle timeout
+        if not self._logged_in:
+            return False
+        return not self.session_ttl or time.monotonic() - self._session_used_at < self.session_ttl
+
+    def _session_stale(self):
+        return bool(self.session_ttl) and time.monotonic() - self._session_used_at >= self.session_ttl - self.refresh_margin
 
+    def _refresh_loop(self):
+        while True:
+            remaining = self.session_ttl - self.refresh_margin - (time.monotonic() - self._session_used_at)
+            if self._closed.wait(max(remaining, 0.05)):
+                return
+            if self._session_stale():
+                try:
+                    if self._relogin(self._session_generation):
+                        self._count('proactive_refreshes')
+                except Exception:
+                    logger.warning("Background qBittorrent session refresh failed", exc_info=True)
+                    self._closed.wait(min(self.refresh_margin, 5.0) or 1.0)
+
+    def close(self):
+        self._closed.set()
+
+    @instrumented
     def get_torrents(self):
         return self.client.torrents()
 
+    @instrumented
+    def sync_maindata(self, rid=0):
+        return self._execute_with_retry(self.client.sync_main_data, rid)
+
+    @instrumented
+    def count_active_torrents(self):
+        return len(self._execute_with_retry(self.client.torrents, filter='active'))
+
     @staticmethod
     def gen_savepath(username):
-        return "/home/fcstorrent/downloads/qbittorrent/" + username
+        return DEFAULT_SAVE_PATH.format(category=username)
 
     def _execute_with_retry(self, func, *args, **kwargs):
+        with self.breaker.guard():
+            generation = self._session_generation
+            if self._session_stale() and self._relogin(generation):
+                self._count('proactive_refreshes')
+                generation = self._session_generation
+            try:
+                result = func(*args, **kwargs)
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code == 403:
+                    self._count('retries')
+                    with span('qbittorrent.retry', status=403):
+                        if self._relogin(generation):
+                            self._count('relogins_after_403')
+                        result = func(*args, **kwargs)
+                else:
+                    raise
+        self._session_used_at = time.monotonic()
+        return result
+
+    def upstream_status(self):
+        # Breaker and bulkhead state of this worker, for /upstream
+        status = self.breaker.status()
+        status['bulkheads'] = {kind: bulkhead.status() for kind, bulkhead in self.bulkheads.items()}
+        return {self.breaker.name: status}
+
+    @instrumented
+    def add_download_by_link(self, magnet_link, user):
+        with self.bulkheads['magnet'].slot():
+            return self._execute_with_retry(
+                self.client.download_from_link,
+                magnet_link,
+                category=user,
+                savepath=self.gen_savepath(user)
+            )
+
+    @instrumented
+    def add_downloads_by_links(self, links, user):
+        # qBittorrent's torrents/add accepts several newline-separated URLs,
+        # so the whole batch shares one round trip (and one category/savepath).
+        links = list(dict.fromkeys(links))
+        if not links:
+            return None
+        with self.bulkheads['magnet'].slot():
+            return self._execute_with_retry(
+                self.client.download_from_link,
+                links,
+                category=user,
+                savepath=self.gen_savepath(user)
+            )
+
+    @instrumented
+    def add_download_by_file(self, file_descr, user):
+        # Streamed like add_downloads_by_files; the client's download_from_file
+        # would read the whole file into memory to build the request
+        fields = {'category': user, 'savepath': self.gen_savepath(user)}
+        with self.bulkheads['file'].slot():
+            with MultipartStream(fields, [('torrents', 'upload.torrent', file_descr)]) as body:
+                return self._execute_with_retry(self._post_torrent_files, body)
+
+    def _post_torrent_files(self, body):
+        body.rewind()
+        return self.client._post('torrents/add', data=body, headers={'Content-Type': body.content_type})
+
+    @instrumented
+    def add_downloads_by_files(self, files, user, batch_size=50):
+        # files is a list of (filename, stream) pairs. They are sent in batches of
+        # at most batch_size files per torrents/add request, streaming each body.
+        # Returns one entry per file: the upstream response, or the exception
+        # that made its batch fail.
+        results = []
+        fields = {'category': user, 'savepath': self.gen_savepath(user)}
         try:
-            return func(*args, **kwargs)
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 403:
-                self.client.login(self.user, self.passw)
-                return func(*args, **kwargs)
+            with self.bulkheads['file'].slot():
+                for i in range(0, len(files), batch_size):
+                    batch = files[i:i + batch_size]
+                    try:
+                        with MultipartStream(fields, [('torrents', filename, stream) for filename, stream in batch]) as body:
+                            result = self._execute_with_retry(self._post_torrent_files, body)
+                    except Exception as e:
+                        result = e
+                    results.extend([result] * len(batch))
+        except BulkheadFullError as e:
+            return [e] * len(files)
+        return results
+
+
+class Subscription():
+    # Events of one category, handed from the poller thread to one client.
+    # A client that falls max_pending events behind loses the backlog and gets
+    # a fresh snapshot instead, so a stalled connection can't grow memory.
+    def __init__(self, cache, category, max_pending=1000):
+        self.cache = cache
+        self.category = category
+        self.max_pending = max_pending
+        self._events = deque()
+        self._resync = True  # The first wait returns a snapshot
+        self._ready = threading.Condition()
+        self._wake_async = None
+
+    def push(self, event):
+        with self._ready:
+            if len(self._events) >= self.max_pending:
+                self._events.clear()
+                self._resync = True
             else:
-                raise
+                self._events.append(event)
+            self._ready.notify_all()
+        if self._wake_async is not None:
+            self._wake_async()
+
+    def resync(self):
+        # Replaces whatever is pending with a snapshot
+        with self._ready:
+            self._events.clear()
+            self._resync = True
+            self._ready.notify_all()
+        if self._wake_async is not None:
+            self._wake_async()
+
+    def _drain(self):
+        with self._ready:
+            events, self._events = list(self._events), deque()
+            resync, self._resync = self._resync, False
+        if resync:
+            return [{'type': 'snapshot', 'torrents': self.cache.torrents_for_category(self.category)}]
+        return events
+
+    def wait(self, timeout):
+        # Returns the pending events, waiting up to timeout seconds for one
+        with self._ready:
+            if not self._events and not self._resync:
+                self._ready.wait(timeout)
+        return self._drain()
+
+    async def wait_async(self, timeout):
+        if self._wake_async is None:
+            loop = asyncio.get_running_loop()
+            woken = self._woken = asyncio.Event()
+            self._wake_async = lambda: loop.call_soon_threadsafe(woken.set)
+        self._woken.clear()
+        events = self._drain()
+        if events:
+            return events
+        try:
+            await asyncio.wait_for(self._woken.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        return self._drain()
+
+    def close(self):
+        self.cache.unsubscribe(self)
+
+
+def _torrent_size(torrent):
+    # The size of the selected files; total_size if qBittorrent sent no size
+    return torrent.get('size', torrent.get('total_size')) or 0
+
+
+class TorrentStateCache():
+    # In-memory mirror of qBittorrent's torrent list, kept current by polling
+    # sync/maindata with the rid cursor so each poll only transfers what changed.
+    # Torrents are indexed by info-hash, with a secondary index by category (the
+    # per-user category add_download_by_* assigns), so a user's listing costs
+    # O(their torrents) and never waits on qBittorrent. Subscribers get the
+    # changes of their category as events, so any number of clients share the
+    # one poll loop. version(category) changes whenever a category's torrents
+    # do, so responses built from a listing can be cached until then. With
+    # db_factory instead of db, the TorrentDB is created by the first poll, so
+    # starting the cache never waits on qBittorrent. on_removed receives the
+    # info-hashes of torrents that disappeared from qBittorrent.
+    def __init__(self, db=None, poll_interval=2.0, db_factory=None, on_removed=None):
+        self.db = db
+        self.db_factory = db_factory
+        self.on_removed = on_removed
+        self.poll_interval = poll_interval
+        self.rid = 0
+        self.last_sync = None
+        self._torrents = {}
+        self._by_category = {}
+        self._generation = 0  # bumped by full updates, which may change any category
+        self._versions = {}  # category -> changes seen since the last full update
+        self._sizes = {}  # category -> bytes qBittorrent reports for its torrents
+        self._subscribers = {}  # category -> set of Subscriptions
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll_loop, name='torrent-state-cache', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _poll_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.sync_once()
+            except Exception:
+                logger.warning("Polling qBittorrent sync/maindata failed", exc_info=True)
+            self._stopped.wait(self.poll_interval)
+
+    def sync_once(self):
+        if self.db is None:
+            self.db = self.db_factory()
+        self.apply(self.db.sync_maindata(self.rid))
+
+    def subscribe(self, category, max_pending=1000):
+        subscription = Subscription(self, category, max_pending)
+        with self._lock:
+            self._subscribers.setdefault(category, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.category)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.category]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def apply(self, maindata):
+        # Events ((category, event) pairs) are only built for categories
+        # somebody subscribed to
+        events = []
+        with self._lock:
+            watched = self._subscribers
+            full_update = maindata.get('full_update')
+            if full_update or self.last_sync is None:
+                self._generation += 1
+                self._versions = {}
+            # A full update lists every torrent, so whatever it lacks is gone
+            removed = [info_hash for info_hash in self._torrents if info_hash not in maindata.get('torrents', {})] \
+                if full_update else []
+            if full_update:
+                self._torrents = {}
+                self._by_category = {}
+                self._sizes = {}
+            for info_hash, changes in maindata.get('torrents', {}).items():
+                torrent = self._torrents.get(info_hash)
+                is_new = torrent is None
+                if is_new:
+                    torrent = self._torrents[info_hash] = {'hash': info_hash}
+                old_category = torrent.get('category')
+                old_progress = torrent.get('progress')
+                old_size = _torrent_size(torrent)
+                torrent.update(changes)
+                category = torrent.get('category')
+                self._changed(category)
+                if not is_new:
+                    self._add_size(old_category, -old_size)
+                self._add_size(category, _torrent_size(torrent))
+                if is_new or category != old_category:
+                    self._changed(old_category)
+                    self._unindex(info_hash, old_category)
+                    self._by_category.setdefault(category, set()).add(info_hash)
+                if full_update or not watched:
+                    continue
+                if not is_new and category != old_category:
+                    if old_category in watched:
+                        events.append((old_category, {'type': 'removed', 'hash': info_hash}))
+                    changes = torrent
+                if category in watched:
+                    events.append((category, {'type': 'update', 'hash': info_hash, 'changes': dict(changes)}))
+                    if not is_new and old_progress is not None and old_progress < 1 <= torrent.get('progress', 0):
+                        events.append((category, {'type': 'completed', 'hash': info_hash, 'name': torrent.get('name')}))
+            for info_hash in maindata.get('torrents_removed', []):
+                torrent = self._torrents.pop(info_hash, None)
+                if torrent is not None:
+                    removed.append(info_hash)
+                    self._changed(torrent.get('category'))
+                    self._add_size(torrent.get('category'), -_torrent_size(torrent))
+                    self._unindex(info_hash, torrent.get('category'))
+                    if not full_update and torrent.get('category') in watched:
+                        events.append((torrent.get('category'), {'type': 'removed', 'hash': info_hash}))
+            self.rid = maindata.get('rid', self.rid)
+            self.last_sync = time.time()
+            subscribers = {category: list(subscriptions) for category, subscriptions in watched.items()}
+        if removed and self.on_removed is not None:
+            self.on_removed(removed)
+        if full_update:
+            # Every subscriber starts over from a snapshot
+            for subscriptions in subscribers.values():
+                for subscription in subscriptions:
+                    subscription.resync()
+        for category, event in events:
+            for subscription in subscribers.get(category, ()):
+                subscription.push(event)
+
+    def _changed(self, category):
+        self._versions[category] = self._versions.get(category, 0) + 1
+
+    def _add_size(self, category, size):
+        size += self._sizes.get(category, 0)
+        if size:
+            self._sizes[category] = size
+        else:
+            self._sizes.pop(category, None)
+
+    def category_size(self, category):
+        # Bytes of the category's torrents, as qBittorrent reports them
+        with self._lock:
+            return self._sizes.get(category, 0)
+
+    def version(self, category):
+        with self._lock:
+            return (self._generation, self._versions.get(category, 0))
+
+    def _unindex(self, info_hash, category):
+        hashes = self._by_category.get(category)
+        if hashes is not None:
+            hashes.discard(info_hash)
+            if not hashes:
+                del self._by_category[category]
+
+    def get(self, info_hash):
+        with self._lock:
+            torrent = self._torrents.get(info_hash)
+            return dict(torrent) if torrent is not None else None
+
+    def torrents_for_category(self, category):
+        with self._lock:
+            return [dict(self._torrents[info_hash]) for info_hash in self._by_category.get(category, ())]
+
+    def __len__(self):
+        return len(self._torrents)
+
+
+class MagnetCache():
+    # Bounded LRU of what magnet URIs said about each info-hash: the display
+    # name and exact length. A link without dn (or with a different one) for a
+    # torrent seen before resolves to the same name.
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # info-hash -> MagnetInfo
+        self._lock = threading.Lock()
+
+    def resolve(self, magnet_link):
+        # Returns the link's MagnetInfo, completed from the cache, or None if
+        # it is not a magnet URI
+        info = parse_magnet(magnet_link)
+        if info is None or info.info_hash is None:
+            return info
+        with self._lock:
+            cached = self._entries.get(info.info_hash)
+            MAGNET_CACHE_LOOKUPS.inc('miss' if cached is None else 'hit')
+            if cached is not None:
+                info = MagnetInfo(info.info_hash, cached.name or info.name, cached.size or info.size)
+            self._entries[info.info_hash] = info
+            self._entries.move_to_end(info.info_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return info
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class InfoHashIndex():
+    # Bounded LRU + TTL set of info-hashes known to be in qBittorrent, used to
+    # answer repeated adds locally. Torrents removed in qBittorrent are dropped
+    # by replace() and discard(); entries also expire after ttl seconds, in case
+    # neither sees a removal.
+    def __init__(self, max_size=100000, ttl=3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, info_hash):
+        info_hash = info_hash.lower()
+        with self._lock:
+            self._entries[info_hash] = time.monotonic() + self.ttl
+            self._entries.move_to_end(info_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def seed(self, torrents):
+        # torrents as returned by qBittorrent's torrents/info
+        for torrent in torrents:
+            if torrent.get('hash'):
+                self.add(torrent['hash'])
+
+    def replace(self, torrents, started_at):
+        # Like seed(), for qBittorrent's complete torrent list, requested at
+        # started_at (time.monotonic()): hashes missing from it were removed,
+        # unless they were added while the list was being fetched
+        present = {torrent['hash'].lower() for torrent in torrents if torrent.get('hash')}
+        with self._lock:
+            for info_hash, expires_at in list(self._entries.items()):
+                if info_hash not in present and expires_at - self.ttl < started_at:
+                    del self._entries[info_hash]
+        self.seed(torrents)
+
+    def discard(self, info_hash):
+        with self._lock:
+            self._entries.pop(info_hash.lower(), None)
+
+    def __contains__(self, info_hash):
+        if not info_hash:
+            return False
+        info_hash = info_hash.lower()
+        with self._lock:
+            expires_at = self._entries.get(info_hash)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[info_hash]
+                return False
+            self._entries.move_to_end(info_hash)
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ConsistentHashPlacement():
+    # Places a torrent on a hash ring of the backends by its info-hash (by the
+    # user when there is none), so the same torrent always lands on the same
+    # backend and adding or removing a backend only moves ~1/n of them. The
+    # order after the first choice is the failover order.
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self._rings = {}
+
+    @staticmethod
+    def _point(value):
+        return int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+
+    def _ring(self, names):
+        ring = self._rings.get(names)
+        if ring is None:
+            ring = sorted((self._point(f'{name}#{i}'), name) for name in names for i in range(self.replicas))
+            self._rings[names] = ring
+        return ring
+
+    def key(self, info_hash, user):
+        return info_hash or user or ''
+
+    def order(self, backends, info_hash, user):
+        by_name = {backend.name: backend for backend in backends}
+        ring = self._ring(tuple(sorted(by_name)))
+        start = bisect.bisect(ring, (self._point(self.key(info_hash, user)),))
+        ordered = []
+        for i in range(len(ring)):
+            name = ring[(start + i) % len(ring)][1]
+            if by_name[name] not in ordered:
+                ordered.append(by_name[name])
+                if len(ordered) == len(by_name):
+                    break
+        return ordered
+
+
+class UserPlacement(ConsistentHashPlacement):
+    # Keeps all of a user's torrents (their qBittorrent category) on one
+    # backend, so listing them needs a single instance
+    def key(self, info_hash, user):
+        return user or ''
+
+
+class LeastLoadedPlacement():
+    # Prefers the backend with the fewest active torrents, as of the last
+    # health check plus what was placed on it since
+    def order(self, backends, info_hash, user):
+        return sorted(backends, key=lambda backend: backend.active_torrents)
+
+
+PLACEMENTS = {
+    'hash': ConsistentHashPlacement,
+    'user': UserPlacement,
+    'least_loaded': LeastLoadedPlacement,
+}
+
+
+class NoBackendAvailable(UpstreamUnavailable):
+    pass
+
+
+class _Backend():
+    # One qBittorrent instance of a TorrentPool. The TorrentDB is built on
+    # first use, so an instance that is down when the pool starts doesn't
+    # keep the others from serving.
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.db = None
+        self.healthy = True
+        self.active_torrents = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def get_db(self):
+        with self._lock:
+            if self.db is None:
+                self.db = self.factory()
+            return self.db
+
+    def mark_healthy(self, active_torrents=None):
+        if not self.healthy:
+            logger.info("qBittorrent backend %s is available again", self.name)
+        self.healthy = True
+        self.last_error = None
+        if active_torrents is not None:
+            self.active_torrents = active_torrents
+
+    def mark_unhealthy(self, error):
+        if isinstance(error, BulkheadFullError):
+            return  # Busy, not down
+        if self.healthy:
+            logger.warning("qBittorrent backend %s is unavailable: %s", self.name, error)
+        self.healthy = False
+        self.last_error = str(error)
+
+
+class TorrentPool():
+    # Spreads torrents over several qBittorrent instances behind the TorrentDB
+    # interface, so callers don't know whether they talk to one instance or
+    # many. A placement policy orders the backends for each add; unhealthy ones
+    # go last. Only connection errors fail over to the next backend: once a
+    # request may have reached qBittorrent, retrying elsewhere could add the
+    # torrent twice. A background thread re-checks every backend each
+    # health_interval seconds and records its active torrent count.
+    def __init__(self, backends, placement=None, health_interval=10.0):
+        # backends: (name, factory) pairs; factory() returns a logged-in TorrentDB
+        self.backends = [_Backend(name, factory) for name, factory in backends]
+        if not self.backends:
+            raise ValueError("TorrentPool needs at least one backend")
+        self.placement = placement or ConsistentHashPlacement()
+        self.health_interval = health_interval
+        self._maindata_rids = {}
+        self._maindata_hashes = {}
+        self._closed = threading.Event()
+        self.check_health()
+        if not any(backend.healthy for backend in self.backends):
+            raise NoBackendAvailable("No qBittorrent backend is reachable: " + "; ".join(
+                f"{backend.name}: {backend.last_error}" for backend in self.backends))
+        if health_interval:
+            threading.Thread(target=self._health_loop, name='qbittorrent-pool-health', daemon=True).start()
+
+    gen_savepath = staticmethod(TorrentDB.gen_savepath)
+
+    def check_health(self):
+        for backend in self.backends:
+            try:
+                backend.mark_healthy(backend.get_db().count_active_torrents())
+            except Exception as e:
+                backend.mark_unhealthy(e)
+
+    def _health_loop(self):
+        while not self._closed.wait(self.health_interval):
+            self.check_health()
+
+    def close(self):
+        self._closed.set()
+        for backend in self.backends:
+            if backend.db is not None:
+                backend.db.close()
+
+    def session_live(self):
+        return any(backend.db is not None and backend.db.session_live() for backend in self.backends)
+
+    def status(self):
+        return {backend.name: {'healthy': backend.healthy, 'active_torrents': backend.active_torrents,
+                               'error': backend.last_error} for backend in self.backends}
+
+    def upstream_status(self):
+        status = {}
+        for backend in self.backends:
+            if backend.db is not None:
+                status.update(backend.db.upstream_status())
+            else:
+                status[backend.name] = {'state': 'not_connected', 'error': backend.last_error}
+        return status
+
+    def _candidates(self, info_hash, user):
+        ordered = self.placement.order(self.backends, info_hash, user)
+        return [backend for backend in ordered if backend.healthy] + [backend for backend in ordered if not backend.healthy]
+
+    def _call(self, candidates, method, *args, rewind=(), **kwargs):
+        # Calls method on the first backend that is reachable. rewind holds
+        # streams to reset before a retry on the next backend.
+        positions = [stream.tell() for stream in rewind]
+        error = None
+        for i, backend in enumerate(candidates):
+            if i:
+                QB_BACKEND_FAILOVERS.inc(candidates[i - 1].name)
+                for stream, position in zip(rewind, positions):
+                    stream.seek(position)
+            try:
+                result = getattr(backend.get_db(), method)(*args, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                backend.mark_unhealthy(e)
+                error = e
+                continue
+            backend.active_torrents += 1
+            return result
+        raise error
+
+    def _group(self, items, info_hash_of, user):
+        # Splits items by the backend the placement picks first, so each backend
+        # gets one request; a group fails over in the order picked for its
+        # first item. Returns [(candidates, [(index, item), ...])].
+        groups = {}
+        for index, item in enumerate(items):
+            candidates = self._candidates(info_hash_of(item), user)
+            groups.setdefault(candidates[0].name, (candidates, []))[1].append((index, item))
+        return list(groups.values())
+
+    @staticmethod
+    def _file_info_hash(stream):
+        try:
+            return parse_torrent_upload(stream).info_hash
+        except InvalidTorrentError:
+            return None
 
     def add_download_by_link(self, magnet_link, user):
-        return self._execute_with_retry(
-            self.client.download_from_link,
-            magnet_link,
-            category=user,
-            savepath=self.gen_savepath(user)
-        )
+        return self._call(self._candidates(magnet_info_hash(magnet_link), user), 'add_download_by_link', magnet_link, user)
+
+    def add_downloads_by_links(self, links, user):
+        # One upstream request per backend; raises the first error once every
+        # group was tried
+        links = list(dict.fromkeys(links))
+        if not links:
+            return None
+        result = error = None
+        for candidates, group in self._group(links, magnet_info_hash, user):
+            try:
+                result = self._call(candidates, 'add_downloads_by_links', [link for _, link in group], user)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return result
 
     def add_download_by_file(self, file_descr, user):
-        return self._execute_with_retry(
-            self.client.download_from_file,
-            file_descr,
-            category=user,
-            savepath=self.gen_savepath(user)
+        candidates = self._candidates(self._file_info_hash(file_descr), user)
+        return self._call(candidates, 'add_download_by_file', file_descr, user, rewind=[file_descr])
+
+    def add_downloads_by_files(self, files, user, batch_size=50):
+        # Returns one entry per file in the order given, like TorrentDB. Files
+        # whose batch failed with a connection error move on to the next backend.
+        results = [None] * len(files)
+        for candidates, group in self._group(files, lambda item: self._file_info_hash(item[1]), user):
+            for i, backend in enumerate(candidates):
+                if i:
+                    QB_BACKEND_FAILOVERS.inc(candidates[i - 1].name)
+                try:
+                    db = backend.get_db()
+                except requests.exceptions.ConnectionError as e:
+                    backend.mark_unhealthy(e)
+                    group_results = [e] * len(group)
+                else:
+                    streams = [stream for _, (_, stream) in group]
+                    positions = [stream.tell() for stream in streams]
+                    group_results = db.add_downloads_by_files([item for _, item in group], user, batch_size=batch_size)
+                    for stream, position in zip(streams, positions):
+                        stream.seek(position)
+                retry = []
+                for (index, item), result in zip(group, group_results):
+                    results[index] = result
+                    if isinstance(result, requests.exceptions.ConnectionError):
+                        retry.append((index, item))
+                    elif not isinstance(result, Exception):
+                        backend.active_torrents += 1
+                if len(retry) == len(group):
+                    backend.mark_unhealthy(results[retry[0][0]])
+                group = retry
+                if not group:
+                    break
+        return results
+
+    def get_torrents(self):
+        # Torrents of every reachable backend
+        torrents = []
+        for backend in self.backends:
+            try:
+                torrents.extend(backend.get_db().get_torrents())
+            except requests.exceptions.ConnectionError as e:
+                backend.mark_unhealthy(e)
+        return torrents
+
+    def sync_maindata(self, rid=0):
+        # Merges every backend's sync/maindata. The rids are tracked per
+        # backend (the rid passed in only tells a first call from later ones),
+        # and a backend's full update is turned into removals of the torrents
+        # it no longer has, so it doesn't wipe the others' torrents.
+        if not rid:
+            self._maindata_rids = {}
+            self._maindata_hashes = {}
+        merged = {'rid': rid + 1 if rid else 1, 'full_update': not rid, 'torrents': {}, 'torrents_removed': []}
+        for backend in self.backends:
+            try:
+                data = backend.get_db().sync_maindata(self._maindata_rids.get(backend.name, 0))
+            except requests.exceptions.ConnectionError as e:
+                backend.mark_unhealthy(e)
+                continue
+            torrents = data.get('torrents', {})
+            known = self._maindata_hashes.setdefault(backend.name, set())
+            removed = set(data.get('torrents_removed', []))
+            if data.get('full_update'):
+                removed |= known - set(torrents)
+                known.clear()
+            known.update(torrents)
+            known.difference_update(removed)
+            merged['torrents'].update(torrents)
+            merged['torrents_removed'].extend(removed)
+            self._maindata_rids[backend.name] = data.get('rid', 0)
+        return merged
+
+
+class AsyncTorrentPool():
+    # Awaitable facade over a TorrentPool for the async views: each call runs
+    # in a worker thread, so the event loop is not blocked while a backend
+    # answers
+    def __init__(self, pool):
+        self.pool = pool
+
+    gen_savepath = staticmethod(TorrentDB.gen_savepath)
+
+    async def login(self):
+        await asyncio.to_thread(self.pool.check_health)
+
+    def session_live(self):
+        return self.pool.session_live()
+
+    def upstream_status(self):
+        return self.pool.upstream_status()
+
+    async def close(self):
+        pass  # The pool is shared with the sync code and closed with it
+
+    async def get_torrents(self):
+        return await asyncio.to_thread(self.pool.get_torrents)
+
+    async def add_download_by_link(self, magnet_link, user):
+        return await asyncio.to_thread(self.pool.add_download_by_link, magnet_link, user)
+
+    async def add_downloads_by_links(self, links, user):
+        return await asyncio.to_thread(self.pool.add_downloads_by_links, links, user)
+
+    async def add_download_by_file(self, file_descr, user):
+        return await asyncio.to_thread(self.pool.add_download_by_file, file_descr, user)
+
+    async def add_downloads_by_files(self, files, user, batch_size=50):
+        return await asyncio.to_thread(self.pool.add_downloads_by_files, files, user, batch_size)
+
+
+class AsyncTorrentDB():
+    # Non-blocking counterpart of TorrentDB for the ASGI server mode. It talks to
+    # the qBittorrent Web API directly through one pooled httpx.AsyncClient, so
+    # in-flight adds cost coroutines rather than worker processes.
+    def __init__(self, url, user, passw, max_connections=100, connect_timeout=5.0, read_timeout=30.0,
+                 breaker_options=None, magnet_concurrency=0, file_concurrency=None, save_paths=None):
+        import httpx  # Optional dependency, only needed for the async mode
+
+        self.url = url
+        self.user = user
+        self.passw = passw
+        if save_paths is not None:
+            self.gen_savepath = save_paths
+        self.api_url = (url if url.endswith('/') else url + '/') + 'api/v2/'
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self._status_error = httpx.HTTPStatusError
+        self._logged_in = False
+        # Re-logins are coalesced like TorrentDB's: the coroutines that saw the
+        # same session fail wait for one login instead of each sending their own
+        self._login_lock = asyncio.Lock()
+        self._session_generation = 0
+        # Same breaker and bulkheads as TorrentDB; none of them ever waits, so
+        # they are safe to use on the event loop
+        name = _upstream_name(url)
+        self.breaker = CircuitBreaker(name, failure_types=(httpx.HTTPError,), **(breaker_options or {}))
+        if file_concurrency is None:
+            file_concurrency = max(1, max_connections // 2)
+        self.bulkheads = {'magnet': Bulkhead(name, 'magnet', magnet_concurrency),
+                          'file': Bulkhead(name, 'file', file_concurrency)}
+
+    gen_savepath = staticmethod(TorrentDB.gen_savepath)
+
+    async def login(self):
+        QB_SESSION_EVENTS.inc('logins')
+        with span('qbittorrent.login'), QB_LOGIN_SECONDS.time():
+            response = await self.client.post(
+                self.api_url + 'auth/login', data={'username': self.user, 'password': self.passw}
+            )
+        response.raise_for_status()
+        self._session_generation += 1
+        self._logged_in = response.text == 'Ok.'
+        if not self._logged_in:
+            return response.text
+
+    async def _relogin(self, stale_generation):
+        async with self._login_lock:
+            if self._session_generation != stale_generation:
+                return False  # Another coroutine already replaced that session
+            await self.login()
+            return True
+
+    def session_live(self):
+        return self._logged_in
+
+    upstream_status = TorrentDB.upstream_status
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def _request(self, method, endpoint, **kwargs):
+        response = await self.client.request(method, self.api_url + endpoint, **kwargs)
+        response.raise_for_status()
+        if not response.text:
+            return {}
+        try:
+            return response.json()
+        except ValueError:
+            return response.text
+
+    async def _execute_with_retry(self, func, *args, **kwargs):
+        with self.breaker.guard():
+            generation = self._session_generation
+            if not self._logged_in:
+                await self._relogin(generation)
+                generation = self._session_generation
+            try:
+                return await func(*args, **kwargs)
+            except self._status_error as e:
+                if e.response.status_code == 403:
+                    QB_SESSION_EVENTS.inc('retries')
+                    with span('qbittorrent.retry', status=403):
+                        await self._relogin(generation)
+                        return await func(*args, **kwargs)
+                else:
+                    raise
+
+    async def _post_multipart(self, body):
+        async def chunks():
+            body.rewind()
+            for chunk in body:
+                yield chunk
+
+        return await self._request(
+            'POST', 'torrents/add', content=chunks(),
+            headers={'Content-Type': body.content_type, 'Content-Length': str(len(body))}
         )
+
+    @instrumented
+    async def get_torrents(self):
+        return await self._execute_with_retry(self._request, 'GET', 'torrents/info')
+
+    @instrumented
+    async def add_download_by_link(self, magnet_link, user):
+        return await self._add_links([magnet_link], user)
+
+    @instrumented
+    async def add_downloads_by_links(self, links, user):
+        links = list(dict.fromkeys(links))
+        if not links:
+            return None
+        return await self._add_links(links, user)
+
+    async def _add_links(self, links, user):
+        # Not instrumented, so each add is counted once, under the method called
+        fields = {'urls': '\n'.join(links), 'category': user, 'savepath': self.gen_savepath(user)}
+        with self.bulkheads['magnet'].slot():
+            return await self._execute_with_retry(self._post_multipart, MultipartStream(fields, []))
+
+    @instrumented
+    async def add_download_by_file(self, file_descr, user):
+        fields = {'category': user, 'savepath': self.gen_savepath(user)}
+        with self.bulkheads['file'].slot():
+            with MultipartStream(fields, [('torrents', 'upload.torrent', file_descr)]) as body:
+                return await self._execute_with_retry(self._post_multipart, body)
+
+    @instrumented
+    async def add_downloads_by_files(self, files, user, batch_size=50):
+        # Same contract as TorrentDB.add_downloads_by_files
+        results = []
+        fields = {'category': user, 'savepath': self.gen_savepath(user)}
+        try:
+            with self.bulkheads['file'].slot():
+                for i in range(0, len(files), batch_size):
+                    batch = files[i:i + batch_size]
+                    try:
+                        with MultipartStream(fields, [('torrents', filename, stream) for filename, stream in batch]) as body:
+                            result = await self._execute_with_retry(self._post_multipart, body)
+                    except Exception as e:
+                        result = e
+                    results.extend([result] * len(batch))
+        except BulkheadFullError as e:
+            return [e] * len(files)
+        return results
@@ -0,0 +1,306 @@
+# server/torrent_meta.py
+# Helpers to identify and validate torrents locally, without asking
+# qBittorrent: the btih and display name of a magnet URI, and a single-pass
+# bencode validator for .torrent files that also extracts the metadata the API
+# reports.
+import base64
+import binascii
+import hashlib
+import io
+import mmap
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl
+
+TorrentMetadata = namedtuple('TorrentMetadata', ['name', 'info_hash', 'total_size', 'file_count'])
+MagnetInfo = namedtuple('MagnetInfo', ['info_hash', 'name', 'size'])
+
+
+class InvalidTorrentError(ValueError):
+    pass
+
+
+def _btih(btih):
+    if len(btih) == 40:
+        try:
+            return binascii.unhexlify(btih).hex()
+        except (binascii.Error, ValueError):
+            return None
+    if len(btih) == 32:
+        try:
+            return base64.b32decode(btih.upper()).hex()
+        except (binascii.Error, ValueError):
+            return None
+    return None
+
+
+def parse_magnet(magnet_link):
+    # Returns the MagnetInfo of a magnet URI, or None if it is not one. The
+    # info-hash is that of the first urn:btih; it, the dn display name and the
+    # xl exact length are None when missing or unusable.
+    parts = urlsplit(magnet_link.strip())
+    if parts.scheme.lower() != 'magnet':
+        return None
+    info_hash = name = size = None
+    seen_btih = False
+    for key, value in parse_qsl(parts.query):
+        if (key == 'xt' or key.startswith('xt.')) and value.lower().startswith('urn:btih:') and not seen_btih:
+            seen_btih = True
+            info_hash = _btih(value[len('urn:btih:'):])
+        elif key == 'dn' and name is None and value.strip():
+            name = value.strip()
+        elif key == 'xl' and size is None and value.isdigit():
+            size = int(value)
+    return MagnetInfo(info_hash, name, size)
+
+
+def magnet_info_hash(magnet_link):
+    # Returns the lowercase hex info-hash of a magnet URI, or None if it has no
+    # usable urn:btih (hex and base32 forms are both accepted).
+    info = parse_magnet(magnet_link)
+    return info.info_hash if info is not None else None
+
+
+_DICT, _INT = ord('d'), ord('i')
+_DIGITS = frozenset(b'0123456789')
+# One token per match: a string length prefix, a whole integer, or d/l/e. The
+# regex engine scans the buffer in C, which keeps the per-token cost low.
+_TOKEN = re.compile(rb'(0|[1-9][0-9]{0,18}):|i(0|-?[1-9][0-9]{0,30})e|([dle])')
+
+_INFO = (b'info',)
+_NAME = (b'info', b'name')
+_LENGTH = (b'info', b'length')
+_PIECE_LENGTH = (b'info', b'piece length')
+_PIECES = (b'info', b'pieces')
+_META_VERSION = (b'info', b'meta version')
+
+
+def parse_torrent(data, max_depth=64):
+    # Validates a bencoded .torrent file in one pass and returns its
+    # TorrentMetadata. data can be bytes, bytearray, a memoryview or an mmap;
+    # values are read in place, so large strings such as 'pieces' are never
+    # copied and no object tree is built. The v1 info-hash is the SHA-1 of the
+    # raw info dict; v2-only torrents report the truncated SHA-256 like
+    # qBittorrent does. Raises InvalidTorrentError.
+    buf = memoryview(data)
+    if buf.ndim != 1 or buf.itemsize != 1:
+        buf = buf.cast('B')
+    size = len(buf)
+    if size == 0 or buf[0] != _DICT:
+        raise InvalidTorrentError("Not a bencoded dictionary")
+
+    # Each open container is [is_dict, path, pending_key, next_index]; the path
+    # of a value is its container's path plus its key (dicts) or index (lists).
+    match = _TOKEN.match
+    stack = []
+    pos = 0
+    info_start = info_end = None
+    name = None
+    single_length = None
+    piece_length = None
+    pieces_length = None
+    meta_version = 1
+    files_entries = 0
+    files_lengths = 0
+    files_total = 0
+    tree_files = 0
+    tree_total = 0
+    has_files = has_tree = False
+
+    try:
+        while True:
+            token = match(buf, pos)
+            if token is None:
+                raise _token_error(buf, pos, size)
+            kind = token.lastindex
+            value = token.group(kind)
+
+            if stack:
+                frame = stack[-1]
+                if value == b'e':
+                    if frame[0] and frame[2] is not None:
+                        raise InvalidTorrentError(f"Missing value for key at offset {pos}")
+                    stack.pop()
+                    pos += 1
+                    if frame[1] == _INFO:
+                        info_end = pos
+                    if not stack:
+                        break
+                    parent = stack[-1]
+                    if parent[0]:
+                        parent[2] = None
+                    else:
+                        parent[3] += 1
+                    continue
+                if frame[0] and frame[2] is None:
+                    if kind != 1:
+                        raise InvalidTorrentError(f"Dictionary key is not a string at offset {pos}")
+                    start = token.end()
+                    pos = start + int(value)
+                    if pos > size:
+                        raise InvalidTorrentError(f"String at offset {token.start()} runs past the end of data")
+                    frame[2] = buf[start:pos].tobytes()
+                    continue
+                path = frame[1] + ((frame[2],) if frame[0] else (frame[3],))
+            else:
+                path = ()
+
+            if kind == 3:
+                if value == b'e':
+                    raise InvalidTorrentError(f"Unexpected end marker at offset {pos}")
+                if len(stack) >= max_depth:
+                    raise InvalidTorrentError("Nesting too deep")
+                if path == _INFO:
+                    if value != b'd':
+                        raise InvalidTorrentError("'info' is not a dictionary")
+                    info_start = pos
+                elif len(path) == 3 and path[:2] == (b'info', b'files') and value == b'd':
+                    files_entries += 1
+                elif len(path) == 2 and path[0] == b'info':
+                    has_files = has_files or path[1] == b'files'
+                    has_tree = has_tree or path[1] == b'file tree'
+                stack.append([value == b'd', path, None, 0])
+                pos += 1
+                continue
+
+            if kind == 2:
+                pos = token.end()
+                number = int(value)
+                if path == _LENGTH:
+                    single_length = number
+                elif path == _PIECE_LENGTH:
+                    piece_length = number
+                elif path == _META_VERSION:
+                    meta_version = number
+                elif len(path) > 2 and path[-1] == b'length' and path[0] == b'info':
+                    if len(path) == 4 and path[1] == b'files':
+                        if number < 0:
+                            raise InvalidTorrentError("Negative file length")
+                        files_lengths += 1
+                        files_total += number
+                    elif path[1] == b'file tree' and path[-2] == b'':
+                        if number < 0:
+                            raise InvalidTorrentError("Negative file length")
+                        tree_files += 1
+                        tree_total += number
+            else:
+                start = token.end()
+                pos = start + int(value)
+                if pos > size:
+                    raise InvalidTorrentError(f"String at offset {token.start()} runs past the end of data")
+                if path == _NAME:
+                    name = buf[start:pos].tobytes().decode('utf-8', errors='replace')
+                elif path == _PIECES:
+                    pieces_length = pos - start
+
+            if frame[0]:
+                frame[2] = None
+            else:
+                frame[3] += 1
+
+        if pos != size:
+            raise InvalidTorrentError("Trailing data after the torrent dictionary")
+        if info_start is None or info_end is None:
+            raise InvalidTorrentError("Missing 'info' dictionary")
+        if not name:
+            raise InvalidTorrentError("Missing torrent name")
+        if piece_length is None or piece_length <= 0:
+            raise InvalidTorrentError("Missing or invalid 'piece length'")
+
+        if pieces_length is not None:
+            if pieces_length % 20:
+                raise InvalidTorrentError("'pieces' is not a multiple of 20 bytes")
+            if has_files == (single_length is not None):
+                raise InvalidTorrentError("Exactly one of 'length' and 'files' is required")
+            if has_files:
+                if files_entries == 0 or files_lengths != files_entries:
+                    raise InvalidTorrentError("Every entry in 'files' needs a length")
+                total_size, file_count = files_total, files_entries
+            else:
+                if single_length < 0:
+                    raise InvalidTorrentError("Negative file length")
+                total_size, file_count = single_length, 1
+            info_hash = hashlib.sha1(buf[info_start:info_end]).hexdigest()
+        elif meta_version == 2 and has_tree and tree_files:
+            total_size, file_count = tree_total, tree_files
+            info_hash = hashlib.sha256(buf[info_start:info_end]).hexdigest()[:40]
+        else:
+            raise InvalidTorrentError("Missing 'pieces'")
+    finally:
+        buf.release()
+
+    return TorrentMetadata(name, info_hash, total_size, file_count)
+
+
+def _token_error(buf, pos, size):
+    if pos >= size:
+        return InvalidTorrentError("Unexpected end of data")
+    c = buf[pos]
+    if c == _INT:
+        return InvalidTorrentError(f"Invalid integer at offset {pos}")
+    if c in _DIGITS:
+        return InvalidTorrentError(f"Invalid string length at offset {pos}")
+    return InvalidTorrentError(f"Unexpected byte {bytes([c])!r} at offset {pos}")
+
+
+def torrent_info_hash(data):
+    # Returns the info-hash of a .torrent file's bytes, or None if it is invalid
+    try:
+        return parse_torrent(data).info_hash
+    except InvalidTorrentError:
+        return None
+
+
+def map_file(stream):
+    # Returns a read-only mmap of the file behind stream (a temp file, or a
+    # SpooledTemporaryFile that spilled to disk), or None if there is none.
+    # Its contents live in the page cache, not in this process's heap.
+    inner = getattr(stream, '_file', stream)  # Unwrap SpooledTemporaryFile
+    if isinstance(inner, io.BytesIO):
+        return None
+    try:
+        fileno = inner.fileno()
+        position = inner.tell()
+        size = inner.seek(0, io.SEEK_END)  # Also flushes buffered writes
+        inner.seek(position)
+        if size > 0:
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, io.UnsupportedOperation, ValueError):
+        pass
+    return None
+
+
+@contextmanager
+def upload_buffer(stream):
+    # Yields a zero-copy view of an uploaded file's contents: the in-memory
+    # buffer of a BytesIO (or of a SpooledTemporaryFile that hasn't spilled to
+    # disk), or an mmap of the temp file it spilled to. Falls back to reading
+    # the stream. The stream position is left unchanged, even if parsing the
+    # contents fails.
+    position = stream.tell()
+    try:
+        inner = getattr(stream, '_file', stream)
+        if isinstance(inner, io.BytesIO):
+            view = inner.getbuffer()
+            try:
+                yield view
+            finally:
+                view.release()
+        else:
+            mapped = map_file(stream)
+            if mapped is not None:
+                try:
+                    yield mapped
+                finally:
+                    mapped.close()
+            else:
+                stream.seek(0)
+                yield stream.read()
+    finally:
+        stream.seek(position)
+
+
+def parse_torrent_upload(stream):
+    with upload_buffer(stream) as data:
+        return parse_torrent(data)
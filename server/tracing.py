@@ -0,0 +1,205 @@
+# server/tracing.py
+# Request tracing. Every request gets an ID, taken from a well-formed
+# X-Request-ID header or generated, which the response echoes back. While a
+# request runs, spans are kept for its phases (auth, parse, upstream) and for
+# every TorrentDB call to qBittorrent, including logins and retries after a
+# 403. The current trace lives in a context variable, so torrent_lib records
+# spans without knowing about Flask, in threads and on the event loop alike.
+#
+# With a log path set, each finished request becomes one JSON line: a summary
+# for most requests, and the full list of spans for requests that failed, took
+# at least slow_seconds or were picked by sample_rate. Requests only append the
+# record to a buffer; a background thread serializes and writes the buffer
+# every flush_interval seconds. If the writer falls behind by buffer_size
+# records, new records are dropped (and counted) rather than waited for.
+import atexit
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+TRACE_RECORDS = REGISTRY.counter(
+    'trace_records_total', 'Request trace records written, by kind (full or summary)', ['kind'],
+)
+TRACE_RECORDS_DROPPED = REGISTRY.counter(
+    'trace_records_dropped_total', 'Request trace records dropped because the trace writer fell behind',
+)
+
+_REQUEST_ID = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace():
+    def __init__(self, request_id, recording=True, sampled=False):
+        self.request_id = request_id
+        self.recording = recording  # False: only the request ID is needed
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self._open = []  # Indexes of the spans not ended yet, innermost last
+        self._token = None
+
+    def span(self, name, **attrs):
+        if not self.recording:
+            return nullcontext()
+        return self._span(name, attrs)
+
+    @contextmanager
+    def _span(self, name, attrs):
+        index = len(self.spans)
+        record = {'name': name, 'start': round(time.perf_counter() - self.started, 6), 'duration': None,
+                  'parent': self._open[-1] if self._open else None}
+        record.update(attrs)
+        self.spans.append(record)
+        self._open.append(index)
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            record['duration'] = round(time.perf_counter() - self.started - record['start'], 6)
+            self._open.remove(index)
+
+
+def current_trace():
+    return _current.get()
+
+
+def span(name, **attrs):
+    # A span of the current request's trace; does nothing outside a request
+    trace = _current.get()
+    return trace.span(name, **attrs) if trace is not None else nullcontext()
+
+
+class Tracer():
+    # An empty path turns the records off; '-' writes them to stderr
+    def __init__(self, path='', slow_seconds=1.0, sample_rate=0.0, buffer_size=10000, flush_interval=1.0):
+        self.path = path
+        self.slow_seconds = slow_seconds
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer_pid = None
+        self._wakeup = threading.Event()
+        if self.enabled:
+            atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start(self, request_id=None):
+        # Makes a new Trace the current one; request_id is the client's
+        # X-Request-ID, kept if it is well-formed
+        if not request_id or not _REQUEST_ID.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        sampled = bool(self.sample_rate) and random.random() < self.sample_rate
+        trace = Trace(request_id, recording=self.enabled, sampled=sampled)
+        trace._token = _current.set(trace)
+        return trace
+
+    def finish(self, trace, route, method, status, user=None, error=None, streamed=False):
+        # Ends the trace and buffers its record; returns the record, or None
+        # if records are off. Streamed responses (e.g. /events) are open for
+        # minutes by design and never count as slow.
+        duration = time.perf_counter() - trace.started
+        try:
+            _current.reset(trace._token)
+        except ValueError:
+            _current.set(None)  # Finished in another context than it started in
+        if not self.enabled:
+            return None
+        if error is not None or status >= 500:
+            reason = 'error'
+        elif self.slow_seconds and duration >= self.slow_seconds and not streamed:
+            reason = 'slow'
+        else:
+            reason = 'sampled' if trace.sampled else None
+        record = {
+            'time': trace.started_at, 'request_id': trace.request_id, 'method': method, 'route': route,
+            'status': status, 'user': user, 'duration': round(duration, 6), 'pid': os.getpid(),
+        }
+        if error is not None:
+            record['error'] = f'{type(error).__name__}: {error}'
+        if reason is not None:
+            record['trace'] = reason
+            record['spans'] = trace.spans
+        self._emit(record)
+        return record
+
+    def _emit(self, record):
+        with self._lock:
+            if len(self._pending) >= self.buffer_size:
+                TRACE_RECORDS_DROPPED.inc()
+                return
+            self._pending.append(record)
+        self._ensure_writer()
+
+    def flush(self):
+        # Writes the buffered records; called by the writer thread
+        with self._lock:
+            records, self._pending = self._pending, []
+        if not records:
+            return
+        data = ''.join(json.dumps(record, separators=(',', ':'), default=str) + '\n' for record in records)
+        with self._write_lock:
+            if self.path == '-':
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            else:
+                # One write() per batch on an O_APPEND file, so the lines of
+                # workers sharing the file never interleave
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    view = memoryview(data.encode('utf-8'))
+                    while view:
+                        view = view[os.write(fd, view):]
+                finally:
+                    os.close(fd)
+        full = sum(1 for record in records if 'spans' in record)
+        if full:
+            TRACE_RECORDS.inc('full', amount=full)
+        if len(records) > full:
+            TRACE_RECORDS.inc('summary', amount=len(records) - full)
+
+    def stop(self):
+        self._writer_pid = None
+        self._wakeup.set()
+        if self.enabled:
+            self.flush()
+            atexit.unregister(self.flush)
+
+    def _ensure_writer(self):
+        # One writer thread per process, restarted in forked workers
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid != os.getpid():
+                self._writer_pid = os.getpid()
+                self._wakeup.clear()
+                threading.Thread(target=self._write_loop, name='trace-writer', daemon=True).start()
+
+    def _write_loop(self):
+        pid = os.getpid()
+        while self._writer_pid == pid:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                logger.warning("Writing request traces to %s failed", self.path, exc_info=True)